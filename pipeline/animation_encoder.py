@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Streaming Animation Encoder
+
+7_1_frame_compiler.ipynb used to read every PNG frame of a sequence into a
+list and hand the list to `imageio.mimsave`, so memory grew with the number
+of frames. This module appends frames one at a time instead:
+
+- GIF output is written block by block with Pillow's GIF encoder. Every frame
+  is quantized to one global palette, stored once in the file header, so the
+  colours do not flicker between frames and no frame has to be kept after it
+  is written. The default 'outline' palette holds 255 grey levels plus the
+  outline colour; 'adaptive' derives the palette from the first frame.
+- MP4 and WebM output, better suited to long sequences, goes through an
+  `imageio` ffmpeg writer (`pip install imageio[ffmpeg]`), which also
+  streams.
+- Frames can come straight from the outline renderer (`outline_frames.py`)
+  so no intermediate PNGs are needed, or from existing PNG frame folders.
+  Rendering runs in a small process pool with a bounded number of frames in
+  flight.
+- `downsample` shrinks frames by an integer factor: the projection is block
+  averaged and the mask is subsampled, so outlines stay one pixel wide.
+
+Usage:
+    python animation_encoder.py                                   # every condition and channel, GIF
+    python animation_encoder.py --conditions TSA --channels CH0 --format mp4
+    python animation_encoder.py --source frames --downsample 2    # from results/gif_frames PNGs
+    python animation_encoder.py compare --conditions TSA --channels CH0
+"""
+
+import os
+import glob
+import time
+import argparse
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, GifImagePlugin
+
+from zarr_store import ImageSource, DATA_DIR, STORAGE
+from outline_frames import render_outline, CHANNELS, OUTLINE_COLOR, GIF_FRAMES_DIR
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PLOTS_DIR = os.path.join(BASE_DIR, "results", "plots")
+
+DEFAULT_FPS = 5
+FORMATS = ['gif', 'mp4', 'webm']
+VIDEO_CODECS = {'mp4': 'libx264', 'webm': 'libvpx-vp9'}
+PALETTES = ['outline', 'adaptive']
+# Distinct colours matched against the palette at once
+QUANTIZE_CHUNK = 4096
+
+
+def outline_palette(color=OUTLINE_COLOR):
+    """(256, 3) uint8 palette: 255 evenly spaced grey levels and the outline colour last."""
+    grey = np.round(np.arange(255) * 255 / 254).astype(np.uint8)
+    return np.vstack([np.repeat(grey[:, None], 3, axis=1), np.array(color, dtype=np.uint8)[None]])
+
+
+def adaptive_palette(frame, colors=256):
+    """(colors, 3) uint8 palette chosen by median cut from one frame."""
+    quantized = Image.fromarray(_rgb(frame)).quantize(colors, method=Image.Quantize.MEDIANCUT)
+    return np.array(quantized.getpalette()[:colors * 3], dtype=np.uint8).reshape(-1, 3)
+
+
+def _rgb(frame):
+    """Drop the alpha channel and promote grey frames to RGB."""
+    frame = np.asarray(frame)
+    if frame.dtype != np.uint8:
+        raise ValueError(f"Frames must be uint8, got {frame.dtype}")
+    if frame.ndim == 2:
+        return np.repeat(frame[..., None], 3, axis=2)
+    return np.ascontiguousarray(frame[..., :3])
+
+
+def downsample(image, factor):
+    """Block mean over factor x factor pixels; edges that do not fill a block are cropped."""
+    if factor == 1:
+        return image
+    h, w = image.shape[0] // factor * factor, image.shape[1] // factor * factor
+    blocks = image[:h, :w].reshape(h // factor, factor, w // factor, factor, *image.shape[2:])
+    return blocks.mean(axis=(1, 3), dtype=np.float64).round().astype(image.dtype)
+
+
+class GifWriter:
+    """Writes an animated GIF one frame at a time with a single global palette."""
+
+    def __init__(self, path, fps=DEFAULT_FPS, palette='outline', loop=0):
+        self.path = path
+        self.duration = int(round(1000 / fps))
+        self.palette = palette
+        self.loop = loop
+        self.size = None
+        self._file = None
+        self._palette_image = None
+
+    def _start(self, frame):
+        palette = self.palette
+        if isinstance(palette, str):
+            palette = outline_palette() if palette == 'outline' else adaptive_palette(frame)
+        palette = np.asarray(palette, dtype=np.uint8).reshape(-1, 3)
+        if len(palette) > 256:
+            raise ValueError(f"A GIF palette holds at most 256 colours, got {len(palette)}")
+        palette = np.vstack([palette, np.zeros((256 - len(palette), 3), dtype=np.uint8)])
+        self._palette = palette.astype(np.int32)
+        self._palette_image = Image.new('P', (1, 1))
+        self._palette_image.putpalette(palette.tobytes())
+
+        self.size = frame.shape[1], frame.shape[0]
+        first = self._quantize(frame)
+        header, _ = GifImagePlugin.getheader(first, info={'loop': self.loop})
+        self._file = open(self.path, 'wb')
+        self._file.writelines(header)
+        return first
+
+    def _quantize(self, frame):
+        # Exact nearest palette entry for each distinct colour; Pillow's own lookup is approximate
+        rgb = _rgb(frame).astype(np.uint32)
+        packed = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+        colors, inverse = np.unique(packed.ravel(), return_inverse=True)
+        colors = np.stack([colors >> 16, (colors >> 8) & 255, colors & 255], axis=1).astype(np.int32)
+        nearest = np.empty(len(colors), dtype=np.uint8)
+        for start in range(0, len(colors), QUANTIZE_CHUNK):
+            distance = ((colors[start:start + QUANTIZE_CHUNK, None, :] - self._palette[None]) ** 2).sum(axis=2)
+            nearest[start:start + QUANTIZE_CHUNK] = distance.argmin(axis=1)
+        image = Image.fromarray(nearest[inverse].reshape(packed.shape), mode='P')
+        image.putpalette(self._palette_image.getpalette())
+        return image
+
+    def append(self, frame):
+        if self._file is None:
+            image = self._start(frame)
+        else:
+            if (frame.shape[1], frame.shape[0]) != self.size:
+                raise ValueError(f"Frame size {frame.shape[1]}x{frame.shape[0]} does not match "
+                                 f"{self.size[0]}x{self.size[1]}")
+            image = self._quantize(frame)
+        # Without a local palette flag the frame uses the global table from the header
+        self._file.writelines(GifImagePlugin.getdata(image, duration=self.duration, disposal=1))
+
+    def close(self):
+        if self._file is not None:
+            self._file.write(b';')
+            self._file.close()
+            self._file = None
+
+
+class VideoWriter:
+    """MP4/WebM through imageio's ffmpeg writer, padded to even dimensions for yuv420p."""
+
+    def __init__(self, path, fps=DEFAULT_FPS, codec=None, quality=7):
+        try:
+            import imageio_ffmpeg  # noqa: F401
+        except ImportError:
+            raise ImportError("MP4/WebM output needs imageio-ffmpeg: pip install imageio[ffmpeg]") from None
+        import imageio.v2 as imageio
+        extension = os.path.splitext(path)[1].lstrip('.').lower()
+        self._writer = imageio.get_writer(path, format='FFMPEG', mode='I', fps=fps,
+                                          codec=codec or VIDEO_CODECS.get(extension, 'libx264'),
+                                          quality=quality, macro_block_size=1)
+        self.size = None
+
+    def append(self, frame):
+        frame = _rgb(frame)
+        if self.size is None:
+            self.size = frame.shape[1] + frame.shape[1] % 2, frame.shape[0] + frame.shape[0] % 2
+        pad_h, pad_w = self.size[1] - frame.shape[0], self.size[0] - frame.shape[1]
+        if pad_h < 0 or pad_w < 0 or pad_h > 1 or pad_w > 1:
+            raise ValueError(f"Frame size {frame.shape[1]}x{frame.shape[0]} does not match "
+                             f"{self.size[0]}x{self.size[1]}")
+        if pad_h or pad_w:
+            frame = np.pad(frame, ((0, pad_h), (0, pad_w), (0, 0)), mode='edge')
+        self._writer.append_data(frame)
+
+    def close(self):
+        self._writer.close()
+
+
+class AnimationWriter:
+    """
+    Context manager that appends frames to a GIF, MP4 or WebM file as they arrive.
+
+        with AnimationWriter("TSA_CH0.gif", fps=5) as writer:
+            for frame in frames:
+                writer.append(frame)
+
+    `downsample` is applied to each appended frame (block mean); `palette` is
+    used for GIF output only.
+    """
+
+    def __init__(self, path, fps=DEFAULT_FPS, downsample=1, palette='outline', loop=0):
+        extension = os.path.splitext(path)[1].lstrip('.').lower()
+        if extension not in FORMATS:
+            raise ValueError(f"Unsupported animation format '.{extension}' (use {', '.join(FORMATS)})")
+        self.path = path
+        self.downsample = downsample
+        self.frames = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if extension == 'gif':
+            self._writer = GifWriter(path, fps, palette, loop)
+        else:
+            self._writer = VideoWriter(path, fps)
+
+    def append(self, frame):
+        self._writer.append(downsample(np.asarray(frame), self.downsample))
+        self.frames += 1
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def render_outline_frame(condition, channel, filename, factor=1, storage=None, data_dir=DATA_DIR):
+    """One outline frame rendered from the projection and mask, optionally downsampled."""
+    source = ImageSource(storage, data_dir)
+    image = source.read(condition, channel, filename)
+    mask = source.read(condition, f"{channel}_masks", filename)
+    if factor > 1:
+        image = downsample(image, factor)
+        mask = mask[:image.shape[0] * factor:factor, :image.shape[1] * factor:factor]
+    return render_outline(image, mask)
+
+
+def _bounded_map(function, tasks, workers, in_flight):
+    """Like executor.map, but with at most `in_flight` results waiting to be consumed."""
+    tasks = iter(tasks)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        for task in tasks:
+            pending.append(executor.submit(function, *task))
+            if len(pending) >= in_flight:
+                break
+        while pending:
+            result = pending.popleft().result()
+            for task in tasks:
+                pending.append(executor.submit(function, *task))
+                break
+            yield result
+
+
+def outline_frame_stream(condition, channel, factor=1, storage=None, data_dir=DATA_DIR, workers=1):
+    """Outline frames of one sequence in projection filename order, rendered as they are needed."""
+    filenames = ImageSource(storage, data_dir).list(condition, channel)
+    tasks = [(condition, channel, filename, factor, storage, data_dir) for filename in filenames]
+    if workers <= 1:
+        return (render_outline_frame(*task) for task in tasks)
+    return _bounded_map(render_outline_frame, tasks, workers, in_flight=2 * workers)
+
+
+def png_frame_stream(frames_dir):
+    """Frames of an existing PNG folder (frame_XXX.png), read one at a time."""
+    for path in sorted(glob.glob(os.path.join(frames_dir, "*.png"))):
+        with Image.open(path) as image:
+            yield np.asarray(image)
+
+
+def compile_animation(frames, output_path, fps=DEFAULT_FPS, downsample=1, palette='outline'):
+    """Append every frame of an iterable to `output_path`; returns the number of frames."""
+    with AnimationWriter(output_path, fps=fps, downsample=downsample, palette=palette) as writer:
+        for frame in frames:
+            writer.append(frame)
+    return writer.frames
+
+
+def animation_path(condition, channel, fmt='gif', plots_dir=PLOTS_DIR):
+    return os.path.join(plots_dir, f"{condition}_{channel}_segmentation.{fmt}")
+
+
+def compile_all(conditions=None, channels=CHANNELS, fmt='gif', fps=DEFAULT_FPS, factor=1, palette='outline',
+                source='masks', storage=None, data_dir=DATA_DIR, frames_dir=GIF_FRAMES_DIR,
+                plots_dir=PLOTS_DIR, workers=None):
+    """One animation per condition and channel; returns {output_path: frames} for those written."""
+    workers = workers or int(os.environ.get("SMFISH_CORES", os.cpu_count()))
+    image_source = ImageSource(storage, data_dir)
+    written = {}
+    for condition in conditions or image_source.conditions('CH0'):
+        for channel in channels:
+            output_path = animation_path(condition, channel, fmt, plots_dir)
+            # Written under a temporary name (same extension) and moved into place only once complete
+            root, extension = os.path.splitext(output_path)
+            tmp_path = f"{root}.{os.getpid()}.tmp{extension}"
+            try:
+                if source == 'frames':
+                    frames = png_frame_stream(os.path.join(frames_dir, f"{condition}_{channel}"))
+                    count = compile_animation(frames, tmp_path, fps, factor, palette)
+                else:
+                    frames = outline_frame_stream(condition, channel, factor, storage, data_dir, workers)
+                    count = compile_animation(frames, tmp_path, fps, 1, palette)
+            except Exception as e:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                print(f"  - FAILED to process {condition}_{channel}: {e}")
+                continue
+            if count:
+                os.replace(tmp_path, output_path)
+                print(f"  ✓ {condition}_{channel}: {count} frames -> {output_path}")
+                written[output_path] = count
+            else:
+                for path in (tmp_path, output_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                print(f"  - {condition}_{channel}: no frames found")
+    return written
+
+
+def compare(condition, channel, fps=DEFAULT_FPS, storage=None, data_dir=DATA_DIR, limit=None):
+    """Peak traced memory and time of the streaming GIF against a frame list + imageio.mimsave."""
+    import tempfile
+    import tracemalloc
+    import imageio.v2 as imageio
+
+    filenames = ImageSource(storage, data_dir).list(condition, channel)[:limit]
+    if not filenames:
+        print(f"No projections for {condition}/{channel}")
+        return
+    frames = lambda: (render_outline_frame(condition, channel, f, 1, storage, data_dir) for f in filenames)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for name, encode in [('list + mimsave', lambda path: imageio.mimsave(path, list(frames()), fps=fps)),
+                             ('streaming', lambda path: compile_animation(frames(), path, fps))]:
+            path = os.path.join(tmp, name.replace(' ', '') + '.gif')
+            tracemalloc.start()
+            start = time.perf_counter()
+            encode(path)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[name] = (seconds, peak, os.path.getsize(path))
+            with Image.open(path) as gif:
+                decoded = gif.n_frames
+            print(f"  {name:<15} {seconds:6.2f}s  peak {peak / 1e6:8.1f} MB  "
+                  f"file {results[name][2] / 1e6:6.2f} MB  {decoded} frames")
+
+    print(f"\n{len(filenames)} frames: streaming peak memory is "
+          f"{results['list + mimsave'][1] / max(results['streaming'][1], 1):.1f}x lower")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming GIF/MP4/WebM encoder for outline frames")
+    parser.add_argument('command', nargs='?', default='compile', choices=['compile', 'compare'])
+    parser.add_argument('--conditions', nargs='*', help='Conditions (default: all found)')
+    parser.add_argument('--channels', nargs='*', default=CHANNELS, choices=CHANNELS)
+    parser.add_argument('--format', default='gif', choices=FORMATS)
+    parser.add_argument('--fps', type=float, default=DEFAULT_FPS)
+    parser.add_argument('--downsample', type=int, default=1, help='Integer shrink factor')
+    parser.add_argument('--palette', default='outline', choices=PALETTES, help='Global GIF palette')
+    parser.add_argument('--source', default='masks', choices=['masks', 'frames'],
+                        help='Render from projections and masks, or read PNG frames')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--frames-dir', default=GIF_FRAMES_DIR)
+    parser.add_argument('--plots-dir', default=PLOTS_DIR)
+    parser.add_argument('--storage', default=STORAGE, choices=['tiff', 'zarr'])
+    parser.add_argument('--workers', type=int, help='Render processes (default: SMFISH_CORES or all cores)')
+    parser.add_argument('--limit', type=int, help='Frames to use with compare')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        conditions = args.conditions or ImageSource(args.storage, args.data_dir).conditions('CH0')[:1]
+        for condition in conditions:
+            for channel in args.channels:
+                print(f"{condition}/{channel}:")
+                compare(condition, channel, args.fps, args.storage, args.data_dir, args.limit)
+        return
+
+    start = time.perf_counter()
+    written = compile_all(args.conditions, args.channels, args.format, args.fps, args.downsample, args.palette,
+                          args.source, args.storage, args.data_dir, args.frames_dir, args.plots_dir, args.workers)
+    print(f"\n{len(written)} animations, {sum(written.values())} frames in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Process-Pool Batch Preprocessing
+
+Discovers every condition and channel and fans the per-image preprocessing work
+out over a pool of worker processes instead of looping over one file at a time:
+
+    project   raw/<cond>/*.tif            -> processed/<cond>/CH<c>/  (1_data_preprocessing)
+    denoise   processed/<cond>/CH1/*.tif  -> processed/<cond>/CH1_denoised/  (denoising_fish)
+    enhance   processed/<cond>/CH1/*.tif  -> processed/<cond>/CH1_enhanced/  (preprocess_for_training)
+    binarize  processed/<cond>/CH0/*.tif  -> processed/<cond>/CH0_binary/    (binary_nucleus)
+
+With --training, denoise/enhance/binarize run on the curated training folders
+used by the notebooks (data/training/images/fish, .../nucleus) instead.
+
+Output files keep their input name (projections use *_ch<c>_projection.tif), so
+names do not depend on worker count or completion order. A file that fails is
+reported as "FAILED to process" and the rest of the batch carries on. If a
+worker process dies (e.g. OOM-killed), the pool breaks and every image not
+finished yet is reported as failed; the batch still returns normally.
+
+Usage:
+    python batch_preprocess.py project --workers 32
+    python batch_preprocess.py denoise --conditions DMSO JQ1
+    python batch_preprocess.py binarize --training
+    python batch_preprocess.py all --workers 16
+"""
+
+import os
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from incremental import load_units, unit_key, unit_is_current, record_unit, save_units
+from instrumentation import measure, tiff_read, tiff_write
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "data")
+
+DENOISING_STRENGTH_FACTOR = 100.0
+PROJECTION_SIGMA = 1.0
+
+
+# --- Per-image work (top-level so worker processes can unpickle it) ---
+
+def project_image(input_path, output_path, sigma=PROJECTION_SIGMA):
+    """Max-project every channel of a raw stack into <output_path>/CH<c>/."""
+    from projection import project_file
+    project_file(input_path, output_path, sigma=sigma)
+
+
+def denoise_image(input_path, output_path, strength=DENOISING_STRENGTH_FACTOR):
+    """BM3D-denoise a projection (through the shared denoise cache) and save it as uint16."""
+    from denoise_cache import cached_denoise
+
+    # Already one image per core: tiles (if SMFISH_BM3D_TILE is set) run in this worker
+    denoised_image = cached_denoise(tiff_read(input_path), strength, workers=1)
+    tiff_write(output_path, (denoised_image * 65535).astype(np.uint16))
+
+
+def enhance_image(input_path, output_path):
+    """Otsu → dilate → fill → blur, as preprocess_for_training.ipynb does."""
+    from skimage import filters
+    from skimage.morphology import disk, binary_dilation
+    from scipy.ndimage import binary_fill_holes
+
+    img = tiff_read(input_path)
+    binary_spots = img > filters.threshold_otsu(img)
+    dilated_spots = binary_dilation(binary_spots, footprint=disk(5))
+    filled_shape = binary_fill_holes(dilated_spots)
+    tiff_write(output_path, filters.gaussian(filled_shape, sigma=5))
+
+
+def binarize_image(input_path, output_path):
+    """Otsu threshold and hole filling, as binary_nucleus.ipynb does."""
+    from skimage import filters
+    from scipy.ndimage import binary_fill_holes
+
+    img = tiff_read(input_path)
+    filled_image = binary_fill_holes(img > filters.threshold_otsu(img))
+    tiff_write(output_path, filled_image.astype(np.uint8) * 255)
+
+
+# Operation table: worker function, where inputs come from and where outputs go.
+# 'channel'/'suffix' describe the per-condition layout, 'training' the notebook folders.
+OPERATIONS = {
+    'project': {
+        'function': project_image,
+        'params': {'sigma': PROJECTION_SIGMA},
+    },
+    'denoise': {
+        'function': denoise_image,
+        'params': {'strength': DENOISING_STRENGTH_FACTOR},
+        'channel': 'CH1', 'suffix': '_denoised',
+        'training': ('fish', 'fish_denoised', '_projection.tif'),
+    },
+    'enhance': {
+        'function': enhance_image,
+        'params': {},
+        'channel': 'CH1', 'suffix': '_enhanced',
+        'training': ('fish', 'fish_enhanced', '_projection.tif'),
+    },
+    'binarize': {
+        'function': binarize_image,
+        'params': {},
+        'channel': 'CH0', 'suffix': '_binary',
+        'training': ('nucleus', 'nucleus_binary', '.tif'),
+    },
+}
+
+
+def list_images(folder, suffix=('.tif', '.tiff')):
+    """Sorted image file names in a folder (empty if the folder does not exist)."""
+    if not os.path.isdir(folder):
+        return []
+    return sorted(f for f in os.listdir(folder) if f.endswith(suffix))
+
+
+def discover_conditions(folder):
+    """Condition sub-folders (DMSO, JQ1, TSA, ...) of a data folder."""
+    if not os.path.isdir(folder):
+        return []
+    return sorted(d for d in os.listdir(folder) if os.path.isdir(os.path.join(folder, d)))
+
+
+def discover_tasks(operation, data_dir=DATA_DIR, conditions=None, training=False):
+    """
+    List the (input_path, output_path) pairs for an operation.
+
+    Projection outputs are condition folders (one CH<c> sub-folder per channel);
+    every other operation maps one image to one image with the same name.
+    """
+    spec = OPERATIONS[operation]
+    tasks = []
+
+    if operation == 'project':
+        raw_dir = os.path.join(data_dir, "raw")
+        for condition in conditions or discover_conditions(raw_dir):
+            for filename in list_images(os.path.join(raw_dir, condition)):
+                tasks.append((os.path.join(raw_dir, condition, filename),
+                              os.path.join(data_dir, "processed", condition)))
+        return tasks
+
+    if training:
+        source, target, suffix = spec['training']
+        input_dir = os.path.join(data_dir, "training", "images", source)
+        output_dir = os.path.join(data_dir, "training", "images", target)
+        return [(os.path.join(input_dir, f), os.path.join(output_dir, f)) for f in list_images(input_dir, suffix)]
+
+    processed_dir = os.path.join(data_dir, "processed")
+    for condition in conditions or discover_conditions(processed_dir):
+        input_dir = os.path.join(processed_dir, condition, spec['channel'])
+        output_dir = os.path.join(processed_dir, condition, spec['channel'] + spec['suffix'])
+        for filename in list_images(input_dir):
+            tasks.append((os.path.join(input_dir, filename), os.path.join(output_dir, filename)))
+    return tasks
+
+
+def run_task(operation, input_path, output_path, params):
+    """Worker entry point: process one image and return the error text (None on success)."""
+    try:
+        if operation != 'project':
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with measure(operation, image=os.path.basename(input_path)):
+            OPERATIONS[operation]['function'](input_path, output_path, **params)
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def _limit_worker_threads():
+    """Keep each worker's BLAS/OpenMP pools to one thread so N workers use N cores."""
+    # Environment covers libraries first loaded in the worker, threadpoolctl those already loaded
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = '1'
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError:
+        pass
+
+
+def run_batch(operation, tasks, workers=None, params=None, ledger=None):
+    """
+    Run `tasks` for an operation over a process pool.
+
+    With a `ledger` name, images whose input and parameters are unchanged since
+    the last successful run are skipped (see incremental.py).
+    Returns {input_path: error_text} for the files that failed.
+    """
+    params = dict(OPERATIONS[operation]['params'], **(params or {}))
+    workers = workers or os.cpu_count()
+
+    units = load_units(ledger) if ledger else {}
+    pending = []
+    for input_path, output_path in tasks:
+        key = unit_key(input_path, code=('batch_preprocess',), operation=operation, **params) if ledger else None
+        if ledger and unit_is_current(units, input_path, key, output_path):
+            continue
+        pending.append((input_path, output_path, key))
+
+    skipped = len(tasks) - len(pending)
+    print(f"--- {operation}: {len(pending)} images on {workers} workers"
+          + (f" ({skipped} unchanged, skipped)" if skipped else "") + " ---")
+
+    failures = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_limit_worker_threads) as executor:
+        futures = []
+        submit_error = None
+        for input_path, output_path, _ in pending:
+            try:
+                futures.append(executor.submit(run_task, operation, input_path, output_path, params))
+            except Exception as e:
+                # The pool broke while submitting (a worker died); the rest cannot run
+                submit_error = f"{type(e).__name__}: {e}"
+                break
+        # Collected in submission order, so the log is identical from run to run
+        for index, (input_path, output_path, key) in enumerate(pending):
+            filename = os.path.basename(input_path)
+            if index >= len(futures):
+                error = submit_error
+            else:
+                try:
+                    error = futures[index].result()
+                except Exception as e:
+                    # A crashed worker (BrokenProcessPool) fails every image still in the pool
+                    error = f"{type(e).__name__}: {e}"
+            if error is None:
+                print(f"  - Processed: {filename}")
+                if ledger:
+                    record_unit(units, input_path, key)
+            else:
+                print(f"  - FAILED to process {filename}: {error}")
+                failures[input_path] = error
+
+    if ledger:
+        save_units(ledger, units)
+    print(f"--- {operation} complete: {len(pending) - len(failures)} succeeded, {len(failures)} failed ---")
+    return failures
+
+
+def run_operation(operation, workers=None, data_dir=DATA_DIR, conditions=None, training=False,
+                  params=None, incremental=False):
+    """Discover and run every image of one operation."""
+    tasks = discover_tasks(operation, data_dir, conditions, training)
+    ledger = f"batch_{operation}{'_training' if training else ''}" if incremental else None
+    return run_batch(operation, tasks, workers=workers, params=params, ledger=ledger)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Batch preprocessing over all conditions with a process pool",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('operation', choices=list(OPERATIONS) + ['all'],
+                        help="Operation to run ('all' runs them in pipeline order)")
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: all cores)')
+    parser.add_argument('--data-dir', default=DATA_DIR, help='Root of raw/, processed/ and training/')
+    parser.add_argument('--conditions', nargs='*', help='Conditions to process (default: all found)')
+    parser.add_argument('--training', action='store_true',
+                        help='Use the curated training folders instead of processed/<condition>')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Skip images whose input and parameters are unchanged')
+    args = parser.parse_args()
+
+    operations = list(OPERATIONS) if args.operation == 'all' else [args.operation]
+    failed = 0
+    for operation in operations:
+        failures = run_operation(operation, args.workers, args.data_dir, args.conditions,
+                                 args.training, incremental=args.incremental)
+        failed += len(failures)
+
+    if failed:
+        print(f"\n✗ {failed} files failed")
+    else:
+        print("\n✓ Batch preprocessing complete")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+End-to-End Throughput Benchmark
+
+Generates synthetic datasets (synthetic_data.py) of increasing size and runs
+the pipeline stages on each one, CPU-only and without network access:
+
+    projection      batch_preprocess 'project'  raw stacks -> CH0/CH1 projections
+    denoising       batch_preprocess 'denoise'  BM3D on CH1, with an empty denoise cache
+    segmentation    Cellpose nucleus and cell passes (segmentation_service.run_pass)
+                    when cellpose and the cell model are available; otherwise the
+                    ground-truth masks are written in their place and the row is
+                    marked 'truth'
+    blob_detection  DoG + blob_log (or the fast detector) and per-cell counts, as
+                    8_blob_detection.ipynb does, over a process pool
+    stats           stats_engine.compare_conditions on the per-image counts
+
+Every size is run once for each worker count. Detected spots are matched
+one-to-one to the ground-truth spots within MATCH_TOLERANCE pixels (see
+spot_detection.match_spots) to give recall, precision and F1 per image,
+together with the same scores for nascent sites.
+
+Output in results/benchmarks/<run id>/:
+
+    throughput.csv   stage, images, workers, seconds, images/s, megapixels/s
+    accuracy.csv     per-image spot and nascent-site recall/precision
+    scaling.png      images/s per stage against dataset size, one line per worker count
+
+Usage:
+    python benchmark_suite.py                                  # 2, 4 and 8 images per condition
+    python benchmark_suite.py --sizes 4 16 64 --workers 1 4 16 --image-size 1024
+    python benchmark_suite.py --stages projection blob_detection stats --detector fast
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import tifffile
+
+from synthetic_data import generate_dataset, load_truth, truth_masks, write_truth_masks, CONDITIONS, DEFAULTS
+from spot_detection import (normalize_image, match_spots, detect_spots, SIGMA_LIGHT_BLUR, SIGMA_HEAVY_BLUR,
+                            BLOB_MIN_SIGMA, BLOB_MAX_SIGMA, BLOB_THRESHOLD, FAST_SPOT_SIGMAS)
+from cell_quantification import (quantify_cells, image_compartment_counts, spot_pixels, NASCENT_SIZE_THRESHOLD,
+                                 NASCENT_INTENSITY_THRESHOLD)
+from projection import projection_filename
+from batch_preprocess import run_operation
+from stats_engine import compare_conditions
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS_DIR = os.path.join(BASE_DIR, "results", "benchmarks")
+
+STAGES = ['projection', 'denoising', 'segmentation', 'blob_detection', 'stats']
+DEFAULT_SIZES = [2, 4, 8]
+# Pixels between a detected and a true spot for them to count as the same spot
+MATCH_TOLERANCE = 2.0
+STATS_METRICS = ['total_count', 'nascent_count']
+STATS_RESAMPLES = 2000
+
+THROUGHPUT_COLUMNS = ['stage', 'mode', 'images_per_condition', 'images', 'workers', 'seconds', 'images_per_s',
+                      'megapixels_per_s', 'failed']
+ACCURACY_COLUMNS = ['images_per_condition', 'workers', 'condition', 'image', 'true_spots', 'detected_spots',
+                    'matched_spots', 'recall', 'precision', 'f1', 'true_nascent', 'detected_nascent',
+                    'matched_nascent', 'nascent_recall', 'nascent_precision']
+
+
+def cellpose_available():
+    """True when Cellpose can be imported and the fine-tuned cell model is on disk."""
+    from segmentation_service import CELL_MODEL_PATH
+    return importlib.util.find_spec('cellpose') is not None and os.path.exists(CELL_MODEL_PATH)
+
+
+def detect_image(condition, filename, data_dir, detector='blob_log'):
+    """
+    Worker entry point: the 8_blob_detection.ipynb steps for one CH1 projection.
+
+    Returns (detailed-count row, blobs, nascent flags).
+    """
+    from skimage import filters
+    from skimage.feature import blob_log
+
+    processed = os.path.join(data_dir, "processed", condition)
+    masks = os.path.join(data_dir, "final_masks", condition)
+    fish_image = tifffile.imread(os.path.join(processed, "CH1", filename))
+    cell_mask = tifffile.imread(os.path.join(masks, "CH1_masks", filename))
+    nuc_mask = tifffile.imread(os.path.join(masks, "CH0_masks", filename.replace('_ch1_', '_ch0_')))
+
+    fish_image_float = normalize_image(fish_image)
+    dog_image = (filters.gaussian(fish_image_float, sigma=SIGMA_LIGHT_BLUR)
+                 - filters.gaussian(fish_image_float, sigma=SIGMA_HEAVY_BLUR))
+    if detector == 'fast':
+        blobs = detect_spots(dog_image, FAST_SPOT_SIGMAS, BLOB_THRESHOLD)
+    else:
+        blobs = blob_log(dog_image, min_sigma=BLOB_MIN_SIGMA, max_sigma=BLOB_MAX_SIGMA, threshold=BLOB_THRESHOLD)
+    blobs = np.asarray(blobs, dtype=np.float64).reshape(-1, 3)
+
+    cells = quantify_cells(blobs, fish_image_float, cell_mask, nuc_mask)
+    blob_y, blob_x = spot_pixels(blobs, fish_image_float.shape)
+    is_nascent = (blobs[:, 2] > NASCENT_SIZE_THRESHOLD) & (fish_image_float[blob_y, blob_x] > NASCENT_INTENSITY_THRESHOLD)
+    row = {'condition': condition, 'image': filename, 'total_count': len(blobs),
+           'nascent_count': int(is_nascent.sum()), 'single_molecule_count': int(len(blobs) - is_nascent.sum()),
+           'avg_intensity': float(fish_image_float[blob_y, blob_x].mean()) if len(blobs) else 0.0}
+    row.update(image_compartment_counts(cells))
+    return row, blobs, is_nascent
+
+
+def _scores(truth, detected, tolerance):
+    matched = match_spots(truth, detected, tolerance)
+    recall = matched / len(truth) if len(truth) else np.nan
+    precision = matched / len(detected) if len(detected) else np.nan
+    return matched, recall, precision
+
+
+def spot_accuracy(truth, blobs, is_nascent, tolerance=MATCH_TOLERANCE):
+    """Recall/precision of the detected spots, and of the nascent sites, against one image's truth."""
+    true_yx = truth[['y', 'x']].to_numpy(dtype=np.float64)
+    true_nascent = truth.loc[truth['nascent'].astype(bool), ['y', 'x']].to_numpy(dtype=np.float64)
+    matched, recall, precision = _scores(true_yx, blobs, tolerance)
+    matched_nascent, nascent_recall, nascent_precision = _scores(true_nascent, blobs[is_nascent], tolerance)
+    f1 = 2 * matched / (len(true_yx) + len(blobs)) if len(true_yx) + len(blobs) else np.nan
+    return {'true_spots': len(true_yx), 'detected_spots': len(blobs), 'matched_spots': matched,
+            'recall': recall, 'precision': precision, 'f1': f1,
+            'true_nascent': len(true_nascent), 'detected_nascent': int(is_nascent.sum()),
+            'matched_nascent': matched_nascent, 'nascent_recall': nascent_recall,
+            'nascent_precision': nascent_precision}
+
+
+class StageTimer:
+    """Collects one throughput row per timed stage."""
+
+    def __init__(self, images_per_condition, images, workers, megapixels):
+        self.context = {'images_per_condition': images_per_condition, 'images': images, 'workers': workers}
+        self.megapixels = megapixels
+        self.rows = []
+
+    def run(self, stage, function, mode='', *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        failed = len(result) if isinstance(result, dict) else 0
+        images = self.context['images']
+        self.rows.append(dict(self.context, stage=stage, mode=mode, seconds=seconds,
+                              images_per_s=images / seconds if seconds else np.nan,
+                              megapixels_per_s=self.megapixels[stage] / seconds if seconds else np.nan,
+                              failed=failed))
+        print(f"  ✓ {stage}{f' ({mode})' if mode else ''}: {images} images in {seconds:.2f}s "
+              f"({images / max(seconds, 1e-9):.2f} images/s)" + (f", {failed} failed" if failed else ""))
+        return result
+
+
+def run_segmentation(data_dir, conditions, workers, mode):
+    """Cellpose nucleus and cell passes, or the ground truth written as final masks."""
+    if mode == 'cellpose':
+        from segmentation_service import SegmentationService, run_pass
+        service = SegmentationService(gpu=False, threads=workers)
+        failures = {}
+        for pass_name in ('nucleus', 'cell'):
+            failures.update(run_pass(service, pass_name, conditions, os.path.join(data_dir, "processed"),
+                                     os.path.join(data_dir, "final_masks"), incremental=False))
+        return failures
+
+    for condition in conditions:
+        for filename in sorted(os.listdir(os.path.join(data_dir, "raw", condition))):
+            write_truth_masks(data_dir, condition, filename, *truth_masks(data_dir, condition, filename))
+    return {}
+
+
+def run_blob_detection(data_dir, conditions, workers, detector, images_per_condition):
+    """Detect and count every image over a process pool and score it against the truth."""
+    truth = load_truth(data_dir)
+    tasks = [(condition, filename) for condition in conditions
+             for filename in sorted(os.listdir(os.path.join(data_dir, "raw", condition)))]
+    detailed, accuracy, failures = [], [], {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(detect_image, condition, projection_filename(filename, 1), data_dir, detector)
+                   for condition, filename in tasks]
+        for (condition, filename), future in zip(tasks, futures):
+            try:
+                row, blobs, is_nascent = future.result()
+            except Exception as e:
+                print(f"  - FAILED to process {filename}: {e}")
+                failures[filename] = str(e)
+                continue
+            detailed.append(row)
+            image_truth = truth[(truth['condition'] == condition) & (truth['image'] == filename)]
+            accuracy.append(dict({'images_per_condition': images_per_condition, 'workers': workers,
+                                  'condition': condition, 'image': filename},
+                                 **spot_accuracy(image_truth, blobs, is_nascent)))
+    return detailed, accuracy, failures
+
+
+def run_stats(detailed, conditions, workers, resamples):
+    """stats_engine tests on the per-image counts (needs at least two conditions with data)."""
+    df = pd.DataFrame(detailed)
+    present = [c for c in conditions if c in set(df.get('condition', []))]
+    if len(present) < 2:
+        return pd.DataFrame()
+    return compare_conditions(df, STATS_METRICS, conditions=present, n_permutations=resamples,
+                              n_bootstrap=resamples, workers=workers)
+
+
+def run_size(work_dir, images_per_condition, workers, args):
+    """Generate one dataset and time every requested stage on it; returns (throughput rows, accuracy rows)."""
+    data_dir = os.path.join(work_dir, f"n{images_per_condition}_w{workers}")
+    params = {'size': args.image_size, 'z': args.z, 'noise': args.noise}
+    print(f"\n=== {images_per_condition} images per condition, {workers} workers ===")
+    start = time.perf_counter()
+    generate_dataset(data_dir, args.conditions, images_per_condition, args.seed, **params)
+    print(f"  Dataset generated in {time.perf_counter() - start:.1f}s")
+
+    images = images_per_condition * len(args.conditions)
+    plane = args.image_size * args.image_size / 1e6
+    megapixels = {'projection': images * plane * args.z * 2, 'denoising': images * plane,
+                  'segmentation': images * plane * 2, 'blob_detection': images * plane, 'stats': np.nan}
+    timer = StageTimer(images_per_condition, images, workers, megapixels)
+
+    timer.run('projection', run_operation, '', 'project', workers, data_dir, args.conditions)
+
+    if 'denoising' in args.stages:
+        # A fresh cache, so every image is denoised and none is read back from an earlier size
+        import denoise_cache
+        cache_dir = os.path.join(data_dir, "denoise_cache")
+        os.environ['SMFISH_DENOISE_CACHE'] = denoise_cache.CACHE_DIR = cache_dir
+        timer.run('denoising', run_operation, 'bm3d', 'denoise', workers, data_dir, args.conditions)
+
+    accuracy = []
+    if {'segmentation', 'blob_detection', 'stats'} & set(args.stages):
+        mode = args.segmentation
+        if mode == 'auto':
+            mode = 'cellpose' if cellpose_available() else 'truth'
+        timer.run('segmentation', run_segmentation, mode, data_dir, args.conditions, workers, mode)
+
+        detailed, accuracy, _ = timer.run('blob_detection', run_blob_detection, args.detector, data_dir,
+                                          args.conditions, workers, args.detector, images_per_condition)
+        timer.rows[-1]['failed'] = images - len(detailed)
+        if accuracy:
+            scores = pd.DataFrame(accuracy)
+            matched, true, detected = (scores[c].sum() for c in ('matched_spots', 'true_spots', 'detected_spots'))
+            print(f"    spots: recall {matched / max(true, 1):.3f}, precision {matched / max(detected, 1):.3f} "
+                  f"({matched}/{true} true, {detected} detected)")
+
+        if 'stats' in args.stages:
+            timer.run('stats', run_stats, '', detailed, args.conditions, workers, args.resamples)
+
+    rows = [row for row in timer.rows if row['stage'] in args.stages]
+    return rows, accuracy
+
+
+def plot_scaling(throughput, path):
+    """images/s against dataset size for every stage, one line per worker count."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    stages = [s for s in STAGES if s in set(throughput['stage'])]
+    fig, axes = plt.subplots(1, len(stages), figsize=(4 * len(stages), 3.5), squeeze=False)
+    for ax, stage in zip(axes[0], stages):
+        rows = throughput[throughput['stage'] == stage]
+        for workers, group in rows.groupby('workers'):
+            group = group.sort_values('images')
+            ax.plot(group['images'], group['images_per_s'], marker='o', label=f"{workers} workers")
+        ax.set_title(stage)
+        ax.set_xscale('log', base=2)
+        ax.set_xlabel('images')
+        ax.set_ylabel('images/s')
+        ax.grid(True, alpha=0.3)
+        ax.legend(fontsize=8)
+    fig.tight_layout()
+    fig.savefig(path, dpi=120)
+    plt.close(fig)
+
+
+def summarize(throughput, accuracy):
+    """Throughput per stage and size, and detection scores per size."""
+    print("\n--- Throughput (images/s) ---")
+    print(throughput.pivot_table(index=['stage', 'workers'], columns='images', values='images_per_s',
+                                 sort=False).round(2).to_string())
+    if not accuracy.empty:
+        print("\n--- Spot detection against ground truth ---")
+        totals = accuracy.groupby(['images_per_condition', 'workers'])[
+            ['true_spots', 'detected_spots', 'matched_spots', 'true_nascent', 'detected_nascent',
+             'matched_nascent']].sum()
+        totals['recall'] = totals['matched_spots'] / totals['true_spots']
+        totals['precision'] = totals['matched_spots'] / totals['detected_spots']
+        totals['nascent_recall'] = totals['matched_nascent'] / totals['true_nascent']
+        totals['nascent_precision'] = totals['matched_nascent'] / totals['detected_nascent']
+        print(totals[['true_spots', 'detected_spots', 'recall', 'precision', 'nascent_recall',
+                      'nascent_precision']].round(3).to_string())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic end-to-end throughput and accuracy benchmark")
+    parser.add_argument('--sizes', nargs='*', type=int, default=DEFAULT_SIZES, help='Images per condition')
+    parser.add_argument('--workers', nargs='*', type=int, help='Worker counts (default: SMFISH_CORES or all cores)')
+    parser.add_argument('--stages', nargs='*', default=STAGES, choices=STAGES)
+    parser.add_argument('--conditions', nargs='*', default=CONDITIONS)
+    parser.add_argument('--image-size', type=int, default=DEFAULTS['size'])
+    parser.add_argument('--z', type=int, default=DEFAULTS['z'])
+    parser.add_argument('--noise', type=float, default=DEFAULTS['noise'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--segmentation', default='auto', choices=['auto', 'cellpose', 'truth'],
+                        help="'auto' uses Cellpose when it and the cell model are installed")
+    parser.add_argument('--detector', default='blob_log', choices=['blob_log', 'fast'])
+    parser.add_argument('--resamples', type=int, default=STATS_RESAMPLES, help='Permutations and bootstrap samples')
+    parser.add_argument('--work-dir', help='Where datasets are generated (default: a temporary folder)')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated datasets')
+    parser.add_argument('--output-dir', help='Default: results/benchmarks/<run id>')
+    args = parser.parse_args()
+
+    if args.segmentation == 'cellpose' and not cellpose_available():
+        parser.error("Cellpose or the cell model (models/smfish_cell_model_cpsam) is not available")
+    worker_counts = args.workers or [int(os.environ.get("SMFISH_CORES", os.cpu_count()))]
+    from results_store import new_run_id
+    output_dir = args.output_dir or os.path.join(BENCHMARKS_DIR, new_run_id())
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="smfish_benchmark_")
+    os.makedirs(output_dir, exist_ok=True)
+
+    throughput, accuracy = [], []
+    try:
+        for images_per_condition in args.sizes:
+            for workers in worker_counts:
+                rows, scores = run_size(work_dir, images_per_condition, workers, args)
+                throughput.extend(rows)
+                accuracy.extend(scores)
+                if not args.keep:
+                    shutil.rmtree(os.path.join(work_dir, f"n{images_per_condition}_w{workers}"), ignore_errors=True)
+    finally:
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    throughput = pd.DataFrame(throughput, columns=THROUGHPUT_COLUMNS)
+    accuracy = pd.DataFrame(accuracy, columns=ACCURACY_COLUMNS)
+    throughput.to_csv(os.path.join(output_dir, "throughput.csv"), index=False)
+    accuracy.to_csv(os.path.join(output_dir, "accuracy.csv"), index=False)
+    if not throughput.empty:
+        plot_scaling(throughput, os.path.join(output_dir, "scaling.png"))
+    summarize(throughput, accuracy)
+    print(f"\nBenchmark saved to: {output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Cached Scale-Space Sweeps of the Blob-Detection Parameters
+
+Tuning BLOB_THRESHOLD, BLOB_MIN_SIGMA, NASCENT_SIZE_THRESHOLD and
+NASCENT_INTENSITY_THRESHOLD in 8_blob_detection.ipynb by rerunning the
+notebook repeats the Gaussian/DoG filtering and the full `blob_log` for
+every image and every value. Most of that work does not depend on the
+parameters being tuned:
+
+- The DoG image depends only on the image.
+- The LoG scale space and its 3x3x3 local maxima depend only on
+  min_sigma/max_sigma. `blob_log` keeps the maxima whose response is above
+  the threshold, ordered by response.
+
+For each image and each (min_sigma, max_sigma), the DoG image and the peak
+candidates above the lowest threshold of the grid are computed once. The
+candidates are kept with their pixel intensity and cell/nucleus labels. A
+threshold is then a filter over the candidates followed by blob_log's own
+overlap pruning. Every nascent size/intensity cut-off is one vectorized
+comparison over the surviving spots. The results match `blob_log` on the
+notebook's DoG image exactly (`check` verifies this).
+
+DoG images and candidate sets are kept in a least-recently-used cache bounded
+by SMFISH_SWEEP_CACHE_MB (default 2048). Repeated sweeps in one process, e.g.
+from a notebook with workers=1, start from the cached candidates.
+
+Output in results/tables/:
+
+    blob_sweep_counts.csv    one row per image and parameter combination, with the
+                             detailed_counts columns of 8_blob_detection.ipynb
+    blob_sweep_summary.csv   per combination and condition: images and mean counts
+
+Usage:
+    python blob_sweep.py                                       # default 10 x 3 x 3 grid
+    python blob_sweep.py --thresholds 0.06 0.08 0.1 --min-sigmas 0.2 0.5 --nascent-sizes 1.5 --conditions DMSO
+    python blob_sweep.py --nascent-intensities 0.05 0.1 0.15 --max-sigmas 2 3
+    python blob_sweep.py check --limit 3                       # against blob_log for a few grid points
+"""
+
+import os
+import time
+import argparse
+import itertools
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+from spot_detection import SIGMA_LIGHT_BLUR, SIGMA_HEAVY_BLUR, BLOB_MIN_SIGMA, BLOB_MAX_SIGMA
+from cell_quantification import NASCENT_SIZE_THRESHOLD, NASCENT_INTENSITY_THRESHOLD
+from zarr_store import ImageSource, DATA_DIR, STORAGE
+from instrumentation import measure
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TABLES_DIR = os.path.join(BASE_DIR, "results", "tables")
+CONDITIONS = ["DMSO", "JQ1", "TSA"]
+
+MAX_CACHE_BYTES = int(float(os.environ.get('SMFISH_SWEEP_CACHE_MB', 2048)) * 1e6)
+# blob_log defaults used by the notebook
+NUM_SIGMA = 10
+OVERLAP = 0.5
+
+DEFAULT_GRID = {
+    'threshold': tuple(np.round(np.arange(0.04, 0.135, 0.01), 3)),
+    'min_sigma': (BLOB_MIN_SIGMA,),
+    'max_sigma': (BLOB_MAX_SIGMA,),
+    'nascent_size': (1.2, NASCENT_SIZE_THRESHOLD, 1.8),
+    'nascent_intensity': (0.05, NASCENT_INTENSITY_THRESHOLD, 0.15),
+}
+PARAMETERS = list(DEFAULT_GRID)
+# Command-line option of each grid parameter
+GRID_FLAGS = {
+    'threshold': '--thresholds',
+    'min_sigma': '--min-sigmas',
+    'max_sigma': '--max-sigmas',
+    'nascent_size': '--nascent-sizes',
+    'nascent_intensity': '--nascent-intensities',
+}
+COUNT_COLUMNS = ['total_count', 'nascent_count', 'single_molecule_count', 'avg_intensity', 'nucleus_count',
+                 'cytoplasm_count']
+
+
+class ScaleSpaceCache:
+    """Least-recently-used values bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        return None
+
+    def put(self, key, value, nbytes):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (value, nbytes)
+        self.bytes += nbytes
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.bytes -= size
+
+
+# One cache per process: worker processes keep theirs for the lifetime of the pool
+_cache = ScaleSpaceCache()
+
+
+def notebook_dog(fish_image):
+    """(fish_image_float, dog_image) exactly as 8_blob_detection.ipynb computes them."""
+    from skimage import filters
+    fish_image_float = (fish_image - fish_image.min()) / (fish_image.max() - fish_image.min())
+    dog_image = filters.gaussian(fish_image_float, sigma=SIGMA_LIGHT_BLUR) - filters.gaussian(fish_image_float, sigma=SIGMA_HEAVY_BLUR)
+    return fish_image_float, dog_image
+
+
+def sigma_list(dtype, min_sigma, max_sigma, num_sigma=NUM_SIGMA):
+    """The (num_sigma, 2) scales blob_log uses for scalar min/max sigma on a 2D image."""
+    return np.linspace(np.full(2, min_sigma, dtype=dtype), np.full(2, max_sigma, dtype=dtype), num_sigma)
+
+
+def peak_candidates(dog_image, min_sigma, max_sigma, floor, num_sigma=NUM_SIGMA):
+    """
+    Scale-space maxima of `dog_image` with a response above `floor`.
+
+    These are the voxels blob_log's `peak_local_max` returns, in the same
+    order (highest response first), for any threshold >= `floor`. Returns a
+    dict of arrays y, x, scale, sigma, response and the scales (`sigmas`).
+    """
+    image = np.asarray(dog_image)
+    if image.dtype.kind != 'f':
+        raise ValueError("The DoG image must be floating point")
+    sigmas = sigma_list(image.dtype, min_sigma, max_sigma, num_sigma)
+    cube = np.empty(image.shape + (len(sigmas),), dtype=image.dtype)
+    for i, s in enumerate(sigmas):
+        cube[..., i] = -ndimage.gaussian_laplace(image, s) * np.mean(s) ** 2
+
+    peaks = cube == ndimage.maximum_filter(cube, footprint=np.ones((3, 3, 3)), mode='nearest')
+    if peaks.all():
+        # peak_local_max returns nothing for a constant image
+        peaks[:] = False
+    peaks &= cube > floor
+    y, x, scale = np.nonzero(peaks)
+    response = cube[y, x, scale]
+    order = np.argsort(-response, kind='stable')
+    return {'y': y[order], 'x': x[order], 'scale': scale[order], 'sigma': sigmas[scale[order], 0],
+            'response': response[order], 'sigmas': sigmas[:, 0], 'shape': image.shape + (len(sigmas),),
+            'floor': floor}
+
+
+def prune(candidates, threshold, overlap=OVERLAP):
+    """Indices into `candidates` of the spots blob_log keeps at `threshold`."""
+    from skimage.feature.blob import _prune_blobs
+
+    index = np.flatnonzero(candidates['response'] > threshold)
+    if len(index) == 0:
+        return index
+    lm = np.column_stack([candidates['y'][index], candidates['x'][index], candidates['sigma'][index]])
+    kept = _prune_blobs(lm.astype(candidates['sigma'].dtype), overlap, sigma_dim=1)
+    if len(kept) == len(index):
+        return index
+    # Pruning keeps rows in order; (y, x, scale) identifies a candidate
+    _, width, n_scales = candidates['shape']
+    keys = (candidates['y'][index] * width + candidates['x'][index]) * n_scales + candidates['scale'][index]
+    kept_scales = np.searchsorted(candidates['sigmas'], kept[:, 2])
+    kept_keys = (kept[:, 0].astype(np.int64) * width + kept[:, 1].astype(np.int64)) * n_scales + kept_scales
+    return index[np.isin(keys, kept_keys)]
+
+
+def image_candidates(key, fish_image, cell_mask, nuc_mask, min_sigma, max_sigma, floor, cache=None):
+    """Candidates of one image with their intensity and compartment, from the cache when possible."""
+    cache = cache or _cache
+    entry_key = (key, float(min_sigma), float(max_sigma))
+    candidates = cache.get(entry_key)
+    if candidates is not None and candidates['floor'] <= floor:
+        return candidates
+
+    dog = cache.get((key, 'dog'))
+    if dog is None:
+        dog = notebook_dog(fish_image)
+        cache.put((key, 'dog'), dog, dog[0].nbytes + dog[1].nbytes)
+    fish_image_float, dog_image = dog
+    with measure('blob_sweep_scale_space', image=key[-1], min_sigma=min_sigma):
+        candidates = peak_candidates(dog_image, min_sigma, max_sigma, floor)
+    y, x = candidates['y'], candidates['x']
+    candidates['intensity'] = fish_image_float[y, x].astype(np.float64)
+    if cell_mask is not None and nuc_mask is not None:
+        in_cell = cell_mask[y, x] > 0
+        candidates['nucleus'] = in_cell & (nuc_mask[y, x] > 0)
+        candidates['cytoplasm'] = in_cell & ~candidates['nucleus']
+    cache.put(entry_key, candidates, sum(v.nbytes for v in candidates.values() if isinstance(v, np.ndarray)))
+    return candidates
+
+
+def sweep_counts(candidates, grid):
+    """Count rows (parameters + COUNT_COLUMNS) for every combination of `grid` on one image's candidates."""
+    sizes = np.asarray(grid['nascent_size'], dtype=np.float64)
+    intensities = np.asarray(grid['nascent_intensity'], dtype=np.float64)
+    rows = []
+    for threshold in grid['threshold']:
+        kept = prune(candidates, threshold)
+        sigma, intensity = candidates['sigma'][kept], candidates['intensity'][kept]
+        # (sizes, intensities) nascent counts in one broadcast comparison
+        nascent = ((sigma[None, None, :] > sizes[:, None, None])
+                   & (intensity[None, None, :] > intensities[None, :, None])).sum(axis=2)
+        compartments = {}
+        if 'nucleus' in candidates:
+            compartments = {'nucleus_count': int(candidates['nucleus'][kept].sum()),
+                            'cytoplasm_count': int(candidates['cytoplasm'][kept].sum())}
+        avg_intensity = float(np.mean(intensity)) if len(kept) else 0.0
+        for (i, size), (j, cutoff) in itertools.product(enumerate(sizes), enumerate(intensities)):
+            row = {'threshold': threshold, 'nascent_size': size, 'nascent_intensity': cutoff,
+                   'total_count': len(kept), 'nascent_count': int(nascent[i, j]),
+                   'single_molecule_count': int(len(kept) - nascent[i, j]), 'avg_intensity': avg_intensity}
+            row.update(compartments)
+            rows.append(row)
+    return rows
+
+
+def sweep_image(condition, filename, grid, storage=None, data_dir=DATA_DIR):
+    """Worker entry point: count rows of one image for the whole grid, or the error text."""
+    try:
+        source = ImageSource(storage, data_dir)
+        fish_image = source.read(condition, "CH1", filename)
+        cell_mask = nuc_mask = None
+        if source.exists(condition, "CH0_masks"):
+            cell_mask = source.read(condition, "CH1_masks", filename)
+            nuc_mask = source.read(condition, "CH0_masks", filename.replace('_ch1_', '_ch0_'))
+        floor = min(grid['threshold'])
+        rows = []
+        for min_sigma, max_sigma in itertools.product(grid['min_sigma'], grid['max_sigma']):
+            candidates = image_candidates((condition, filename), fish_image, cell_mask, nuc_mask, min_sigma,
+                                          max_sigma, floor)
+            for row in sweep_counts(candidates, grid):
+                rows.append(dict({'condition': condition, 'image': filename, 'min_sigma': min_sigma,
+                                  'max_sigma': max_sigma}, **row))
+        return rows
+    except Exception as e:
+        return str(e)
+
+
+def sweep(conditions=CONDITIONS, grid=None, storage=None, data_dir=DATA_DIR, workers=None, limit=None):
+    """
+    Count table for every image (with CH1 masks) and every parameter combination.
+
+    With workers=1 the images are swept in this process, so the cache carries
+    over to the next call.
+    """
+    grid = dict(DEFAULT_GRID, **(grid or {}))
+    workers = workers or int(os.environ.get("SMFISH_CORES", os.cpu_count()))
+    source = ImageSource(storage, data_dir)
+    tasks = [(condition, filename) for condition in conditions if source.exists(condition, "CH1_masks")
+             for filename in source.list(condition, "CH1_masks")][:limit]
+
+    rows = []
+    if workers == 1:
+        results = (sweep_image(*task, grid, storage, data_dir) for task in tasks)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers,
+                                       mp_context=multiprocessing.get_context('spawn'))
+        results = executor.map(sweep_image, *zip(*tasks), [grid] * len(tasks), [storage] * len(tasks),
+                               [data_dir] * len(tasks)) if tasks else []
+    try:
+        for (condition, filename), result in zip(tasks, results):
+            if isinstance(result, str):
+                print(f"  - FAILED to process {filename}: {result}")
+                continue
+            rows.extend(result)
+    finally:
+        if workers != 1:
+            executor.shutdown()
+    columns = ['condition', 'image'] + PARAMETERS + COUNT_COLUMNS
+    return pd.DataFrame(rows, columns=columns)
+
+
+def summarize(counts):
+    """Per parameter combination and condition: number of images and mean counts per image."""
+    return (counts.groupby(PARAMETERS + ['condition'], sort=True)
+            .agg(images=('image', 'size'), **{f"mean_{c}": (c, 'mean') for c in COUNT_COLUMNS})
+            .reset_index())
+
+
+def notebook_counts(fish_image, cell_mask, nuc_mask, threshold, min_sigma, max_sigma, nascent_size,
+                    nascent_intensity):
+    """Counts from the notebook's own steps (blob_log and quantify_cells) for one combination."""
+    from skimage.feature import blob_log
+    from cell_quantification import quantify_cells, image_compartment_counts
+
+    fish_image_float, dog_image = notebook_dog(fish_image)
+    blobs = blob_log(dog_image, min_sigma=min_sigma, max_sigma=max_sigma, threshold=threshold)
+    blobs = np.asarray(blobs, dtype=np.float64).reshape(-1, 3)
+    intensities = fish_image_float[blobs[:, 0].astype(int), blobs[:, 1].astype(int)]
+    nascent = int(((blobs[:, 2] > nascent_size) & (intensities > nascent_intensity)).sum())
+    counts = {'total_count': len(blobs), 'nascent_count': nascent, 'single_molecule_count': len(blobs) - nascent,
+              'avg_intensity': float(np.mean(intensities)) if len(blobs) else 0.0}
+    if cell_mask is not None:
+        compartments = image_compartment_counts(quantify_cells(blobs, fish_image_float, cell_mask, nuc_mask,
+                                                               nascent_size, nascent_intensity))
+        counts['nucleus_count'] = compartments['nucleus_count']
+        counts['cytoplasm_count'] = compartments['cytoplasm_count']
+    return counts
+
+
+def check(conditions, grid, storage=None, data_dir=DATA_DIR, limit=3, points=4, seed=0):
+    """Compare sweep rows with the notebook's own computation at random grid points; returns mismatches."""
+    grid = dict(DEFAULT_GRID, **(grid or {}))
+    start = time.perf_counter()
+    counts = sweep(conditions, grid, storage, data_dir, workers=1, limit=limit)
+    sweep_seconds = time.perf_counter() - start
+    if counts.empty:
+        print("No images with masks found.")
+        return 0
+
+    source = ImageSource(storage, data_dir)
+    rng = np.random.default_rng(seed)
+    mismatches, full_seconds, runs = 0, 0.0, 0
+    for (condition, filename), rows in counts.groupby(['condition', 'image'], sort=False):
+        fish_image = source.read(condition, "CH1", filename)
+        cell_mask = nuc_mask = None
+        if source.exists(condition, "CH0_masks"):
+            cell_mask = source.read(condition, "CH1_masks", filename)
+            nuc_mask = source.read(condition, "CH0_masks", filename.replace('_ch1_', '_ch0_'))
+        for i in rng.choice(len(rows), size=min(points, len(rows)), replace=False):
+            row = rows.iloc[i]
+            start = time.perf_counter()
+            expected = notebook_counts(fish_image, cell_mask, nuc_mask, **{p: row[p] for p in PARAMETERS})
+            full_seconds += time.perf_counter() - start
+            runs += 1
+            differ = [c for c, value in expected.items() if not np.isclose(row[c], value)]
+            if differ:
+                mismatches += 1
+                print(f"  - {filename} {dict(row[PARAMETERS])}: {', '.join(differ)} differ")
+
+    combinations = len(counts) // counts.groupby(['condition', 'image']).ngroups
+    per_run = full_seconds / runs
+    images = counts.groupby(['condition', 'image']).ngroups
+    print(f"\n{images} images x {combinations} combinations swept in {sweep_seconds:.1f}s; "
+          f"one notebook run per image takes {per_run:.2f}s, so the grid would take "
+          f"{per_run * combinations * images:.1f}s ({per_run * combinations * images / max(sweep_seconds, 1e-9):.0f}x)")
+    print("✓ Sweep counts match blob_log" if not mismatches else f"✗ {mismatches} of {runs} checked rows differ")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Blob-detection parameter sweep over cached scale spaces")
+    parser.add_argument('command', nargs='?', default='sweep', choices=['sweep', 'check'])
+    parser.add_argument('--conditions', nargs='*', default=CONDITIONS)
+    for name, values in DEFAULT_GRID.items():
+        parser.add_argument(GRID_FLAGS[name], dest=name, nargs='*', type=float, default=list(values))
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--storage', default=STORAGE, choices=['tiff', 'zarr'])
+    parser.add_argument('--workers', type=int, help='Worker processes (default: SMFISH_CORES or all cores)')
+    parser.add_argument('--limit', type=int, help='Only the first N images')
+    parser.add_argument('--points', type=int, default=4, help='Grid points checked per image (check)')
+    parser.add_argument('--output-dir', default=TABLES_DIR)
+    args = parser.parse_args()
+
+    grid = {name: tuple(getattr(args, name)) for name in DEFAULT_GRID}
+    if args.command == 'check':
+        raise SystemExit(1 if check(args.conditions, grid, args.storage, args.data_dir, args.limit or 3,
+                                    args.points) else 0)
+
+    n_combinations = int(np.prod([len(values) for values in grid.values()]))
+    print(f"Sweeping {n_combinations} parameter combinations...")
+    start = time.perf_counter()
+    counts = sweep(args.conditions, grid, args.storage, args.data_dir, args.workers, args.limit)
+    if counts.empty:
+        print("No images with masks found.")
+        return
+    summary = summarize(counts)
+    os.makedirs(args.output_dir, exist_ok=True)
+    counts.to_csv(os.path.join(args.output_dir, "blob_sweep_counts.csv"), index=False)
+    summary.to_csv(os.path.join(args.output_dir, "blob_sweep_summary.csv"), index=False)
+    print(f"\n{counts['image'].nunique()} images x {n_combinations} combinations in "
+          f"{time.perf_counter() - start:.1f}s, saved to: {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Cell–Nucleus Association
+
+The CH0 (nucleus) and CH1 (cell) masks in data/final_masks are segmented
+independently. This stage links them: for every image pair it builds the
+sparse cell × nucleus overlap matrix in one pass over the pixels, assigns each
+nucleus to the cell it overlaps most, and flags cells with no nucleus or with
+several. Per-cell area, centroid and CH1 intensity features come from the same
+pass, so the cost grows with pixel count, not labels × pixels.
+
+Per cell (label > 0 in the CH1 mask):
+
+    area, centroid_y, centroid_x
+    mean_intensity, integrated_intensity      over the whole cell
+    nuclear_area, nuclear_mean_intensity      over the assigned nuclei inside the cell
+    cytoplasm_mean_intensity                  over the rest of the cell
+    n_nuclei, nucleus_id                      assigned nuclei and the largest of them (0 if none)
+    no_nucleus, multi_nucleus                 flags
+
+Per nucleus (label > 0 in the CH0 mask): area, cell_id (0 when unassigned)
+and overlap_fraction, the share of the nucleus inside that cell. A nucleus is
+only assigned when at least `min_overlap` of it lies in one cell.
+
+    from cell_nucleus_matching import match_image
+    cells, nuclei = match_image(cell_mask, nuc_mask, fish_image)
+
+Usage:
+    python cell_nucleus_matching.py                          # every condition in data/final_masks
+    python cell_nucleus_matching.py --conditions DMSO --workers 4
+"""
+
+import os
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import tifffile
+from scipy import sparse
+
+from zarr_store import ImageSource, STORAGE
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROCESSED_DIR = os.path.join(BASE_DIR, "data", "processed")
+FINAL_MASKS_DIR = os.path.join(BASE_DIR, "data", "final_masks")
+TABLES_DIR = os.path.join(BASE_DIR, "results", "tables")
+
+MIN_OVERLAP_FRACTION = 0.5
+
+CELL_COLUMNS = ['cell_id', 'area', 'centroid_y', 'centroid_x', 'mean_intensity', 'integrated_intensity',
+                'nuclear_area', 'nuclear_mean_intensity', 'cytoplasm_mean_intensity',
+                'n_nuclei', 'nucleus_id', 'no_nucleus', 'multi_nucleus']
+NUCLEUS_COLUMNS = ['nucleus_id', 'area', 'cell_id', 'overlap_fraction']
+
+
+def overlap_matrix(cell_mask, nuc_mask, weights=None):
+    """
+    Sparse (cell label × nucleus label) pixel counts, or sums of `weights`.
+
+    Row 0 and column 0 are background. Duplicate (cell, nucleus) entries are
+    summed on conversion to CSR, which is linear in the number of pixels.
+    """
+    cells = cell_mask.ravel().astype(np.intp)
+    nuclei = nuc_mask.ravel().astype(np.intp)
+    data = np.ones(cells.size, dtype=np.int64) if weights is None else weights.ravel().astype(np.float64)
+    shape = (int(cells.max()) + 1, int(nuclei.max()) + 1)
+    return sparse.coo_matrix((data, (cells, nuclei)), shape=shape).tocsr()
+
+
+def assign_nuclei(overlap, min_overlap=MIN_OVERLAP_FRACTION):
+    """
+    Cell of maximum overlap for every nucleus label.
+
+    Returns (cell_of_nucleus, fraction, nucleus_area) indexed by nucleus label;
+    cell_of_nucleus is 0 when no cell holds at least `min_overlap` of the nucleus.
+    """
+    nucleus_area = np.asarray(overlap.sum(axis=0)).ravel()
+    if overlap.shape[0] <= 1 or overlap.shape[1] <= 1:
+        # No cell or no nucleus labels: nothing to assign
+        n_nuclei = overlap.shape[1]
+        return np.zeros(n_nuclei, dtype=np.intp), np.zeros(n_nuclei), nucleus_area
+    inside_cells = overlap[1:].tocsc()
+    best = np.asarray(inside_cells.max(axis=0).todense()).ravel()
+    cell_of_nucleus = np.asarray(inside_cells.argmax(axis=0)).ravel() + 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = np.where(nucleus_area > 0, best / np.maximum(nucleus_area, 1), 0.0)
+    cell_of_nucleus[(best == 0) | (fraction < min_overlap)] = 0
+    cell_of_nucleus[0] = 0
+    return cell_of_nucleus, fraction, nucleus_area
+
+
+def match_image(cell_mask, nuc_mask, image=None, min_overlap=MIN_OVERLAP_FRACTION):
+    """
+    Cell and nucleus tables (CELL_COLUMNS, NUCLEUS_COLUMNS) for one image pair.
+
+    `image` is the CH1 projection used for the intensity features; without it
+    the intensity columns are NaN.
+    """
+    if cell_mask.shape != nuc_mask.shape or (image is not None and image.shape != cell_mask.shape):
+        raise ValueError(f"Shapes do not match: cells {cell_mask.shape}, nuclei {nuc_mask.shape}"
+                         + (f", image {image.shape}" if image is not None else ""))
+
+    overlap = overlap_matrix(cell_mask, nuc_mask)
+    cell_of_nucleus, fraction, nucleus_area = assign_nuclei(overlap, min_overlap)
+    n_cells = overlap.shape[0]
+
+    cell_ids = cell_mask.ravel().astype(np.intp)
+    area = np.asarray(overlap.sum(axis=1)).ravel()
+    rows, cols = np.indices(cell_mask.shape)
+    centroid_y = np.bincount(cell_ids, weights=rows.ravel(), minlength=n_cells) / np.maximum(area, 1)
+    centroid_x = np.bincount(cell_ids, weights=cols.ravel(), minlength=n_cells) / np.maximum(area, 1)
+
+    # Entries of the overlap matrix where the nucleus was assigned to that very cell
+    entries = overlap.tocoo()
+    own = (entries.row > 0) & (entries.col > 0) & (cell_of_nucleus[entries.col] == entries.row)
+    nuclear_area = np.bincount(entries.row[own], weights=entries.data[own], minlength=n_cells)
+
+    if image is not None:
+        intensity_sum = np.bincount(cell_ids, weights=image.ravel().astype(np.float64), minlength=n_cells)
+        weighted = overlap_matrix(cell_mask, nuc_mask, weights=image).tocoo()
+        # Same sparsity pattern as `entries`, so the same assignment test applies
+        own_weighted = ((weighted.row > 0) & (weighted.col > 0)
+                        & (cell_of_nucleus[weighted.col] == weighted.row))
+        nuclear_sum = np.bincount(weighted.row[own_weighted], weights=weighted.data[own_weighted],
+                                  minlength=n_cells)
+    else:
+        intensity_sum = np.full(n_cells, np.nan)
+        nuclear_sum = np.full(n_cells, np.nan)
+
+    assigned = np.flatnonzero(cell_of_nucleus)
+    n_nuclei = np.bincount(cell_of_nucleus[assigned], minlength=n_cells)
+    # Largest assigned nucleus per cell: sort by area so the last write wins
+    nucleus_id = np.zeros(n_cells, dtype=np.int64)
+    by_area = assigned[np.argsort(nucleus_area[assigned], kind='stable')]
+    nucleus_id[cell_of_nucleus[by_area]] = by_area
+
+    labels = np.flatnonzero(area)
+    labels = labels[labels > 0]
+    cytoplasm_area = area[labels] - nuclear_area[labels]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        nuclear_mean = np.where(nuclear_area[labels] > 0, nuclear_sum[labels] / nuclear_area[labels], np.nan)
+        cytoplasm_mean = np.where(cytoplasm_area > 0,
+                                  (intensity_sum[labels] - nuclear_sum[labels]) / cytoplasm_area, np.nan)
+
+    cells = pd.DataFrame({
+        'cell_id': labels,
+        'area': area[labels],
+        'centroid_y': centroid_y[labels],
+        'centroid_x': centroid_x[labels],
+        'mean_intensity': intensity_sum[labels] / area[labels],
+        'integrated_intensity': intensity_sum[labels],
+        'nuclear_area': nuclear_area[labels].astype(np.int64),
+        'nuclear_mean_intensity': nuclear_mean,
+        'cytoplasm_mean_intensity': cytoplasm_mean,
+        'n_nuclei': n_nuclei[labels],
+        'nucleus_id': nucleus_id[labels],
+        'no_nucleus': n_nuclei[labels] == 0,
+        'multi_nucleus': n_nuclei[labels] > 1,
+    }, columns=CELL_COLUMNS)
+
+    nucleus_labels = np.flatnonzero(nucleus_area)
+    nucleus_labels = nucleus_labels[nucleus_labels > 0]
+    nuclei = pd.DataFrame({
+        'nucleus_id': nucleus_labels,
+        'area': nucleus_area[nucleus_labels],
+        'cell_id': cell_of_nucleus[nucleus_labels],
+        'overlap_fraction': fraction[nucleus_labels],
+    }, columns=NUCLEUS_COLUMNS)
+    if n_cells <= 1:
+        # Empty segmentation: both tables empty (with their column types)
+        nuclei = nuclei.iloc[:0]
+    return cells, nuclei
+
+
+def discover_pairs(masks_dir=FINAL_MASKS_DIR, processed_dir=PROCESSED_DIR, conditions=None, storage=None):
+    """
+    (condition, filename, cell_mask, nuc_mask, image) for every CH1 mask.
+
+    The last three are TIFF paths, or (kind, filename) references into the
+    Zarr store when `storage` (default: SMFISH_STORAGE) is 'zarr'.
+    """
+    if (storage or STORAGE) == 'zarr':
+        source = ImageSource('zarr')
+        return [(condition, filename, ('CH1_masks', filename),
+                 ('CH0_masks', filename.replace('_ch1_', '_ch0_')), ('CH1', filename))
+                for condition in conditions or source.conditions()
+                for filename in source.list(condition, 'CH1_masks')]
+    if not os.path.isdir(masks_dir):
+        return []
+    conditions = conditions or sorted(d for d in os.listdir(masks_dir)
+                                      if os.path.isdir(os.path.join(masks_dir, d)))
+    pairs = []
+    for condition in conditions:
+        cell_mask_dir = os.path.join(masks_dir, condition, "CH1_masks")
+        if not os.path.isdir(cell_mask_dir):
+            print(f"Warning: Skipping {condition}, directory not found.")
+            continue
+        for filename in sorted(f for f in os.listdir(cell_mask_dir) if f.endswith('.tif')):
+            pairs.append((condition, filename,
+                          os.path.join(cell_mask_dir, filename),
+                          os.path.join(masks_dir, condition, "CH0_masks", filename.replace('_ch1_', '_ch0_')),
+                          os.path.join(processed_dir, condition, "CH1", filename)))
+    return pairs
+
+
+def match_pair(condition, filename, cell_mask_ref, nuc_mask_ref, image_ref, min_overlap=MIN_OVERLAP_FRACTION):
+    """Worker entry point: load one image pair (see discover_pairs) and match it."""
+    if isinstance(cell_mask_ref, tuple):
+        source = ImageSource('zarr')
+        image = source.read(condition, *image_ref) if image_ref[1] in source.list(condition, image_ref[0]) else None
+        cell_mask, nuc_mask = source.read(condition, *cell_mask_ref), source.read(condition, *nuc_mask_ref)
+    else:
+        image = tifffile.imread(image_ref) if os.path.exists(image_ref) else None
+        cell_mask, nuc_mask = tifffile.imread(cell_mask_ref), tifffile.imread(nuc_mask_ref)
+    cells, nuclei = match_image(cell_mask, nuc_mask, image, min_overlap)
+    for table in (cells, nuclei):
+        table.insert(0, 'image', filename)
+        table.insert(0, 'condition', condition)
+    return cells, nuclei
+
+
+def match_dataset(pairs, workers=None, min_overlap=MIN_OVERLAP_FRACTION):
+    """Match every pair over a process pool; returns (cells, nuclei, failures)."""
+    workers = workers or int(os.environ.get("SMFISH_CORES", os.cpu_count()))
+    cell_tables, nucleus_tables, failures = [], [], {}
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(match_pair, *pair, min_overlap) for pair in pairs]
+        for pair, future in zip(pairs, futures):
+            try:
+                cells, nuclei = future.result()
+            except Exception as e:
+                print(f"  - FAILED to process {pair[1]}: {e}")
+                failures[pair[1]] = str(e)
+                continue
+            print(f"  - {pair[0]}/{pair[1]}: {len(cells)} cells, {len(nuclei)} nuclei, "
+                  f"{int(cells['no_nucleus'].sum())} without nucleus, {int(cells['multi_nucleus'].sum())} multinucleate")
+            cell_tables.append(cells)
+            nucleus_tables.append(nuclei)
+
+    cells = pd.concat(cell_tables, ignore_index=True) if cell_tables else pd.DataFrame(
+        columns=['condition', 'image'] + CELL_COLUMNS)
+    nuclei = pd.concat(nucleus_tables, ignore_index=True) if nucleus_tables else pd.DataFrame(
+        columns=['condition', 'image'] + NUCLEUS_COLUMNS)
+    return cells, nuclei, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Associate CH0 nuclei with CH1 cells")
+    parser.add_argument('--conditions', nargs='*', help='Conditions to process (default: all found)')
+    parser.add_argument('--masks-dir', default=FINAL_MASKS_DIR)
+    parser.add_argument('--processed-dir', default=PROCESSED_DIR)
+    parser.add_argument('--output-dir', default=TABLES_DIR)
+    parser.add_argument('--min-overlap', type=float, default=MIN_OVERLAP_FRACTION,
+                        help='Share of a nucleus that must lie in one cell to assign it')
+    parser.add_argument('--workers', type=int, help='Worker processes (default: SMFISH_CORES or all cores)')
+    args = parser.parse_args()
+
+    pairs = discover_pairs(args.masks_dir, args.processed_dir, args.conditions)
+    if not pairs:
+        print("No mask pairs found.")
+        return
+    print(f"--- Matching {len(pairs)} image pairs ---")
+    cells, nuclei, failures = match_dataset(pairs, args.workers, args.min_overlap)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    cells.to_csv(os.path.join(args.output_dir, "cell_nucleus_cells.csv"), index=False)
+    nuclei.to_csv(os.path.join(args.output_dir, "cell_nucleus_nuclei.csv"), index=False)
+    print("\n--- Cells without a nucleus / with several nuclei ---")
+    print(cells.groupby('condition')[['no_nucleus', 'multi_nucleus']].sum())
+    print(f"\n✗ {len(failures)} files failed" if failures else f"\n✓ Tables saved to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
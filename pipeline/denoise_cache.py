@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Shared Content-Addressed Cache for BM3D-Denoised Images
+
+BM3D is the most expensive CPU step of the pipeline and the same denoise
+(estimate_sigma → sigma_psd = noise_sigma_est * DENOISING_STRENGTH_FACTOR →
+bm3d.bm3d) is needed by denoising, validation and final segmentation. This
+module computes it once per image: results are stored on disk as float32 .npy
+files keyed by the source pixels, the strength factor and the installed bm3d
+version, so any later stage asking for the same denoise reads it back instead.
+
+The cache is bounded in size; the least recently used entries are evicted first.
+With SMFISH_BM3D_TILE set, misses are computed by the tiled multi-core BM3D in
+tiled_denoise.py; the tile size and overlap then become part of the key. Other
+backends from denoisers.py are cached the same way under their own name.
+
+    from denoise_cache import cached_denoise
+    denoised_image = cached_denoise(original_noisy_img, DENOISING_STRENGTH_FACTOR)
+
+Environment:
+    SMFISH_DENOISE_CACHE      cache folder (default: pipeline/.pipeline_cache/bm3d)
+    SMFISH_DENOISE_CACHE_GB   size limit in GB (default: 10)
+    SMFISH_BM3D_TILE          tile size for tiled BM3D (default: unset, whole image)
+    SMFISH_BM3D_OVERLAP       tile overlap in pixels (default: 64)
+
+Usage:
+    python denoise_cache.py stats
+    python denoise_cache.py prune --max-gb 5
+    python denoise_cache.py clear
+"""
+
+import os
+import time
+import hashlib
+import argparse
+from importlib import metadata
+
+import numpy as np
+
+from instrumentation import measure, tiff_read
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.environ.get('SMFISH_DENOISE_CACHE', os.path.join(BASE_DIR, '.pipeline_cache', 'bm3d'))
+MAX_CACHE_BYTES = int(float(os.environ.get('SMFISH_DENOISE_CACHE_GB', 10)) * 1e9)
+TILE_SIZE = int(os.environ.get('SMFISH_BM3D_TILE', 0)) or None
+TILE_OVERLAP = int(os.environ.get('SMFISH_BM3D_OVERLAP', 64))
+
+
+def bm3d_version():
+    """Installed bm3d version, part of every cache key."""
+    try:
+        return metadata.version('bm3d')
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def image_hash(image):
+    """SHA-256 of an image's pixels, shape and dtype."""
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha256()
+    digest.update(f"{image.shape}{image.dtype.str}".encode())
+    digest.update(image.data)
+    return digest.hexdigest()
+
+
+def cache_key(image, strength, tile_size=None, overlap=None, method='bm3d'):
+    """Cache key for denoising `image` with a given strength factor (and tiling, if any)."""
+    digest = hashlib.sha256()
+    digest.update(image_hash(image).encode())
+    digest.update(repr(float(strength)).encode())
+    digest.update(bm3d_version().encode())
+    if method != 'bm3d':
+        digest.update(f"method={method}".encode())
+    if tile_size:
+        # Tiled output differs slightly from whole-image output; the worker count does not matter
+        digest.update(f"tile={int(tile_size)},overlap={int(overlap)}".encode())
+    return digest.hexdigest()
+
+
+def cache_path(key, cache_dir=None):
+    """Location of a cache entry (sharded by the first two hex digits)."""
+    return os.path.join(cache_dir or CACHE_DIR, key[:2], f"{key}.npy")
+
+
+def bm3d_denoise(image, strength):
+    """BM3D exactly as the notebooks run it; returns the float64 result."""
+    import bm3d
+    from skimage.util import img_as_float
+    from skimage.restoration import estimate_sigma
+
+    noisy_image_float = img_as_float(image)
+    with measure('estimate_sigma'):
+        noise_sigma_est = np.mean(estimate_sigma(noisy_image_float, channel_axis=None))
+    manual_sigma_psd = noise_sigma_est * strength
+    with measure('bm3d'):
+        return bm3d.bm3d(noisy_image_float, sigma_psd=manual_sigma_psd)
+
+
+def cached_denoise(image, strength, cache_dir=None, max_bytes=None, tile_size=None, overlap=None, workers=None,
+                   method='bm3d'):
+    """
+    Denoise `image` (BM3D by default), reusing a previous result for identical pixels and settings.
+
+    `image` may be an array or a TIFF path. `tile_size` (default SMFISH_BM3D_TILE)
+    switches misses to tiled BM3D on `workers` processes; `method` selects another
+    backend from denoisers.py instead. Returns a float32 array in [0, 1].
+    """
+    if isinstance(image, (str, os.PathLike)):
+        image = tiff_read(image)
+
+    # Tiling only applies to BM3D
+    tile_size = (tile_size or TILE_SIZE) if method == 'bm3d' else None
+    overlap = TILE_OVERLAP if overlap is None else overlap
+    key = cache_key(image, strength, tile_size, overlap, method)
+    path = cache_path(key, cache_dir)
+    try:
+        denoised_image = np.load(path)
+        # Reading counts as a use for LRU eviction
+        os.utime(path)
+        return denoised_image
+    except (FileNotFoundError, ValueError, OSError):
+        pass
+
+    if method != 'bm3d':
+        from denoisers import denoise
+        denoised_image = np.asarray(denoise(image, method, strength), dtype=np.float32)
+    elif tile_size:
+        from tiled_denoise import tiled_bm3d
+        denoised_image = tiled_bm3d(image, strength, tile_size, overlap, workers).astype(np.float32)
+    else:
+        denoised_image = bm3d_denoise(image, strength).astype(np.float32)
+    store(path, denoised_image)
+    evict(cache_dir, max_bytes if max_bytes is not None else MAX_CACHE_BYTES)
+    return denoised_image
+
+
+def store(path, array):
+    """Write an entry atomically so concurrent workers never read a partial file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def list_entries(cache_dir=None):
+    """(mtime, size, path) for every cache entry, oldest first; `cache_dir` may be a list of sharded folders."""
+    entries = []
+    roots = cache_dir if isinstance(cache_dir, (list, tuple)) else [cache_dir or CACHE_DIR]
+    for root in roots:
+        if not os.path.isdir(root):
+            continue
+        for shard in os.scandir(root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()
+    return entries
+
+
+def evict(cache_dir=None, max_bytes=None):
+    """Delete least recently used entries (across every folder of `cache_dir`) until they fit in `max_bytes`."""
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+    entries = list_entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            removed += 1
+        except FileNotFoundError:
+            # Already evicted by another worker
+            total -= size
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the shared BM3D denoise cache")
+    parser.add_argument('command', choices=['stats', 'prune', 'clear'])
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='Cache folder')
+    parser.add_argument('--max-gb', type=float, default=MAX_CACHE_BYTES / 1e9, help='Size limit for prune')
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        entries = list_entries(args.cache_dir)
+        total = sum(size for _, size, _ in entries)
+        print(f"Cache folder: {args.cache_dir}")
+        print(f"Entries: {len(entries)}")
+        print(f"Size: {total / 1e9:.2f} GB (limit {MAX_CACHE_BYTES / 1e9:.1f} GB)")
+        if entries:
+            print(f"Oldest use: {time.ctime(entries[0][0])}")
+            print(f"Newest use: {time.ctime(entries[-1][0])}")
+    elif args.command == 'prune':
+        removed = evict(args.cache_dir, int(args.max_gb * 1e9))
+        print(f"Removed {removed} entries")
+    elif args.command == 'clear':
+        removed = evict(args.cache_dir, 0)
+        print(f"Removed {removed} entries")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Pluggable Denoiser Backends
+
+BM3D gives the best masks but is by far the slowest step. For screening runs a
+faster backend can be selected by name instead:
+
+    bm3d            BM3D with sigma_psd = estimate_sigma * strength (the reference)
+    wavelet         BayesShrink wavelet denoising (scikit-image)
+    nl_means_fast   non-local means, fast mode, h = 0.8 * estimated sigma (scikit-image)
+    gaussian        float32 Gaussian filter, sigma = 1 (SciPy)
+    median          float32 3x3 median filter (SciPy)
+
+Every backend takes the raw projection and the strength factor (only BM3D uses
+it) and returns a float image in the [0, 1] range of `img_as_float`. In the
+notebooks, set DENOISER and pass it to `cached_denoise`:
+
+    DENOISER = "wavelet"
+    denoised_image = cached_denoise(original_noisy_img, DENOISING_STRENGTH_FACTOR, method=DENOISER)
+
+The benchmark runs every backend on data/processed/*/CH1 and reports time per
+image, peak memory and, when Cellpose is available, how well the masks from
+each backend agree with the masks from BM3D-denoised images.
+
+Usage:
+    python denoisers.py list
+    python denoisers.py benchmark --limit 5
+    python denoisers.py benchmark --methods bm3d wavelet gaussian --output results/tables/denoiser_benchmark.csv
+"""
+
+import os
+import glob
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_IMAGES = os.path.join(BASE_DIR, "data", "processed", "*", "CH1", "*.tif")
+CELL_MODEL_PATH = os.path.join(BASE_DIR, "models", "smfish_cell_model_cpsam")
+
+
+def denoise_bm3d(image, strength):
+    """The pipeline's reference BM3D denoise."""
+    from denoise_cache import bm3d_denoise
+    return bm3d_denoise(image, strength)
+
+
+def denoise_wavelet(image, strength):
+    """BayesShrink wavelet denoising; the noise level is estimated per image."""
+    from skimage.util import img_as_float32
+    from skimage.restoration import denoise_wavelet as wavelet
+    return wavelet(img_as_float32(image), method='BayesShrink', mode='soft', rescale_sigma=True)
+
+
+def denoise_nl_means_fast(image, strength):
+    """Fast-mode non-local means with h tied to the estimated noise level."""
+    from skimage.util import img_as_float32
+    from skimage.restoration import denoise_nl_means, estimate_sigma
+    image_float = img_as_float32(image)
+    sigma_est = float(np.mean(estimate_sigma(image_float, channel_axis=None)))
+    return denoise_nl_means(image_float, h=0.8 * sigma_est, sigma=sigma_est,
+                            fast_mode=True, patch_size=5, patch_distance=6)
+
+
+def denoise_gaussian(image, strength):
+    """float32 Gaussian baseline."""
+    from scipy import ndimage
+    from skimage.util import img_as_float32
+    return ndimage.gaussian_filter(img_as_float32(image), sigma=1.0)
+
+
+def denoise_median(image, strength):
+    """float32 3x3 median baseline."""
+    from scipy import ndimage
+    from skimage.util import img_as_float32
+    return ndimage.median_filter(img_as_float32(image), size=3)
+
+
+# Registry: name -> backend(image, strength) -> float image in [0, 1]
+DENOISERS = {
+    'bm3d': denoise_bm3d,
+    'wavelet': denoise_wavelet,
+    'nl_means_fast': denoise_nl_means_fast,
+    'gaussian': denoise_gaussian,
+    'median': denoise_median,
+}
+
+
+def get_denoiser(name):
+    """Look up a backend by name."""
+    try:
+        return DENOISERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown denoiser '{name}'. Available: {', '.join(DENOISERS)}") from None
+
+
+def denoise(image, method='bm3d', strength=100.0):
+    """Denoise `image` with the named backend (uncached; see denoise_cache.cached_denoise)."""
+    return get_denoiser(method)(image, strength)
+
+
+# --- Benchmark ---
+
+def _peak_rss_mb():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _benchmark_backend(method, image_paths, strength):
+    """Run one backend over all images in a fresh process; returns (seconds, peak MB, outputs)."""
+    import tifffile
+
+    function = get_denoiser(method)
+    # Warm up imports so they are not charged to the first image
+    function(np.zeros((64, 64), dtype=np.uint16) + 1, strength)
+    baseline = _peak_rss_mb()
+
+    seconds, outputs = [], []
+    for path in image_paths:
+        image = tifffile.imread(path)
+        start = time.perf_counter()
+        denoised_image = function(image, strength)
+        seconds.append(time.perf_counter() - start)
+        outputs.append(np.asarray(denoised_image, dtype=np.float32))
+    return seconds, max(0.0, _peak_rss_mb() - baseline), outputs
+
+
+def mask_agreement(reference, test, iou_threshold=0.5):
+    """F1 of objects matched at IoU > `iou_threshold`, and foreground IoU, between two label images."""
+    reference = reference.ravel().astype(np.int64)
+    test = test.ravel().astype(np.int64)
+    n_test = int(test.max()) + 1
+    n_reference = int(reference.max()) + 1
+    overlap = np.bincount(reference * n_test + test, minlength=n_reference * n_test).reshape(n_reference, n_test)
+
+    area_reference = overlap.sum(axis=1)
+    area_test = overlap.sum(axis=0)
+    union = area_reference[1:, None] + area_test[None, 1:] - overlap[1:, 1:]
+    iou = overlap[1:, 1:] / np.maximum(union, 1)
+    # With a threshold of at least 0.5 every object has at most one match
+    true_positives = int((iou > iou_threshold).sum())
+    total = (n_reference - 1) + (n_test - 1)
+    f1 = 2 * true_positives / total if total else 1.0
+
+    foreground_union = np.count_nonzero((reference > 0) | (test > 0))
+    foreground_iou = np.count_nonzero((reference > 0) & (test > 0)) / foreground_union if foreground_union else 1.0
+    return f1, float(foreground_iou)
+
+
+def load_cell_model(model_path):
+    """The fine-tuned cell model (or None when Cellpose or the model is unavailable)."""
+    try:
+        from cellpose import models
+    except ImportError:
+        print("Cellpose is not installed: skipping mask agreement.")
+        return None
+    if not os.path.exists(model_path):
+        print(f"Cell model not found at {model_path}: skipping mask agreement.")
+        return None
+    return models.CellposeModel(gpu=True, pretrained_model=model_path)
+
+
+def benchmark(image_paths, methods, strength, model_path):
+    """Time, memory and Cellpose mask agreement (against BM3D) for each backend."""
+    methods = ['bm3d'] + [m for m in methods if m != 'bm3d']
+    results = {}
+    for method in methods:
+        print(f"--- {method}: {len(image_paths)} images ---")
+        # Each backend runs in its own process so its peak memory is measured in isolation
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results[method] = executor.submit(_benchmark_backend, method, image_paths, strength).result()
+
+    model = load_cell_model(model_path)
+    masks = {}
+    if model is not None:
+        for method in methods:
+            masks[method] = [model.eval(image, channels=[0, 0], diameter=None)[0] for image in results[method][2]]
+
+    rows = []
+    for method in methods:
+        seconds, peak_mb, _ = results[method]
+        row = {'method': method, 'images': len(seconds),
+               'seconds_per_image': float(np.mean(seconds)), 'peak_memory_mb': peak_mb,
+               'speedup_vs_bm3d': float(np.mean(results['bm3d'][0]) / np.mean(seconds))}
+        if masks:
+            agreement = [mask_agreement(ref, test) for ref, test in zip(masks['bm3d'], masks[method])]
+            row['mask_f1_vs_bm3d'] = float(np.mean([a[0] for a in agreement]))
+            row['foreground_iou_vs_bm3d'] = float(np.mean([a[1] for a in agreement]))
+        rows.append(row)
+
+    print("\n" + "=" * 70)
+    print(f"{'method':<15}{'s/image':>10}{'speedup':>9}{'peak MB':>10}{'mask F1':>10}{'fg IoU':>9}")
+    for row in rows:
+        f1 = f"{row['mask_f1_vs_bm3d']:.3f}" if 'mask_f1_vs_bm3d' in row else '-'
+        fg = f"{row['foreground_iou_vs_bm3d']:.3f}" if 'foreground_iou_vs_bm3d' in row else '-'
+        print(f"{row['method']:<15}{row['seconds_per_image']:>10.3f}{row['speedup_vs_bm3d']:>8.1f}x"
+              f"{row['peak_memory_mb']:>10.1f}{f1:>10}{fg:>9}")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pluggable denoiser backends and benchmark")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('list', help='List available backends')
+    bench = subparsers.add_parser('benchmark', help='Speed, memory and mask agreement against BM3D')
+    bench.add_argument('--images', nargs='*', help=f'Images to test (default: {DEFAULT_IMAGES})')
+    bench.add_argument('--limit', type=int, default=5, help='Maximum number of images')
+    bench.add_argument('--methods', nargs='*', default=list(DENOISERS), choices=list(DENOISERS))
+    bench.add_argument('--strength', type=float, default=100.0, help='DENOISING_STRENGTH_FACTOR')
+    bench.add_argument('--model', default=CELL_MODEL_PATH, help='Cellpose model used for mask agreement')
+    bench.add_argument('--output', help='Optional CSV file for the results table')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for name, function in DENOISERS.items():
+            print(f"  {name:<15} {function.__doc__}")
+    elif args.command == 'benchmark':
+        image_paths = sorted(args.images or glob.glob(DEFAULT_IMAGES))[:args.limit]
+        if not image_paths:
+            print("No images found to benchmark.")
+            return
+        rows = benchmark(image_paths, args.methods, args.strength, args.model)
+        if args.output:
+            import pandas as pd
+            os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+            pd.DataFrame(rows).to_csv(args.output, index=False)
+            print(f"\n✓ Results saved to {args.output}")
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Content-Hashed Incremental Execution Cache
+
+Records a content hash of everything a pipeline notebook depends on (its input
+files, model files, the parameter constants and code of the notebook itself,
+and the pipeline modules it imports, directly or through each other) and lets run_pipeline.py skip notebooks whose hash has not changed since their
+last successful run.
+
+The same hashing is available per image for the expensive loops inside the
+notebooks (BM3D, Cellpose), so a rerun only touches images whose source file,
+model, parameters or processing code (the named modules and the pipeline
+modules they import) changed:
+
+    units = load_units("complete_segmentation_ch1")
+    key = unit_key(image_path, CELL_MODEL_PATH, code=('segmentation_service',),
+                   strength=DENOISING_STRENGTH_FACTOR)
+    if unit_is_current(units, filename, key, output_path):
+        continue
+    ...
+    record_unit(units, filename, key)
+    save_units("complete_segmentation_ch1", units)
+
+The notebooks only keep these per-image ledgers when SMFISH_INCREMENTAL=1
+(run_pipeline.py --incremental or --force); a plain run processes every image.
+Setting SMFISH_FORCE=1 (run_pipeline.py --force) bypasses every check.
+"""
+
+import os
+import re
+import ast
+import glob
+import json
+import hashlib
+import threading
+from pathlib import Path
+
+PIPELINE_DIR = Path(__file__).resolve().parent
+CACHE_DIR = PIPELINE_DIR / '.pipeline_cache'
+MANIFEST_PATH = CACHE_DIR / 'manifest.json'
+UNITS_DIR = CACHE_DIR / 'units'
+FILE_HASHES_PATH = CACHE_DIR / 'file_hashes.json'
+
+HASH_CHUNK_BYTES = 1 << 20
+
+_lock = threading.Lock()
+_file_hashes = None
+
+
+def incremental_enabled():
+    """True when SMFISH_INCREMENTAL asks the notebooks to keep per-image ledgers."""
+    return os.environ.get('SMFISH_INCREMENTAL', '') not in ('', '0')
+
+
+def force_enabled():
+    """True when SMFISH_FORCE asks for every cache check to be ignored."""
+    return os.environ.get('SMFISH_FORCE', '') not in ('', '0')
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_json(path, data):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(path.suffix + f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def hash_file(path):
+    """
+    SHA-256 of a file's content.
+
+    Digests are remembered against (size, mtime) so multi-GB raw stacks are
+    only read again after they change.
+    """
+    global _file_hashes
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    signature = [stat.st_size, stat.st_mtime_ns]
+
+    with _lock:
+        if _file_hashes is None:
+            _file_hashes = _read_json(FILE_HASHES_PATH)
+        cached = _file_hashes.get(path)
+    if cached and cached[:2] == signature:
+        return cached[2]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    hexdigest = digest.hexdigest()
+
+    with _lock:
+        _file_hashes[path] = signature + [hexdigest]
+    return hexdigest
+
+
+def flush_file_hashes():
+    """Persist the (size, mtime) → digest memo to disk."""
+    with _lock:
+        if _file_hashes is not None:
+            _write_json(FILE_HASHES_PATH, _file_hashes)
+
+
+def expand_paths(pattern):
+    """All files matched by a path or glob pattern, directories walked recursively."""
+    files = []
+    for match in sorted(glob.glob(pattern)):
+        if os.path.isdir(match):
+            for root, dirs, names in os.walk(match):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(match)
+    return files
+
+
+def hash_paths(*patterns):
+    """One digest over the relative names and contents of every matched file."""
+    digest = hashlib.sha256()
+    for pattern in patterns:
+        digest.update(pattern.encode())
+        for path in expand_paths(pattern):
+            digest.update(os.path.relpath(path).encode())
+            digest.update(hash_file(path).encode())
+    return digest.hexdigest()
+
+
+def notebook_cells(notebook_path):
+    """Source of each code cell in a notebook (outputs are ignored)."""
+    with open(notebook_path) as f:
+        notebook = json.load(f)
+    return [''.join(cell['source']) for cell in notebook['cells'] if cell['cell_type'] == 'code']
+
+
+def notebook_code(notebook_path):
+    """Concatenated source of a notebook's code cells."""
+    return '\n'.join(notebook_cells(notebook_path))
+
+
+def notebook_params(notebook_path):
+    """UPPER_CASE module-level constants with literal values, e.g. DENOISING_STRENGTH_FACTOR."""
+    params = {}
+    for source in notebook_cells(notebook_path):
+        try:
+            tree = ast.parse(source)
+        except SyntaxError:
+            # Cells using IPython magics are not plain Python
+            continue
+        for stmt in tree.body:
+            if not isinstance(stmt, ast.Assign):
+                continue
+            for target in stmt.targets:
+                if isinstance(target, ast.Name) and target.id.isupper():
+                    try:
+                        params[target.id] = ast.literal_eval(stmt.value)
+                    except ValueError:
+                        pass
+    return params
+
+
+def imported_names(source):
+    """Top-level names of the modules a piece of Python source imports, anywhere in it."""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        # Cells using IPython magics are not plain Python: fall back to the import lines
+        names = set()
+        for module, modules in re.findall(r'^\s*(?:from\s+(\w+)|import\s+([\w., ]+))', source, re.MULTILINE):
+            names.update(name.strip().split('.')[0] for name in (module or modules).split(',') if name.strip())
+        return names
+    names = set()
+    for stmt in ast.walk(tree):
+        if isinstance(stmt, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in stmt.names)
+        elif isinstance(stmt, ast.ImportFrom) and stmt.level == 0 and stmt.module:
+            names.add(stmt.module.split('.')[0])
+    return names
+
+
+def module_hashes(*sources):
+    """
+    {filename: content hash} of the pipeline/*.py modules the sources import,
+    directly or through other pipeline modules. Imports inside functions count.
+    """
+    found = {}
+    pending = [name for source in sources for name in imported_names(source)]
+    while pending:
+        name = pending.pop()
+        path = PIPELINE_DIR / f'{name}.py'
+        if name in found or not path.is_file():
+            continue
+        found[name] = path
+        pending.extend(imported_names(path.read_text()))
+    return {path.name: hash_file(path) for path in sorted(found.values())}
+
+
+def node_key(node, artifacts):
+    """
+    Content key for a pipeline node.
+
+    Covers the notebook's code, its parameter constants, its environment, the
+    pipeline modules it imports and the content of every input artifact.
+    """
+    # Round-trip through JSON so tuples compare equal to what the manifest stores
+    params = json.loads(json.dumps(notebook_params(node['notebook']), default=str))
+    inputs = {name: hash_paths(artifacts[name]) for name in node.get('inputs', [])}
+    modules = module_hashes(*notebook_cells(node['notebook']))
+
+    digest = hashlib.sha256()
+    digest.update(notebook_code(node['notebook']).encode())
+    digest.update(json.dumps(node.get('env', {}), sort_keys=True).encode())
+    digest.update(json.dumps(inputs, sort_keys=True).encode())
+    digest.update(json.dumps(modules, sort_keys=True).encode())
+    return {'key': digest.hexdigest(), 'params': params, 'inputs': inputs, 'modules': modules}
+
+
+def outputs_present(node, artifacts):
+    """True when every declared output artifact exists on disk."""
+    return all(glob.glob(artifacts[name]) for name in node.get('outputs', []))
+
+
+def load_manifest():
+    """Last successful key per node."""
+    return _read_json(MANIFEST_PATH)
+
+
+def record_node(name, entry):
+    """Store the key of a node that just ran successfully."""
+    with _lock:
+        manifest = _read_json(MANIFEST_PATH)
+        manifest[name] = entry
+        _write_json(MANIFEST_PATH, manifest)
+    flush_file_hashes()
+
+
+def explain_changes(previous, current):
+    """Human-readable reasons why a node's key changed."""
+    if not previous:
+        return ['never run']
+
+    reasons = []
+    for name, digest in current['inputs'].items():
+        if previous.get('inputs', {}).get(name) != digest:
+            reasons.append(f"input '{name}' changed")
+    for name, digest in current.get('modules', {}).items():
+        if previous.get('modules', {}).get(name) != digest:
+            reasons.append(f"module '{name}' changed")
+    old_params = previous.get('params', {})
+    for name, value in current['params'].items():
+        if old_params.get(name) != value:
+            reasons.append(f"{name}: {old_params.get(name)!r} → {value!r}")
+    if not reasons and previous.get('key') != current['key']:
+        reasons.append('notebook code changed')
+    return reasons
+
+
+# --- Per-image units ---
+
+def unit_key(*paths, code=(), **params):
+    """
+    Key for one image: the content of `paths`, keyword parameters, and the code
+    of the pipeline modules named in `code` with the pipeline modules they import.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(hash_paths(path).encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    digest.update(json.dumps(code_hashes(*code), sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+_code_hashes = {}
+
+
+def code_hashes(*modules):
+    """module_hashes() of the named pipeline modules, themselves included (memoized per process)."""
+    if modules not in _code_hashes:
+        _code_hashes[modules] = module_hashes(*(f'import {name}' for name in modules))
+    return _code_hashes[modules]
+
+
+def load_units(ledger):
+    """Keys of the images processed by a named loop."""
+    return _read_json(UNITS_DIR / f'{ledger}.json')
+
+
+def unit_is_current(units, unit, key, output_path=None):
+    """True if `unit` was processed with the same key and its output still exists."""
+    if force_enabled() or units.get(unit) != key:
+        return False
+    return output_path is None or os.path.exists(output_path)
+
+
+def record_unit(units, unit, key):
+    """Mark `unit` as processed with `key`."""
+    units[unit] = key
+
+
+def save_units(ledger, units):
+    """Persist a ledger of per-image keys."""
+    _write_json(UNITS_DIR / f'{ledger}.json', units)
+    flush_file_hashes()
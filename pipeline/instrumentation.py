@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+Per-Image, Per-Stage Instrumentation
+
+Records wall time, CPU time and peak RSS of the hot paths (projection,
+BM3D, estimate_sigma, Cellpose eval, blob detection, TIFF reads and writes)
+for every image, and turns them into a machine-readable run report that can
+be compared against an earlier one.
+
+Measurement is off unless SMFISH_PROFILE_DIR names a directory, which
+`python run_pipeline.py --profile` sets to results/profiles/<run_id>. The
+variable is inherited by notebooks and their worker processes; each process
+appends one JSON line per measurement to events-<pid>.jsonl there:
+
+    from instrumentation import measure, tiff_read
+    with measure('blob_detection', image=filename):
+        blobs = blob_log(...)
+
+A measurement without an image name takes the one of the enclosing
+measurement in the same thread, so BM3D inside a per-image `denoise` is
+attributed to that image. `items` marks a measurement that covers several
+images (a batched Cellpose eval); per-image times divide by it.
+
+- Wall time is `time.perf_counter`; CPU time is `time.process_time`, which
+  counts every thread of the process (BM3D, torch and BLAS threads included).
+- Peak RSS is the process high-water mark (VmHWM) during the measurement.
+  On Linux the mark is reset when a measurement starts, so it is per stage;
+  elsewhere it is the peak of the process so far. Threads of one process
+  share the mark, so overlapping stages see each other's memory.
+
+Usage:
+    python instrumentation.py report results/profiles/<run_id>          # (re)build and print the report
+    python instrumentation.py compare results/profiles/A results/profiles/B --threshold 0.2
+    python instrumentation.py list
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import platform
+import argparse
+import threading
+from contextlib import nullcontext
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROFILES_DIR = os.path.join(BASE_DIR, "results", "profiles")
+REPORT_NAME = "report.json"
+
+# Packages whose upgrades are the usual suspects for a slowdown; versions go into the report
+TRACKED_PACKAGES = ['numpy', 'scipy', 'scikit-image', 'tifffile', 'bm3d', 'cellpose', 'torch', 'pandas']
+
+# A stage regresses when it is slower by more than the threshold AND by more than these absolute margins
+DEFAULT_THRESHOLD = 0.2
+MIN_SECONDS = 0.05
+MIN_RSS_MB = 50.0
+
+_NULL = nullcontext()
+_local = threading.local()
+_lock = threading.Lock()
+_open = []
+_can_reset_peak = None
+
+
+def _after_fork():
+    # A forked worker must not inherit a held lock or the parent's open measurements
+    global _lock, _open, _local
+    _lock = threading.Lock()
+    _open = []
+    _local = threading.local()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def profile_dir():
+    return os.environ.get("SMFISH_PROFILE_DIR") or None
+
+
+def enabled():
+    return profile_dir() is not None
+
+
+def _read_hwm_mb():
+    """Peak RSS of this process in MB (VmHWM, or ru_maxrss where /proc is missing)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _reset_hwm():
+    """Reset VmHWM to the current RSS (Linux); returns False where that is not possible."""
+    global _can_reset_peak
+    if _can_reset_peak is False:
+        return False
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        _can_reset_peak = True
+    except OSError:
+        _can_reset_peak = False
+    return _can_reset_peak
+
+
+def _current_image():
+    stack = getattr(_local, 'stack', None)
+    for measurement in reversed(stack or []):
+        if measurement.image is not None:
+            return measurement.image
+    return None
+
+
+def record(stage, wall, cpu, peak_rss_mb, image=None, items=1, **fields):
+    """Append one measurement to this process's event file."""
+    directory = profile_dir()
+    if directory is None:
+        return
+    event = {'stage': stage, 'image': image, 'items': items, 'wall': wall, 'cpu': cpu,
+             'peak_rss_mb': peak_rss_mb, 'notebook': os.environ.get("SMFISH_PROFILE_NOTEBOOK"),
+             'pid': os.getpid(), 'time': time.time()}
+    event.update(fields)
+    line = json.dumps(event, default=str) + "\n"
+    with _lock:
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"events-{os.getpid()}.jsonl"), 'a') as f:
+            f.write(line)
+
+
+class _Measurement:
+    def __init__(self, stage, image, items, fields):
+        self.stage = stage
+        self.image = image
+        self.items = items
+        self.fields = fields
+        self.peak = 0.0
+
+    def __enter__(self):
+        if self.image is None:
+            self.image = _current_image()
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self)
+        with _lock:
+            # Stages still open keep the peak they reached before the mark is reset
+            hwm = _read_hwm_mb()
+            for measurement in _open:
+                measurement.peak = max(measurement.peak, hwm)
+            _open.append(self)
+            _reset_hwm()
+        self.peak = 0.0
+        self.cpu = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu
+        with _lock:
+            peak = max(self.peak, _read_hwm_mb())
+            _open.remove(self)
+            # The kernel updates the mark lazily; stages still open must not end up below this one
+            for measurement in _open:
+                measurement.peak = max(measurement.peak, peak)
+        _local.stack.remove(self)
+        fields = dict(self.fields)
+        if exc_type is not None:
+            fields['error'] = exc_type.__name__
+        record(self.stage, wall, cpu, peak, self.image, self.items, **fields)
+        return False
+
+
+def measure(stage, image=None, items=1, **fields):
+    """Context manager timing one stage; does nothing unless SMFISH_PROFILE_DIR is set."""
+    if not enabled():
+        return _NULL
+    return _Measurement(stage, image, items, fields)
+
+
+def tiff_read(path, **kwargs):
+    """tifffile.imread, measured as 'tiff_read'."""
+    import tifffile
+    with measure('tiff_read', image=_image_name(path)):
+        return tifffile.imread(path, **kwargs)
+
+
+def tiff_write(path, data, **kwargs):
+    """tifffile.imwrite, measured as 'tiff_write'."""
+    import tifffile
+    with measure('tiff_write', image=_image_name(path)):
+        return tifffile.imwrite(path, data, **kwargs)
+
+
+def _image_name(path):
+    return os.path.basename(str(path)) if isinstance(path, (str, os.PathLike)) else None
+
+
+# --- Run report ---
+
+def read_events(directory):
+    """Every measurement recorded in a profile directory, oldest first."""
+    events = []
+    for path in sorted(glob.glob(os.path.join(directory, "events-*.jsonl"))):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        # A process killed mid-write leaves a partial last line
+                        continue
+    events.sort(key=lambda e: e.get('time', 0))
+    return events
+
+
+def _stage_summary(events):
+    wall = np.array([e['wall'] for e in events])
+    cpu = np.array([e['cpu'] for e in events])
+    items = np.array([max(e.get('items') or 1, 1) for e in events])
+    per_item = wall / items
+    return {
+        'count': len(events),
+        'items': int(items.sum()),
+        'wall_total': float(wall.sum()),
+        'cpu_total': float(cpu.sum()),
+        'wall_per_item_p50': float(np.median(per_item)),
+        'wall_per_item_p95': float(np.percentile(per_item, 95)),
+        'cpu_per_item_mean': float(cpu.sum() / items.sum()),
+        'peak_rss_mb': float(max(e['peak_rss_mb'] for e in events)),
+        'errors': sum(1 for e in events if e.get('error')),
+    }
+
+
+def package_versions(names=TRACKED_PACKAGES):
+    from importlib import metadata
+    versions = {}
+    for name in names:
+        try:
+            versions[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            continue
+    return versions
+
+
+def build_report(directory):
+    """Summaries per stage and per notebook plus per-image rows, from a profile directory."""
+    events = read_events(directory)
+    notebooks = {}
+    for event in events:
+        if event['stage'] == 'notebook':
+            name = event.get('notebook') or '?'
+            if event.get('channels'):
+                name += f" [{event['channels']}]"
+            notebooks[name] = {'status': 'failed' if event.get('error') else 'ok', 'wall': event['wall'],
+                               'cpu': event['cpu'], 'peak_rss_mb': event['peak_rss_mb']}
+    by_stage = {}
+    for event in events:
+        by_stage.setdefault(event['stage'], []).append(event)
+
+    images = {}
+    for event in events:
+        if event.get('image') is None:
+            continue
+        key = (event['stage'], event['image'], event.get('notebook'))
+        row = images.setdefault(key, {'stage': key[0], 'image': key[1], 'notebook': key[2],
+                                      'count': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss_mb': 0.0})
+        row['count'] += 1
+        row['wall'] += event['wall']
+        row['cpu'] += event['cpu']
+        row['peak_rss_mb'] = max(row['peak_rss_mb'], event['peak_rss_mb'])
+
+    return {
+        'run_id': os.path.basename(os.path.normpath(directory)),
+        'created': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(),
+                 'cpu_count': os.cpu_count(), 'per_stage_peak_rss': os.access('/proc/self/clear_refs', os.W_OK)},
+        'packages': package_versions(),
+        'notebooks': notebooks,
+        'stages': {stage: _stage_summary(stage_events) for stage, stage_events in sorted(by_stage.items())},
+        'images': sorted(images.values(), key=lambda r: (r['stage'], str(r['notebook']), r['image'])),
+    }
+
+
+def write_report(directory):
+    """Build the report and save it as report.json in the profile directory."""
+    report = build_report(directory)
+    path = os.path.join(directory, REPORT_NAME)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+    return path, report
+
+
+def load_report(path):
+    """A report from its JSON file or its profile directory (built on the fly if missing)."""
+    if os.path.isdir(path):
+        report_path = os.path.join(path, REPORT_NAME)
+        if not os.path.exists(report_path):
+            return build_report(path)
+        path = report_path
+    with open(path) as f:
+        return json.load(f)
+
+
+def print_report(report):
+    print(f"Run {report['run_id']}:")
+    if report.get('notebooks'):
+        print(f"  {'notebook':<48} {'status':>7} {'wall s':>9} {'cpu s':>9} {'peak MB':>9}")
+        for name, row in report['notebooks'].items():
+            print(f"  {name:<48} {row.get('status', ''):>7} {row['wall']:9.1f} {row['cpu']:9.1f} "
+                  f"{row['peak_rss_mb']:9.0f}")
+    print(f"  {'stage':<16} {'calls':>6} {'items':>6} {'wall s':>9} {'cpu s':>9} {'p50 s/img':>10} "
+          f"{'p95 s/img':>10} {'peak MB':>9}")
+    for stage, row in report['stages'].items():
+        print(f"  {stage:<16} {row['count']:6d} {row['items']:6d} {row['wall_total']:9.2f} {row['cpu_total']:9.2f} "
+              f"{row['wall_per_item_p50']:10.3f} {row['wall_per_item_p95']:10.3f} {row['peak_rss_mb']:9.0f}")
+
+
+# --- Regression check ---
+
+# (summary field, absolute margin, label)
+COMPARED_METRICS = [
+    ('wall_per_item_p50', MIN_SECONDS, 'p50 wall/image'),
+    ('cpu_per_item_mean', MIN_SECONDS, 'mean cpu/image'),
+    ('peak_rss_mb', MIN_RSS_MB, 'peak RSS'),
+]
+
+
+def compare_reports(baseline, current, threshold=DEFAULT_THRESHOLD, stages=None):
+    """
+    Stage-by-stage differences between two reports.
+
+    Returns (rows, regressions); a metric regresses when the current value
+    exceeds the baseline by more than `threshold` (relative) and by more than
+    its absolute margin, so tiny stages do not fail on noise.
+    """
+    rows, regressions = [], []
+    for stage in sorted(set(baseline['stages']) | set(current['stages'])):
+        if stages and stage not in stages:
+            continue
+        before, after = baseline['stages'].get(stage), current['stages'].get(stage)
+        if before is None or after is None:
+            rows.append((stage, 'only in ' + ('current' if before is None else 'baseline'), None, None, None, False))
+            continue
+        for field, margin, label in COMPARED_METRICS:
+            old, new = before[field], after[field]
+            change = (new - old) / old if old > 0 else (float('inf') if new > 0 else 0.0)
+            regressed = change > threshold and new - old > margin
+            rows.append((stage, label, old, new, change, regressed))
+            if regressed:
+                regressions.append((stage, label, old, new, change))
+    return rows, regressions
+
+
+def print_comparison(rows):
+    print(f"  {'stage':<16} {'metric':<15} {'baseline':>10} {'current':>10} {'change':>8}")
+    for stage, label, old, new, change, regressed in rows:
+        if old is None:
+            print(f"  {stage:<16} {label}")
+            continue
+        marker = '  ✗ REGRESSION' if regressed else ''
+        print(f"  {stage:<16} {label:<15} {old:10.3f} {new:10.3f} {change * 100:+7.1f}%{marker}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-image, per-stage run reports and regression checks")
+    subparsers = parser.add_subparsers(dest='command')
+    report_parser = subparsers.add_parser('report', help='Build and print the report of a profile directory')
+    report_parser.add_argument('directory')
+    compare_parser = subparsers.add_parser('compare', help='Fail when a stage regressed against a baseline')
+    compare_parser.add_argument('baseline', help='Baseline report.json or profile directory')
+    compare_parser.add_argument('current', help='Current report.json or profile directory')
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                                help='Relative slowdown that fails the check (default: 0.2 = 20%%)')
+    compare_parser.add_argument('--stages', nargs='*', help='Only compare these stages')
+    list_parser = subparsers.add_parser('list', help='Profiled runs')
+    list_parser.add_argument('--root', default=PROFILES_DIR)
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        path, report = write_report(args.directory)
+        print_report(report)
+        print(f"\n✓ Report saved to {path}")
+    elif args.command == 'compare':
+        baseline, current = load_report(args.baseline), load_report(args.current)
+        rows, regressions = compare_reports(baseline, current, args.threshold, args.stages)
+        print(f"Baseline {baseline['run_id']} vs current {current['run_id']}:")
+        print_comparison(rows)
+        changed = {name: (baseline.get('packages', {}).get(name), version)
+                   for name, version in current.get('packages', {}).items()
+                   if baseline.get('packages', {}).get(name) != version}
+        for name, (old, new) in changed.items():
+            print(f"  package {name}: {old} -> {new}")
+        if regressions:
+            print(f"\n✗ {len(regressions)} metrics regressed by more than {args.threshold * 100:.0f}%")
+            raise SystemExit(1)
+        print(f"\n✓ No stage regressed by more than {args.threshold * 100:.0f}%")
+    elif args.command == 'list':
+        if not os.path.isdir(args.root):
+            print(f"No profiled runs in {args.root}")
+            return
+        for run_id in sorted(os.listdir(args.root)):
+            has_report = os.path.exists(os.path.join(args.root, run_id, REPORT_NAME))
+            print(f"  {run_id}{'' if has_report else '  (no report yet)'}")
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
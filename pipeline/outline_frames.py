@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Parallel Outline Frame Renderer
+
+Renders the segmentation outline frames of 6_generate_outlines.ipynb for
+every condition and channel at once. The frames are pixel-for-pixel the PNGs
+that `mark_boundaries(image, mask, color=(1, 1, 0), mode='inner')` followed by
+`plt.imsave` produce. The work is done on uint8 and bool arrays instead of a
+float64 RGB image:
+
+- Boundaries come from comparing the uint16 mask with its four shifted
+  neighbours. A labelled pixel is on the outline when any neighbour inside the
+  image has a different label, which matches `find_boundaries(mode='inner')`.
+- The projection is scaled to uint8 through a lookup table that reproduces
+  `img_as_float` followed by imsave's truncation to 8 bits.
+- Outline pixels are set to yellow in the RGBA frame, which is written with
+  Pillow at a fast PNG compression level.
+
+Frames go to results/gif_frames/<condition>_<channel>/frame_XXX.png, numbered
+by the sorted projection filenames as before. Images are spread over a
+process pool.
+
+Usage:
+    python outline_frames.py                                  # every condition, CH0 and CH1
+    python outline_frames.py --conditions JQ1 --channels CH0 --workers 4
+    python outline_frames.py compare --limit 5                # check against mark_boundaries + plt.imsave
+"""
+
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from zarr_store import ImageSource, DATA_DIR, STORAGE
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+GIF_FRAMES_DIR = os.path.join(BASE_DIR, "results", "gif_frames")
+
+CHANNELS = ['CH0', 'CH1']
+OUTLINE_COLOR = (255, 255, 0)
+# PNG is lossless at any level; encoding, not rendering, dominates the time per frame
+PNG_COMPRESS_LEVEL = 1
+
+# uint16/uint8 value -> uint8 exactly as img_as_float followed by (x * 255).astype(np.uint8)
+_LUTS = {}
+
+
+def _lut(dtype):
+    if dtype not in _LUTS:
+        imax = np.iinfo(dtype).max
+        _LUTS[dtype] = (np.multiply(np.arange(imax + 1, dtype=np.float64), 1.0 / imax) * 255).astype(np.uint8)
+    return _LUTS[dtype]
+
+
+def to_uint8(image):
+    """Grey levels of the saved frame: the dtype range scaled to 0-255, truncated like imsave."""
+    if image.dtype in (np.uint8, np.uint16):
+        return _lut(image.dtype)[image]
+    if image.dtype.kind == 'f':
+        if image.min() < 0 or image.max() > 1:
+            raise ValueError("Floating point images must be in the 0..1 range")
+        return (image * 255).astype(np.uint8)
+    raise ValueError(f"Unsupported image dtype {image.dtype}")
+
+
+def label_boundaries(mask, background=0):
+    """Inner label boundaries (4-connectivity), as find_boundaries(mode='inner') gives them."""
+    vertical = mask[1:] != mask[:-1]
+    horizontal = mask[:, 1:] != mask[:, :-1]
+    boundaries = np.zeros(mask.shape, dtype=bool)
+    boundaries[1:] |= vertical
+    boundaries[:-1] |= vertical
+    boundaries[:, 1:] |= horizontal
+    boundaries[:, :-1] |= horizontal
+    boundaries &= mask != background
+    return boundaries
+
+
+def render_outline(image, mask, color=OUTLINE_COLOR):
+    """RGBA uint8 frame: the grey image with label outlines in `color`."""
+    if image.shape != mask.shape:
+        raise ValueError(f"Mask shape {mask.shape} does not match image {image.shape}")
+    frame = np.empty(image.shape + (4,), dtype=np.uint8)
+    frame[..., :3] = to_uint8(image)[..., None]
+    frame[..., 3] = 255
+    frame[label_boundaries(mask)] = color + (255,)
+    return frame
+
+
+def render_frame(condition, channel, filename, output_path, storage=None, data_dir=DATA_DIR):
+    """Worker entry point: render and save one frame; returns the error text or None."""
+    try:
+        source = ImageSource(storage, data_dir)
+        frame = render_outline(source.read(condition, channel, filename),
+                               source.read(condition, f"{channel}_masks", filename))
+        Image.fromarray(frame).save(output_path, compress_level=PNG_COMPRESS_LEVEL)
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def frame_tasks(conditions=None, channels=CHANNELS, storage=None, data_dir=DATA_DIR, frames_dir=GIF_FRAMES_DIR):
+    """(condition, channel, filename, output_path) for every projection, numbered as the notebook did."""
+    source = ImageSource(storage, data_dir)
+    tasks = []
+    for condition in conditions or source.conditions('CH0'):
+        for channel in channels:
+            output_dir = os.path.join(frames_dir, f"{condition}_{channel}")
+            for i, filename in enumerate(source.list(condition, channel)):
+                tasks.append((condition, channel, filename, os.path.join(output_dir, f"frame_{i:03d}.png")))
+    return tasks
+
+
+def render_all(tasks, workers=None, storage=None, data_dir=DATA_DIR):
+    """Render every task over a process pool; returns {filename: error_text} for failures."""
+    workers = workers or int(os.environ.get("SMFISH_CORES", os.cpu_count()))
+    for output_dir in {os.path.dirname(task[3]) for task in tasks}:
+        os.makedirs(output_dir, exist_ok=True)
+    failures = {}
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(render_frame, *task, storage, data_dir) for task in tasks]
+        for (condition, channel, filename, _), future in zip(tasks, futures):
+            error = future.result()
+            if error is not None:
+                print(f"  - FAILED to process {filename}: {error}")
+                failures[f"{condition}/{channel}/{filename}"] = error
+    return failures
+
+
+def compare(tasks, storage=None, data_dir=DATA_DIR):
+    """Pixel equality, time and working array size against mark_boundaries + plt.imsave."""
+    import io
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from skimage.segmentation import mark_boundaries
+
+    source = ImageSource(storage, data_dir)
+    reference_seconds, fast_seconds, mismatches = 0.0, 0.0, 0
+    for condition, channel, filename, _ in tasks:
+        image = source.read(condition, channel, filename)
+        mask = source.read(condition, f"{channel}_masks", filename)
+
+        start = time.perf_counter()
+        outline_image = mark_boundaries(image, mask, color=(1, 1, 0), mode='inner', background_label=0)
+        buffer = io.BytesIO()
+        plt.imsave(buffer, outline_image, format='png')
+        reference_seconds += time.perf_counter() - start
+        buffer.seek(0)
+        reference = np.asarray(Image.open(buffer))
+
+        start = time.perf_counter()
+        frame = render_outline(image, mask)
+        buffer = io.BytesIO()
+        Image.fromarray(frame).save(buffer, format='png', compress_level=PNG_COMPRESS_LEVEL)
+        fast_seconds += time.perf_counter() - start
+        buffer.seek(0)
+
+        if not np.array_equal(reference, np.asarray(Image.open(buffer))):
+            mismatches += 1
+            print(f"  - {condition}/{channel}/{filename}: frames differ")
+
+    print(f"\n{len(tasks)} frames: mark_boundaries + imsave {reference_seconds:.2f}s, "
+          f"uint8 renderer {fast_seconds:.2f}s ({reference_seconds / max(fast_seconds, 1e-9):.1f}x)")
+    if tasks:
+        pixels = image.size
+        print(f"Per-frame working arrays: float64 RGB {pixels * 24 / 1e6:.1f} MB vs uint8 RGBA + mask "
+              f"{pixels * 5 / 1e6:.1f} MB")
+    print("✓ Frames are pixel-identical" if not mismatches else f"✗ {mismatches} frames differ")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel uint8 outline frame renderer")
+    parser.add_argument('command', nargs='?', default='render', choices=['render', 'compare'])
+    parser.add_argument('--conditions', nargs='*', help='Conditions (default: all found)')
+    parser.add_argument('--channels', nargs='*', default=CHANNELS, choices=CHANNELS)
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--frames-dir', default=GIF_FRAMES_DIR)
+    parser.add_argument('--storage', default=STORAGE, choices=['tiff', 'zarr'])
+    parser.add_argument('--workers', type=int, help='Worker processes (default: SMFISH_CORES or all cores)')
+    parser.add_argument('--limit', type=int, default=5, help='Frames to check with compare')
+    args = parser.parse_args()
+
+    tasks = frame_tasks(args.conditions, args.channels, args.storage, args.data_dir, args.frames_dir)
+    if not tasks:
+        print("No projections found.")
+        return
+    if args.command == 'compare':
+        raise SystemExit(1 if compare(tasks[:args.limit], args.storage, args.data_dir) else 0)
+
+    print(f"Generating {len(tasks)} outline frames...")
+    start = time.perf_counter()
+    failures = render_all(tasks, args.workers, args.storage, args.data_dir)
+    print(f"\n{len(tasks) - len(failures)} frames in {time.perf_counter() - start:.1f}s, saved to: {args.frames_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Superimposed Outline Overlays
+
+7_2_frame_compiler.ipynb built a union-of-outlines overlay by decoding the
+whole segmentation GIF and keeping the pixels that looked yellow in any
+frame. That depended on the GIF palette and on a hard-coded project path.
+Here the union comes straight from the label masks in data/final_masks: the
+boundaries of each mask (`outline_frames.label_boundaries`) are OR-ed into
+one boolean image, reading one mask at a time.
+
+Each sequence is split into chunks of masks that workers reduce in parallel.
+The partial unions are OR-ed together as they arrive, so memory holds one
+accumulator and one mask per worker, however many images there are. The
+union is drawn in red over a background projection (the first one of the
+sequence unless another is named) and saved as a PNG:
+
+    results/plots/overlays/<condition>_<channel>_overlay.png
+
+Usage:
+    python outline_overlay.py                                 # every condition, CH0 and CH1
+    python outline_overlay.py --conditions DMSO --channels CH0 --background MCF7_AREG_DMSO_020_ch0_projection.tif
+    python outline_overlay.py compare --conditions DMSO       # against thresholding the segmentation GIF
+"""
+
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image
+
+from zarr_store import ImageSource, DATA_DIR, STORAGE
+from outline_frames import label_boundaries, CHANNELS
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+OVERLAYS_DIR = os.path.join(BASE_DIR, "results", "plots", "overlays")
+
+OVERLAY_COLOR = (255, 0, 0)
+OVERLAY_ALPHA = 0.7
+# Masks reduced by one worker task before its partial union is returned
+CHUNK_SIZE = 16
+
+
+def union_outlines(masks, shape=None):
+    """OR of the label boundaries of every mask in an iterable, consumed one mask at a time."""
+    union = None if shape is None else np.zeros(shape, dtype=bool)
+    for mask in masks:
+        if union is None:
+            union = np.zeros(mask.shape, dtype=bool)
+        elif mask.shape != union.shape:
+            raise ValueError(f"Mask shape {mask.shape} does not match {union.shape}")
+        union |= label_boundaries(mask)
+    return union
+
+
+def union_chunk(condition, channel, filenames, storage=None, data_dir=DATA_DIR):
+    """Worker entry point: partial union over some masks of one sequence."""
+    source = ImageSource(storage, data_dir)
+    return union_outlines(source.read(condition, f"{channel}_masks", filename) for filename in filenames)
+
+
+def render_overlay(background, union, color=OVERLAY_COLOR, alpha=OVERLAY_ALPHA):
+    """
+    RGB uint8 image: the background stretched to its min-max range in grey, as
+    imshow(cmap='gray') shows it, with the union blended in `color` at `alpha`.
+    """
+    if background.shape != union.shape:
+        raise ValueError(f"Background shape {background.shape} does not match the outlines {union.shape}")
+    low, high = float(background.min()), float(background.max())
+    grey = (background.astype(np.float32) - low) * (255.0 / max(high - low, 1e-12))
+    rgb = np.repeat(grey[..., None], 3, axis=2)
+    rgb[union] = rgb[union] * (1 - alpha) + np.array(color, dtype=np.float32) * alpha
+    return np.clip(np.round(rgb), 0, 255).astype(np.uint8)
+
+
+def overlay_path(condition, channel, overlays_dir=OVERLAYS_DIR):
+    return os.path.join(overlays_dir, f"{condition}_{channel}_overlay.png")
+
+
+def build_overlays(conditions=None, channels=CHANNELS, background=None, storage=None, data_dir=DATA_DIR,
+                   overlays_dir=OVERLAYS_DIR, workers=None, chunk_size=CHUNK_SIZE):
+    """
+    One overlay PNG per condition and channel.
+
+    `background` names the projection to draw on (default: the first of each
+    sequence). Returns {(condition, channel): union} for the overlays written.
+    """
+    workers = workers or int(os.environ.get("SMFISH_CORES", os.cpu_count()))
+    source = ImageSource(storage, data_dir)
+    sequences = {}
+    for condition in conditions or source.conditions('CH0'):
+        for channel in channels:
+            filenames = source.list(condition, f"{channel}_masks")
+            if filenames:
+                sequences[(condition, channel)] = filenames
+            else:
+                print(f"  - {condition}/{channel}: no masks found")
+
+    unions = {}
+    failed = set()
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {}
+        for key, filenames in sequences.items():
+            for start in range(0, len(filenames), chunk_size):
+                future = executor.submit(union_chunk, *key, filenames[start:start + chunk_size], storage, data_dir)
+                futures[future] = key
+        for future in as_completed(futures):
+            key = futures.pop(future)
+            if key in failed:
+                continue
+            try:
+                partial = future.result()
+                if key not in unions:
+                    unions[key] = partial
+                elif partial.shape != unions[key].shape:
+                    raise ValueError(f"Mask shape {partial.shape} does not match {unions[key].shape}")
+                else:
+                    unions[key] |= partial
+            except Exception as e:
+                print(f"  - FAILED to process {key[0]}_{key[1]}: {e}")
+                failed.add(key)
+                unions.pop(key, None)
+
+    os.makedirs(overlays_dir, exist_ok=True)
+    for (condition, channel), union in list(unions.items()):
+        try:
+            name = background or source.list(condition, channel)[0]
+            image = render_overlay(source.read(condition, channel, name), union)
+            path = overlay_path(condition, channel, overlays_dir)
+            Image.fromarray(image).save(path)
+            print(f"  ✓ {condition}_{channel}: {len(sequences[(condition, channel)])} masks -> {path}")
+        except Exception as e:
+            print(f"  - FAILED to process {condition}_{channel}: {e}")
+            del unions[(condition, channel)]
+    return unions
+
+
+def gif_outlines(gif_path):
+    """The old union: pixels that are yellow in any decoded frame of the segmentation GIF."""
+    import imageio.v2 as imageio
+    union = None
+    for frame in imageio.get_reader(gif_path):
+        is_outline = (frame[:, :, 0] > 200) & (frame[:, :, 1] > 200) & (frame[:, :, 2] < 50)
+        union = is_outline if union is None else union | is_outline
+    return union
+
+
+def compare(condition, channel, gif_path, storage=None, data_dir=DATA_DIR):
+    """Time and agreement of the mask union against thresholding the decoded GIF."""
+    source = ImageSource(storage, data_dir)
+    start = time.perf_counter()
+    union = union_chunk(condition, channel, source.list(condition, f"{channel}_masks"), storage, data_dir)
+    mask_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = gif_outlines(gif_path)
+    gif_seconds = time.perf_counter() - start
+
+    if reference.shape != union.shape:
+        print(f"✗ GIF frames are {reference.shape}, masks are {union.shape}")
+        return 1
+    differ = int((reference != union).sum())
+    print(f"  {condition}/{channel}: GIF decoding {gif_seconds:.2f}s, masks {mask_seconds:.2f}s "
+          f"({gif_seconds / max(mask_seconds, 1e-9):.1f}x)")
+    print(f"  {int(union.sum())} outline pixels from masks, {int(reference.sum())} from the GIF, {differ} differ")
+    print("✓ Outlines are identical" if not differ else f"✗ {differ} pixels differ")
+    return differ
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Union-of-outlines overlays from label masks")
+    parser.add_argument('command', nargs='?', default='build', choices=['build', 'compare'])
+    parser.add_argument('--conditions', nargs='*', help='Conditions (default: all found)')
+    parser.add_argument('--channels', nargs='*', default=CHANNELS, choices=CHANNELS)
+    parser.add_argument('--background', help='Projection filename to draw on (default: first of each sequence)')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--overlays-dir', default=OVERLAYS_DIR)
+    parser.add_argument('--storage', default=STORAGE, choices=['tiff', 'zarr'])
+    parser.add_argument('--workers', type=int, help='Worker processes (default: SMFISH_CORES or all cores)')
+    parser.add_argument('--gif', help='Segmentation GIF for compare (default: results/plots/<condition>_<channel>_segmentation.gif)')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        from animation_encoder import animation_path
+        differ = 0
+        conditions = args.conditions or ImageSource(args.storage, args.data_dir).conditions('CH0')
+        for condition in conditions:
+            for channel in args.channels:
+                gif_path = args.gif or animation_path(condition, channel)
+                if not os.path.exists(gif_path):
+                    print(f"  - {condition}/{channel}: no GIF at {gif_path}")
+                    continue
+                differ += compare(condition, channel, gif_path, args.storage, args.data_dir)
+        raise SystemExit(1 if differ else 0)
+
+    print("Building outline overlays...")
+    start = time.perf_counter()
+    unions = build_overlays(args.conditions, args.channels, args.background, args.storage, args.data_dir,
+                            args.overlays_dir, args.workers)
+    print(f"\n{len(unions)} overlays in {time.perf_counter() - start:.1f}s, saved to: {args.overlays_dir}")
+
+
+if __name__ == "__main__":
+    main()
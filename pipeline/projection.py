@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Streaming Multi-Channel Z-Projection
+
+Computes the maximum intensity projection of every channel of a raw
+(Z, C, Y, X) stack in a single pass over the file. Planes are read one at a
+time (or through a memory map for uncompressed, contiguous files) and folded
+into a running maximum per channel, so peak memory stays at about one plane
+per channel whatever the Z depth.
+
+Each projection is smoothed and saved exactly as `preprocess_and_save()` in
+1_data_preprocessing.ipynb does, into data/processed/<condition>/CH<c>/.
+
+Stacks saved without axes metadata show up in tifffile as 'QQYX'; a 4D
+series without a C axis is read as ZCYX, the layout of the raw data.
+
+Usage:
+    python projection.py                              # All conditions under data/raw
+    python projection.py --conditions DMSO JQ1 --sigma 1.0
+    python projection.py --raw-dir /path/to/raw --processed-dir /path/to/processed
+    python projection.py check                        # Projections of tagged and untagged stacks vs numpy
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+import tifffile
+from skimage.filters import gaussian
+
+from instrumentation import measure, tiff_write
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RAW_DATA_DIR = os.path.join(BASE_DIR, "data", "raw")
+PROCESSED_DATA_DIR = os.path.join(BASE_DIR, "data", "processed")
+
+
+def plane_channels(series):
+    """
+    Channel index of each YX plane of a series, in file order.
+
+    Without a C axis a 4D series is taken as ZCYX (untagged files report
+    'QQYX'), a 3D one as a single channel.
+    """
+    axes = series.axes.upper()
+    if not axes.endswith('YX'):
+        raise ValueError(f"Expected planes ending in YX, got axes '{series.axes}'")
+    plane_axes = axes[:-2]
+    plane_shape = series.shape[:len(plane_axes)]
+    n_planes = int(np.prod(plane_shape, dtype=np.int64))
+    if 'C' in plane_axes:
+        channel_axis = plane_axes.index('C')
+    elif len(plane_axes) == 2:
+        channel_axis = 1
+    elif len(plane_axes) <= 1:
+        return np.zeros(n_planes, dtype=int)
+    else:
+        raise ValueError(f"Cannot tell the channel axis of a series with axes '{series.axes}'")
+    index = np.unravel_index(np.arange(n_planes), plane_shape)
+    return index[channel_axis]
+
+
+def iter_planes(tif, series_index=0):
+    """Yield (channel, plane) for every YX plane, reading one plane at a time."""
+    series = tif.series[series_index]
+    channels = plane_channels(series)
+    height, width = series.shape[-2:]
+
+    if series.dataoffset is not None and not series.keyframe.is_tiled:
+        # Uncompressed, contiguous data: view the planes through a read-only memory map
+        planes = tifffile.memmap(tif.filehandle.path, series=series_index, mode='r')
+        planes = planes.reshape(len(channels), height, width)
+        for channel, plane in zip(channels, planes):
+            yield int(channel), plane
+        return
+
+    pages = series.pages
+    if len(pages) == len(channels):
+        for channel, page in zip(channels, pages):
+            yield int(channel), page.asarray()
+        return
+
+    # Pages hold more than one plane (e.g. samples stored per page): read page by page
+    per_page = len(channels) // len(pages)
+    for i, page in enumerate(pages):
+        data = page.asarray().reshape(per_page, height, width)
+        for j in range(per_page):
+            yield int(channels[i * per_page + j]), data[j]
+
+
+def max_project_channels(image_path):
+    """
+    Maximum intensity projection of every channel from one read of the file.
+
+    Returns an array of shape (C, Y, X) with the source dtype.
+    """
+    with tifffile.TiffFile(image_path) as tif:
+        projections = None
+        seen = None
+        for channel, plane in iter_planes(tif):
+            if projections is None:
+                n_channels = int(plane_channels(tif.series[0]).max()) + 1
+                projections = np.zeros((n_channels, *plane.shape), dtype=plane.dtype)
+                seen = np.zeros(n_channels, dtype=bool)
+            if seen[channel]:
+                np.maximum(projections[channel], plane, out=projections[channel])
+            else:
+                projections[channel] = plane
+                seen[channel] = True
+    return projections
+
+
+def smooth_projection(projection_2d, dtype, sigma=1.0):
+    """Gaussian-smooth a projection and rescale it to `dtype` as preprocess_and_save() does."""
+    smoothed_projection = gaussian(projection_2d, sigma=sigma)
+    if np.issubdtype(dtype, np.integer):
+        max_val = np.iinfo(dtype).max
+        return (smoothed_projection * max_val).astype(dtype)
+    return smoothed_projection
+
+
+def projection_filename(filename, channel_index):
+    """Output name used throughout the pipeline, e.g. X.tif -> X_ch1_projection.tif."""
+    return filename.replace('.tif', f'_ch{channel_index}_projection.tif')
+
+
+def project_file(input_path, output_root, sigma=1.0, channels=None):
+    """
+    Project and save every channel (or `channels`) of one raw stack.
+
+    Files land in <output_root>/CH<c>/. Returns the written paths.
+    """
+    filename = os.path.basename(input_path)
+    with measure('projection', image=filename):
+        projections = max_project_channels(input_path)
+    written = []
+    for channel_index in range(projections.shape[0]):
+        if channels is not None and channel_index not in channels:
+            continue
+        output_dir = os.path.join(output_root, f"CH{channel_index}")
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = os.path.join(output_dir, projection_filename(filename, channel_index))
+        tiff_write(output_path, smooth_projection(projections[channel_index], projections.dtype, sigma))
+        written.append(output_path)
+    return written
+
+
+def project_condition(condition_folder, output_root, sigma=1.0, channels=None):
+    """Project all raw stacks of one condition folder, every channel from a single read."""
+    print(f"\n--- Starting batch processing for: {os.path.basename(condition_folder)} ---")
+
+    image_files = sorted(f for f in os.listdir(condition_folder) if f.endswith(('.tif', '.tiff')))
+    if not image_files:
+        print("No images found to process.")
+        return
+
+    for filename in image_files:
+        try:
+            written = project_file(os.path.join(condition_folder, filename), output_root, sigma, channels)
+            names = ', '.join(os.path.basename(p) for p in written)
+            print(f"  - Processed and saved: {names}")
+        except Exception as e:
+            print(f"  - Failed to process {filename}: {e}")
+
+    print("--- Batch processing complete. ---")
+
+
+def check(work_dir=None):
+    """
+    Project small ZCYX stacks written with and without axes metadata (plain,
+    zlib-compressed and tiled) and compare with `stack.max(axis=0)`.
+
+    Returns True when every projection matches.
+    """
+    import tempfile
+
+    stack = np.random.default_rng(0).integers(0, 4096, size=(7, 2, 64, 48), dtype=np.uint16)
+    variants = {
+        'imagej': {'imagej': True, 'metadata': {'axes': 'ZCYX'}},
+        'untagged': {},
+        'untagged_zlib': {'compression': 'zlib'},
+        'untagged_tiled': {'tile': (32, 32)},
+    }
+    ok = True
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        for name, kwargs in variants.items():
+            path = os.path.join(tmp, f"{name}.tif")
+            tifffile.imwrite(path, stack, **kwargs)
+            with tifffile.TiffFile(path) as tif:
+                axes = tif.series[0].axes
+            projections = max_project_channels(path)
+            same = projections.shape == (2, 64, 48) and np.array_equal(projections, stack.max(axis=0))
+            ok &= same
+            print(f"{'✓' if same else '✗'} {name} (axes {axes}): projection shape {projections.shape}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Single-read multi-channel Z-projection of raw stacks")
+    parser.add_argument('command', nargs='?', choices=['project', 'check'], default='project')
+    parser.add_argument('--raw-dir', default=RAW_DATA_DIR, help='Folder with one sub-folder per condition')
+    parser.add_argument('--processed-dir', default=PROCESSED_DATA_DIR, help='Output root for projections')
+    parser.add_argument('--conditions', nargs='*', help='Conditions to process (default: all found)')
+    parser.add_argument('--channels', nargs='*', type=int, help='Channels to save (default: all)')
+    parser.add_argument('--sigma', type=float, default=1.0, help='Gaussian smoothing sigma')
+    args = parser.parse_args()
+
+    if args.command == 'check':
+        if not check():
+            sys.exit(1)
+        return
+
+    conditions = args.conditions or sorted(
+        d for d in os.listdir(args.raw_dir) if os.path.isdir(os.path.join(args.raw_dir, d)))
+    for condition in conditions:
+        project_condition(os.path.join(args.raw_dir, condition),
+                          os.path.join(args.processed_dir, condition),
+                          sigma=args.sigma, channels=args.channels)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Partitioned Columnar Results Store
+
+8_blob_detection.ipynb appends each image's rows as soon as the image is
+done, instead of holding every result in memory until one CSV is written at
+the end. Rows go to Parquet files laid out in Hive style, one directory per
+table, condition and run:
+
+    results/store/<table>/condition=<condition>/run=<run_id>/<part>.parquet
+
+Writing the same part again (e.g. re-running one image in the same run)
+replaces it. Readers load only the columns and partitions they ask for,
+by default from the latest run:
+
+    from results_store import ResultsStore, read_table
+    store = ResultsStore(os.path.join(RESULTS_DIR, "store"))
+    store.append('detailed_counts', image_df, part=filename)
+    df = read_table(store.root, 'detailed_counts', columns=['condition', 'total_count'])
+
+The CSV tables in results/tables are still exported at the end of a run for
+compatibility (`export_csv`).
+
+Usage:
+    python results_store.py list
+    python results_store.py export detailed_counts results/tables/final_detailed_counts.csv
+    python results_store.py export cell_counts cells.csv --conditions DMSO --runs all
+"""
+
+import os
+import time
+import argparse
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STORE_DIR = os.path.join(BASE_DIR, "results", "store")
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+        import pyarrow.dataset  # noqa: F401
+    except ImportError:
+        raise ImportError("The results store needs pyarrow: pip install pyarrow") from None
+
+
+def new_run_id():
+    """Run identifier: SMFISH_RUN_ID if set, otherwise the start time."""
+    return os.environ.get("SMFISH_RUN_ID") or time.strftime("%Y%m%d-%H%M%S")
+
+
+def _part_name(part):
+    return os.path.splitext(os.path.basename(str(part)))[0] + ".parquet"
+
+
+class ResultsStore:
+    """Appends DataFrames to Parquet partitions of one run as they are produced."""
+
+    def __init__(self, root=STORE_DIR, run_id=None):
+        _require_pyarrow()
+        self.root = root
+        self.run_id = run_id or new_run_id()
+        self._parts = 0
+
+    def partition_dir(self, table, condition):
+        return os.path.join(self.root, table, f"condition={condition}", f"run={self.run_id}")
+
+    def append(self, table, df, part=None):
+        """
+        Write the rows of `df` (which must have a 'condition' column) to `table`.
+
+        `part` names the file inside each partition, usually the image filename;
+        without it every call writes a new numbered part.
+        """
+        if 'condition' not in df.columns:
+            raise ValueError(f"Rows for '{table}' need a 'condition' column")
+        if part is None:
+            self._parts += 1
+            part = f"part-{os.getpid()}-{self._parts:06d}"
+        for condition, rows in df.groupby('condition', sort=False):
+            directory = self.partition_dir(table, condition)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, _part_name(part))
+            # Partition values live in the directory names, not in the files
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            rows.drop(columns=['condition']).to_parquet(temp_path, index=False, engine='pyarrow')
+            os.replace(temp_path, path)
+
+
+def list_runs(root, table):
+    """Run ids present for `table`, oldest first."""
+    table_dir = os.path.join(root, table)
+    if not os.path.isdir(table_dir):
+        return []
+    runs = set()
+    for condition_dir in os.listdir(table_dir):
+        if condition_dir.startswith('condition='):
+            runs.update(d[len('run='):] for d in os.listdir(os.path.join(table_dir, condition_dir))
+                        if d.startswith('run='))
+    return sorted(runs)
+
+
+def read_table(root, table, columns=None, conditions=None, runs=None):
+    """
+    Load `table` as a DataFrame with only the requested columns and partitions.
+
+    `runs=None` reads the latest run, `runs='all'` every run, or pass a list.
+    'condition' and 'run' are available as columns like any other.
+    """
+    _require_pyarrow()
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    table_dir = os.path.join(root, table)
+    if not os.path.isdir(table_dir):
+        raise FileNotFoundError(f"No '{table}' table in {root}")
+    if runs is None:
+        runs = list_runs(root, table)[-1:]
+    dataset = ds.dataset(table_dir, format='parquet', partitioning='hive',
+                         exclude_invalid_files=True, ignore_prefixes=['.', '_'])
+
+    # Partition values are strings, whatever they look like
+    expression = None
+    if runs != 'all':
+        expression = ds.field('run').cast('string').isin([str(r) for r in runs])
+    if conditions:
+        condition_filter = ds.field('condition').cast('string').isin([str(c) for c in conditions])
+        expression = condition_filter if expression is None else expression & condition_filter
+
+    # Parts written separately can disagree on a column type (0 vs 0.5); widen to a common one
+    fragments = [fragment.physical_schema for fragment in dataset.get_fragments(filter=expression)]
+    schema = pa.unify_schemas([dataset.schema] + fragments, promote_options='permissive')
+    dataset = ds.dataset(table_dir, schema=schema, format='parquet', partitioning='hive',
+                         exclude_invalid_files=True, ignore_prefixes=['.', '_'])
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    for column in ('condition', 'run'):
+        if column in df.columns:
+            df[column] = df[column].astype(str)
+    return df
+
+
+def export_csv(root, table, path, columns=None, conditions=None, runs=None, sort_by=None):
+    """Write a table (default: latest run) to a CSV file, 'condition' first."""
+    df = read_table(root, table, columns=columns, conditions=conditions, runs=runs)
+    if columns is None:
+        df = df.drop(columns=['run'])
+        df = df[['condition'] + [c for c in df.columns if c != 'condition']]
+    if sort_by:
+        df = df.sort_values(sort_by, kind='stable').reset_index(drop=True)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    df.to_csv(path, index=False)
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Partitioned Parquet results store")
+    parser.add_argument('--root', default=STORE_DIR, help='Store directory')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('list', help='Tables and runs in the store')
+    export = subparsers.add_parser('export', help='Export a table to CSV')
+    export.add_argument('table')
+    export.add_argument('output')
+    export.add_argument('--columns', nargs='*')
+    export.add_argument('--conditions', nargs='*')
+    export.add_argument('--runs', nargs='*', help="Run ids, or 'all' (default: latest)")
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        if not os.path.isdir(args.root):
+            print(f"No results store at {args.root}")
+            return
+        for table in sorted(os.listdir(args.root)):
+            runs = list_runs(args.root, table)
+            print(f"  {table:<20} {len(runs)} runs, latest: {runs[-1] if runs else '-'}")
+    elif args.command == 'export':
+        runs = 'all' if args.runs == ['all'] else (args.runs or None)
+        df = export_csv(args.root, args.table, args.output, args.columns, args.conditions, runs,
+                        sort_by=['condition'] if 'condition' in (args.columns or ['condition']) else None)
+        print(f"✓ {len(df)} rows of {args.table} saved to {args.output}")
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,15 +10,29 @@ Usage:
     python run_pipeline.py --stage preprocessing    # Run specific stage
     python run_pipeline.py --stage segmentation     # Run specific stage
     python run_pipeline.py --list                   # List available stages
+    python run_pipeline.py --all --jobs 8           # Run independent notebooks concurrently
+    python run_pipeline.py --all --incremental      # Skip notebooks whose inputs are unchanged
+    python run_pipeline.py --all --dry-run          # Report what an incremental run would redo
+    python run_pipeline.py --all --engine warm      # Run notebooks in a persistent warm worker
+    python run_pipeline.py --all --profile          # Per-image/per-stage timing report in results/profiles
 
 Author: Integrated from original notebooks by John Lee Arboleda
 """
 
 import os
 import sys
+import time
 import argparse
+import threading
 import subprocess
 from pathlib import Path
+from collections import deque
+
+import incremental
+from instrumentation import PROFILES_DIR, record, write_report, print_report
+from results_store import new_run_id
+from scheduler import build_dag, topological_order, run_dag, print_plan
+from warm_worker import WarmWorker
 
 # Define pipeline stages and their notebooks
 PIPELINE_STAGES = {
@@ -42,6 +56,7 @@ PIPELINE_STAGES = {
         '02_segmentation/5_complete_segmentation.ipynb'
     ],
     'analysis': [
+        '05_analysis/cell_nucleus_matching.ipynb',
         '05_analysis/8_blob_detection.ipynb',
         '05_analysis/9_stats.ipynb'
     ],
@@ -63,32 +78,312 @@ COMPLETE_PIPELINE = [
     'utilities'
 ]
 
-def run_notebook(notebook_path):
-    """Run a Jupyter notebook using nbconvert."""
+# Data artifacts exchanged between notebooks (paths relative to the pipeline directory)
+ARTIFACTS = {
+    'raw_stacks': 'data/raw',
+    'projections_ch0': 'data/processed/*/CH0',
+    'projections_ch1': 'data/processed/*/CH1',
+    'initial_masks_ch0': 'data/processed/*/CH0_masks',
+    'initial_masks_ch1': 'data/processed/*/CH1_masks',
+    'training_fish': 'data/training/images/fish',
+    'training_fish_denoised': 'data/training/images/fish_denoised',
+    'training_fish_enhanced': 'data/training/images/fish_enhanced',
+    'training_nucleus': 'data/training/images/nucleus',
+    'training_nucleus_binary': 'data/training/images/nucleus_binary',
+    'training_labels_fish': 'data/training/labels/fish',
+    'training_labels_nucleus': 'data/training/labels/nucleus',
+    'models': 'models',
+    'final_masks_ch0': 'data/final_masks/*/CH0_masks',
+    'final_masks_ch1': 'data/final_masks/*/CH1_masks',
+    'detailed_counts': 'results/tables/final_detailed_counts.csv',
+    'cell_counts': 'results/tables/final_cell_counts.csv',
+    'spot_table': 'results/tables/final_spots.csv',
+    'results_store': 'results/store',
+    'condition_stats': 'results/tables/condition_stats.csv',
+    'cell_nucleus_cells': 'results/tables/cell_nucleus_cells.csv',
+    'cell_nucleus_nuclei': 'results/tables/cell_nucleus_nuclei.csv',
+    'gif_frames': 'results/gif_frames',
+    'segmentation_gifs': 'results/plots',
+    'outline_overlays': 'results/plots/overlays',
+    'validation_cell': 'results/tables/validation/cell_*.csv',
+    'validation_nucleus': 'results/tables/validation/nucleus_*.csv',
+}
+
+# Scheduler nodes: what each notebook reads and writes, and how many cores it
+# keeps busy. Notebooks that process both channels are split into one node per
+# channel through SMFISH_CHANNELS so the halves can run side by side.
+PIPELINE_NODES = {
+    'data_preprocessing': {
+        'notebook': '01_preprocessing/1_data_preprocessing.ipynb',
+        'inputs': ['raw_stacks'],
+        'outputs': ['projections_ch0', 'projections_ch1'],
+        'cores': 8,
+    },
+    'denoising_fish': {
+        'notebook': '01_preprocessing/denoising_fish.ipynb',
+        'inputs': ['training_fish'],
+        'outputs': ['training_fish_denoised'],
+        'cores': 8,
+    },
+    'preprocess_for_training': {
+        'notebook': '01_preprocessing/preprocess_for_training.ipynb',
+        'inputs': ['training_fish'],
+        'outputs': ['training_fish_enhanced'],
+        'cores': 8,
+    },
+    'segmentation_ch0': {
+        'notebook': '02_segmentation/2_segmentation.ipynb',
+        'env': {'SMFISH_CHANNELS': 'CH0'},
+        'inputs': ['projections_ch0'],
+        'outputs': ['initial_masks_ch0'],
+        'cores': 4,
+    },
+    'segmentation_ch1': {
+        'notebook': '02_segmentation/2_segmentation.ipynb',
+        'env': {'SMFISH_CHANNELS': 'CH1'},
+        'inputs': ['projections_ch1'],
+        'outputs': ['initial_masks_ch1'],
+        'cores': 4,
+    },
+    'binary_nucleus': {
+        'notebook': '02_segmentation/binary_nucleus.ipynb',
+        'inputs': ['training_nucleus'],
+        'outputs': ['training_nucleus_binary'],
+        'cores': 8,
+    },
+    'model_training': {
+        'notebook': '03_training/3_model_training.ipynb',
+        'inputs': ['training_nucleus_binary', 'training_labels_nucleus'],
+        'outputs': ['models'],
+        'cores': 8,
+    },
+    'validation_smfish': {
+        'notebook': '04_validation/4_1_validation_smfish.ipynb',
+        'inputs': ['training_fish', 'training_labels_fish', 'models'],
+        'outputs': ['validation_cell'],
+        'cores': 2,
+    },
+    'validation_nucleus': {
+        'notebook': '04_validation/4_2_validation_nucleus.ipynb',
+        'inputs': ['training_nucleus_binary', 'training_labels_nucleus'],
+        'outputs': ['validation_nucleus'],
+        'cores': 2,
+    },
+    'complete_segmentation_ch0': {
+        'notebook': '02_segmentation/5_complete_segmentation.ipynb',
+        'env': {'SMFISH_CHANNELS': 'CH0'},
+        'inputs': ['projections_ch0'],
+        'outputs': ['final_masks_ch0'],
+        'cores': 4,
+    },
+    'complete_segmentation_ch1': {
+        'notebook': '02_segmentation/5_complete_segmentation.ipynb',
+        'env': {'SMFISH_CHANNELS': 'CH1'},
+        'inputs': ['projections_ch1', 'models'],
+        'outputs': ['final_masks_ch1'],
+        'cores': 4,
+    },
+    'cell_nucleus_matching': {
+        'notebook': '05_analysis/cell_nucleus_matching.ipynb',
+        'inputs': ['projections_ch1', 'final_masks_ch0', 'final_masks_ch1'],
+        'outputs': ['cell_nucleus_cells', 'cell_nucleus_nuclei'],
+        'cores': 4,
+    },
+    'blob_detection': {
+        'notebook': '05_analysis/8_blob_detection.ipynb',
+        # raw_stacks: read directly with SPOT_DETECTOR = "3d"
+        'inputs': ['raw_stacks', 'projections_ch1', 'final_masks_ch0', 'final_masks_ch1'],
+        'outputs': ['detailed_counts', 'cell_counts', 'spot_table', 'results_store'],
+        'cores': 1,
+    },
+    'stats': {
+        'notebook': '05_analysis/9_stats.ipynb',
+        'inputs': ['detailed_counts', 'results_store'],
+        'outputs': ['condition_stats'],
+        'cores': 1,
+    },
+    'generate_outlines': {
+        'notebook': '06_utilities/6_generate_outlines.ipynb',
+        'inputs': ['projections_ch0', 'projections_ch1', 'final_masks_ch0', 'final_masks_ch1'],
+        'outputs': ['gif_frames'],
+        'cores': 4,
+    },
+    'frame_compiler_1': {
+        'notebook': '06_utilities/7_1_frame_compiler.ipynb',
+        'inputs': ['projections_ch0', 'final_masks_ch0'],
+        'outputs': ['segmentation_gifs'],
+        'cores': 2,
+    },
+    'frame_compiler_2': {
+        'notebook': '06_utilities/7_2_frame_compiler.ipynb',
+        'inputs': ['projections_ch0', 'projections_ch1', 'final_masks_ch0', 'final_masks_ch1'],
+        'outputs': ['outline_overlays'],
+        'cores': 4,
+    },
+}
+
+# Notebooks that train a model; the warm worker must hand them a fresh CellposeModel
+MODEL_TRAINING_NOTEBOOKS = {'03_training/3_model_training.ipynb'}
+
+# nbconvert stderr lines kept for the error message of a failed notebook
+STDERR_TAIL_LINES = 40
+
+# Persistent workers used by --engine warm (None means nbconvert)
+_warm_workers = None
+_warm_lock = threading.Condition()
+
+def start_warm_workers(max_workers=1):
+    """Use persistent warm workers instead of nbconvert for every following notebook."""
+    global _warm_workers
+    _warm_workers = {'idle': [], 'all': [], 'max': max(1, max_workers)}
+
+def stop_warm_workers():
+    """Shut down all warm workers."""
+    global _warm_workers
+    if _warm_workers:
+        for worker in _warm_workers['all']:
+            worker.close()
+    _warm_workers = None
+
+def run_notebook_warm(notebook_path, env=None):
+    """Run a notebook in an idle warm worker, starting a new one while under the limit."""
+    with _warm_lock:
+        while not _warm_workers['idle'] and len(_warm_workers['all']) >= _warm_workers['max']:
+            _warm_lock.wait()
+        worker = _warm_workers['idle'].pop() if _warm_workers['idle'] else None
+        if worker is None:
+            # Reserve the slot before the (slow) worker start-up
+            _warm_workers['all'].append(None)
+
+    if worker is None:
+        print("Starting warm worker (importing heavy modules once)...")
+        worker = WarmWorker()
+        with _warm_lock:
+            _warm_workers['all'][_warm_workers['all'].index(None)] = worker
+
+    try:
+        print(f"Running {notebook_path} in warm worker...")
+        ok, error, seconds = worker.run(notebook_path, env=env,
+                                        reuse_models=notebook_path not in MODEL_TRAINING_NOTEBOOKS)
+    finally:
+        with _warm_lock:
+            if worker.is_alive():
+                _warm_workers['idle'].append(worker)
+            else:
+                # A crashed worker is dropped; the next notebook starts a fresh one
+                _warm_workers['all'].remove(worker)
+            _warm_lock.notify()
+
+    if ok:
+        print(f"✓ Successfully completed {notebook_path} ({seconds:.1f}s)")
+    else:
+        print(f"✗ Error running {notebook_path}")
+        print(f"Error: {error}")
+    return ok
+
+def _wait_with_usage(process):
+    """Exit code and rusage (CPU, peak RSS) of a finished child, including the kernel it reaped."""
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage
+
+def run_notebook(notebook_path, env=None, inplace=True):
+    """Run a Jupyter notebook using nbconvert (or a warm worker with --engine warm)."""
+    # Tags the per-image measurements of a profiled run with the notebook they came from
+    env = dict(os.environ if env is None else env, SMFISH_PROFILE_NOTEBOOK=notebook_path)
+    if _warm_workers is not None:
+        return run_notebook_warm(notebook_path, env=env)
     try:
         print(f"Running {notebook_path}...")
         cmd = [
             'jupyter', 'nbconvert', 
             '--to', 'notebook',
             '--execute',
-            '--inplace',
-            notebook_path
         ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            print(f"✓ Successfully completed {notebook_path}")
+        # Channel-split nodes share one notebook, so they must not race on writing it back
+        cmd += ['--inplace'] if inplace else ['--stdout']
+        cmd.append(notebook_path)
+        start = time.perf_counter()
+        # stderr is shown as it arrives instead of after the process exits; stdout only
+        # carries the executed notebook with --stdout, which is not needed
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, env=env)
+        tail = deque(maxlen=STDERR_TAIL_LINES)
+        for line in process.stderr:
+            line = line.rstrip()
+            tail.append(line)
+            print(f"  [{os.path.basename(notebook_path)}] {line}", flush=True)
+        returncode, usage = _wait_with_usage(process)
+        seconds = time.perf_counter() - start
+
+        if usage is not None:
+            record('notebook', seconds, usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024,
+                   notebook=notebook_path, channels=env.get('SMFISH_CHANNELS'),
+                   **({} if returncode == 0 else {'error': f"exit code {returncode}"}))
+        if returncode == 0:
+            print(f"✓ Successfully completed {notebook_path} ({seconds:.1f}s)")
             return True
         else:
             print(f"✗ Error running {notebook_path}")
-            print(f"Error: {result.stderr}")
+            print("Error: " + "\n".join(tail))
             return False
             
     except Exception as e:
         print(f"✗ Exception running {notebook_path}: {e}")
         return False
 
-def run_stage(stage_name):
+def notebook_nodes(notebook):
+    """Scheduler nodes backed by `notebook` (one per channel for split notebooks)."""
+    return {name: node for name, node in PIPELINE_NODES.items() if node['notebook'] == notebook}
+
+def stale_nodes(nodes):
+    """Return {node: reasons} for the nodes that an incremental run has to execute."""
+    manifest = incremental.load_manifest()
+    stale = {}
+    for name, node in nodes.items():
+        current = incremental.node_key(node, ARTIFACTS)
+        previous = manifest.get(name)
+        if previous and previous.get('key') == current['key']:
+            if not incremental.outputs_present(node, ARTIFACTS):
+                stale[name] = ['outputs missing']
+        else:
+            stale[name] = incremental.explain_changes(previous, current)
+    return stale
+
+def run_notebook_incremental(notebook, nodes, env=None, inplace=True):
+    """Run `notebook` unless every node it backs is unchanged, then record the new keys."""
+    keys = {name: incremental.node_key(node, ARTIFACTS) for name, node in nodes.items()}
+    if not incremental.force_enabled() and not stale_nodes(nodes):
+        print(f"↷ Skipping {notebook} (inputs, parameters and code unchanged)")
+        return True
+
+    success = run_notebook(notebook, env=env, inplace=inplace)
+    if success:
+        for name, entry in keys.items():
+            incremental.record_node(name, entry)
+    return success
+
+def dry_run_report(stages):
+    """Print which notebooks an incremental run of `stages` would execute, and why."""
+    nodes = select_nodes(stages)
+    dependencies = build_dag(nodes)
+    stale = stale_nodes(nodes)
+
+    print("=== INCREMENTAL DRY RUN ===")
+    reruns = 0
+    for name in topological_order(dependencies, list(nodes)):
+        rerun_parents = sorted(p for p in dependencies[name] if p in stale)
+        if name not in stale and rerun_parents:
+            stale[name] = [f"upstream {', '.join(rerun_parents)} reruns"]
+        if name in stale:
+            reruns += 1
+            print(f"  ↻ {name:<28} {'; '.join(stale[name])}")
+        else:
+            print(f"  ✓ {name:<28} up to date")
+    print(f"\n{reruns} of {len(nodes)} nodes would run.")
+
+def run_stage(stage_name, use_cache=False):
     """Run all notebooks in a specific stage."""
     if stage_name not in PIPELINE_STAGES:
         print(f"Error: Unknown stage '{stage_name}'")
@@ -102,8 +397,11 @@ def run_stage(stage_name):
         if not os.path.exists(notebook):
             print(f"Warning: Notebook {notebook} not found, skipping...")
             continue
-            
-        success = run_notebook(notebook)
+
+        if use_cache:
+            success = run_notebook_incremental(notebook, notebook_nodes(notebook))
+        else:
+            success = run_notebook(notebook)
         if not success:
             print(f"Pipeline stopped due to error in {notebook}")
             return False
@@ -111,12 +409,12 @@ def run_stage(stage_name):
     print(f"✓ Stage {stage_name} completed successfully")
     return True
 
-def run_complete_pipeline():
+def run_complete_pipeline(use_cache=False):
     """Run the complete pipeline in order."""
     print("=== STARTING COMPLETE smFISH ANALYSIS PIPELINE ===")
     
     for stage in COMPLETE_PIPELINE:
-        success = run_stage(stage)
+        success = run_stage(stage, use_cache=use_cache)
         if not success:
             print(f"\nPipeline failed at stage: {stage}")
             return False
@@ -125,6 +423,50 @@ def run_complete_pipeline():
     print("\nResults can be found in the 'results/' directory")
     return True
 
+def select_nodes(stages):
+    """Return the scheduler nodes whose notebooks belong to the given stages."""
+    notebooks = {nb for stage in stages for nb in PIPELINE_STAGES[stage]}
+    return {name: node for name, node in PIPELINE_NODES.items() if node['notebook'] in notebooks}
+
+def run_scheduled(stages, jobs, use_cache=False):
+    """Run the notebooks of `stages` as a dependency graph within a budget of `jobs` cores."""
+    for stage in stages:
+        if stage not in PIPELINE_STAGES:
+            print(f"Error: Unknown stage '{stage}'")
+            print(f"Available stages: {list(PIPELINE_STAGES.keys())}")
+            return False
+
+    nodes = {}
+    for name, node in select_nodes(stages).items():
+        if not os.path.exists(node['notebook']):
+            print(f"Warning: Notebook {node['notebook']} not found, skipping...")
+            continue
+        nodes[name] = node
+
+    print(f"=== RUNNING {len(nodes)} NOTEBOOK NODES WITH A BUDGET OF {jobs} CORES ===")
+    print_plan(nodes)
+
+    split_notebooks = {n['notebook'] for n in nodes.values() if n.get('env')}
+
+    def run_node(name, node, env):
+        inplace = node['notebook'] not in split_notebooks
+        if use_cache:
+            return run_notebook_incremental(node['notebook'], {name: node}, env=env, inplace=inplace)
+        return run_notebook(node['notebook'], env=env, inplace=inplace)
+
+    status = run_dag(nodes, run_node, jobs=jobs)
+
+    failed = sorted(n for n, s in status.items() if s == 'failed')
+    cancelled = sorted(n for n, s in status.items() if s == 'cancelled')
+    if failed:
+        print(f"\nFailed nodes: {', '.join(failed)}")
+        if cancelled:
+            print(f"Cancelled downstream nodes: {', '.join(cancelled)}")
+        return False
+
+    print("\n🎉 SCHEDULED RUN FINISHED SUCCESSFULLY! 🎉")
+    return True
+
 def list_stages():
     """List all available pipeline stages."""
     print("Available pipeline stages:")
@@ -136,6 +478,8 @@ def list_stages():
             print(f"  - {notebook}")
     
     print(f"\nComplete pipeline order: {' → '.join(COMPLETE_PIPELINE)}")
+    print("\nDependency graph used with --jobs:")
+    print_plan(PIPELINE_NODES)
 
 def main():
     parser = argparse.ArgumentParser(
@@ -147,6 +491,12 @@ Examples:
   python run_pipeline.py --stage preprocessing    # Run preprocessing only
   python run_pipeline.py --stage analysis         # Run analysis only
   python run_pipeline.py --list                   # List all stages
+  python run_pipeline.py --all --jobs 8           # Parallel run on an 8-core budget
+  python run_pipeline.py --all --incremental      # Rerun only what changed
+  python run_pipeline.py --all --dry-run          # Show what would rerun
+  python run_pipeline.py --all --force            # Ignore the cache and rerun everything
+  python run_pipeline.py --all --engine warm      # Reuse one warm worker for all notebooks
+  python run_pipeline.py --all --profile          # Write results/profiles/<run_id>/report.json
         """
     )
     
@@ -156,6 +506,18 @@ Examples:
                        help='Run a specific pipeline stage')
     parser.add_argument('--list', action='store_true',
                        help='List available pipeline stages')
+    parser.add_argument('--jobs', type=int, default=None,
+                       help='Run notebooks as a dependency graph within a budget of N cores')
+    parser.add_argument('--incremental', action='store_true',
+                       help='Skip notebooks and images whose content hash is unchanged')
+    parser.add_argument('--force', action='store_true',
+                       help='Rerun everything, ignoring (but refreshing) the incremental cache')
+    parser.add_argument('--dry-run', action='store_true',
+                       help='Report which notebooks an incremental run would execute')
+    parser.add_argument('--engine', choices=['nbconvert', 'warm'], default='nbconvert',
+                       help='Execute notebooks with nbconvert kernels or a persistent warm worker')
+    parser.add_argument('--profile', action='store_true',
+                       help='Record wall/CPU time and peak RSS per image and stage into a run report')
     
     args = parser.parse_args()
     
@@ -163,12 +525,51 @@ Examples:
     pipeline_dir = Path(__file__).parent
     os.chdir(pipeline_dir)
     
+    if args.force:
+        # Inherited by the notebooks so their per-image checks are bypassed too
+        os.environ['SMFISH_FORCE'] = '1'
+    use_cache = args.incremental or args.force
+    if use_cache:
+        # Turns on the per-image ledgers inside the notebooks
+        os.environ['SMFISH_INCREMENTAL'] = '1'
+
+    profile_dir = None
+    if args.profile:
+        profile_dir = os.path.join(PROFILES_DIR, new_run_id())
+        os.makedirs(profile_dir, exist_ok=True)
+        # Inherited by notebooks, warm workers and their process pools, which record into it
+        os.environ['SMFISH_PROFILE_DIR'] = profile_dir
+
+    if args.engine == 'warm':
+        start_warm_workers(max_workers=args.jobs or 1)
+
+    try:
+        dispatch(args, parser, use_cache)
+    finally:
+        stop_warm_workers()
+        if profile_dir:
+            finish_profile(profile_dir)
+
+def finish_profile(profile_dir):
+    """Write and print the run report of a profiled run."""
+    path, report = write_report(profile_dir)
+    print()
+    print_report(report)
+    print(f"\nRun report saved to {path}")
+    print(f"Compare with an earlier run: python instrumentation.py compare <baseline> {profile_dir}")
+
+def dispatch(args, parser, use_cache):
+    """Run whatever the command-line arguments ask for."""
     if args.list:
         list_stages()
+    elif args.dry_run and (args.all or args.stage):
+        dry_run_report(COMPLETE_PIPELINE if args.all else [args.stage])
+    elif args.jobs and (args.all or args.stage):
+        run_scheduled(COMPLETE_PIPELINE if args.all else [args.stage], args.jobs, use_cache=use_cache)
     elif args.all:
-        run_complete_pipeline()
+        run_complete_pipeline(use_cache=use_cache)
     elif args.stage:
-        run_stage(args.stage)
+        run_stage(args.stage, use_cache=use_cache)
     else:
         parser.print_help()
 
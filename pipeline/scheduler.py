@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Dependency-Graph Scheduler for Pipeline Notebooks
+
+Builds a DAG from the inputs/outputs declared for each pipeline node and runs
+ready nodes concurrently within a core budget. A failing node only cancels the
+nodes downstream of it; independent branches keep running.
+
+A node is a plain dict:
+    {
+        'notebook': '04_validation/4_1_validation_smfish.ipynb',
+        'inputs':   ['training_fish', 'models'],   # artifact names consumed
+        'outputs':  [],                           # artifact names produced
+        'cores':    2,                            # cores reserved while running
+        'env':      {},                           # extra environment variables
+    }
+
+Used by run_pipeline.py when called with --jobs N.
+"""
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def build_dag(nodes):
+    """Return {node: set(upstream nodes)} by matching declared outputs to inputs."""
+    producers = {}
+    for name, node in nodes.items():
+        for artifact in node.get('outputs', []):
+            producers.setdefault(artifact, set()).add(name)
+
+    dependencies = {}
+    for name, node in nodes.items():
+        upstream = set()
+        for artifact in node.get('inputs', []):
+            upstream |= producers.get(artifact, set())
+        upstream.discard(name)
+        dependencies[name] = upstream
+
+    check_acyclic(dependencies)
+    return dependencies
+
+
+def check_acyclic(dependencies):
+    """Raise ValueError if the dependency graph contains a cycle."""
+    remaining = {name: set(upstream) for name, upstream in dependencies.items()}
+    while remaining:
+        ready = [name for name, upstream in remaining.items() if not upstream]
+        if not ready:
+            raise ValueError(f"Dependency cycle between nodes: {sorted(remaining)}")
+        for name in ready:
+            del remaining[name]
+        for upstream in remaining.values():
+            upstream.difference_update(ready)
+
+
+def topological_order(dependencies, priority=None):
+    """Return node names in a valid execution order, ties broken by `priority` order."""
+    priority = priority or sorted(dependencies)
+    rank = {name: i for i, name in enumerate(priority)}
+    done = set()
+    order = []
+    while len(order) < len(dependencies):
+        ready = [n for n in dependencies if n not in done and dependencies[n] <= done]
+        ready.sort(key=lambda n: rank.get(n, len(rank)))
+        order.append(ready[0])
+        done.add(ready[0])
+    return order
+
+
+def downstream_of(name, dependencies):
+    """Return every node that transitively depends on `name`."""
+    dependents = {}
+    for node, upstream in dependencies.items():
+        for parent in upstream:
+            dependents.setdefault(parent, set()).add(node)
+
+    found = set()
+    stack = [name]
+    while stack:
+        for child in dependents.get(stack.pop(), ()):
+            if child not in found:
+                found.add(child)
+                stack.append(child)
+    return found
+
+
+def node_env(node, cores):
+    """Environment for a node: its declared variables plus thread caps matching its core share."""
+    env = dict(os.environ)
+    for var in THREAD_ENV_VARS:
+        env[var] = str(cores)
+    # Read by notebooks that size their own process pools
+    env['SMFISH_CORES'] = str(cores)
+    env.update(node.get('env', {}))
+    return env
+
+
+def run_dag(nodes, run_fn, jobs=1, order=None):
+    """
+    Run `nodes` with `run_fn(name, node, env) -> bool` respecting dependencies.
+
+    At most `jobs` cores are reserved at once; a node asking for more cores than
+    the whole budget is clamped to the budget so it can still run on its own.
+    Returns {node: 'success' | 'failed' | 'cancelled'}.
+    """
+    jobs = max(1, int(jobs))
+    dependencies = build_dag(nodes)
+    order = topological_order(dependencies, order or list(nodes))
+
+    status = {}
+    running = {}
+    free_cores = jobs
+    lock = threading.Lock()
+    start = time.time()
+
+    def cores_for(name):
+        return max(1, min(int(nodes[name].get('cores', 1)), jobs))
+
+    def is_ready(name):
+        return name not in status and name not in running.values() and all(
+            status.get(parent) == 'success' for parent in dependencies[name])
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(status) < len(nodes):
+            # Launch every ready node that fits in the remaining core budget,
+            # in pipeline order so the original stage sequence is the tie-break.
+            for name in order:
+                if not is_ready(name):
+                    continue
+                cores = cores_for(name)
+                if cores > free_cores:
+                    continue
+                free_cores -= cores
+                env = node_env(nodes[name], cores)
+                with lock:
+                    print(f"[{time.time() - start:7.1f}s] ▶ {name} ({cores} cores)")
+                running[executor.submit(run_fn, name, nodes[name], env)] = name
+
+            if not running:
+                # Nothing runnable and nothing in flight: the rest were cancelled upstream.
+                for name in order:
+                    status.setdefault(name, 'cancelled')
+                break
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                free_cores += cores_for(name)
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    print(f"✗ Exception running {name}: {e}")
+                    ok = False
+
+                elapsed = time.time() - start
+                if ok:
+                    status[name] = 'success'
+                    print(f"[{elapsed:7.1f}s] ✓ {name}")
+                else:
+                    status[name] = 'failed'
+                    print(f"[{elapsed:7.1f}s] ✗ {name}")
+                    for child in sorted(downstream_of(name, dependencies)):
+                        if child not in status:
+                            status[child] = 'cancelled'
+                            print(f"           - cancelled {child} (depends on {name})")
+
+    return status
+
+
+def print_plan(nodes, order=None):
+    """Print each node with its upstream dependencies."""
+    dependencies = build_dag(nodes)
+    for name in topological_order(dependencies, order or list(nodes)):
+        upstream = ', '.join(sorted(dependencies[name])) or '-'
+        print(f"  {name:<28} cores={nodes[name].get('cores', 1):<3} after: {upstream}")
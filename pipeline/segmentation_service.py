@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Batched Cellpose Segmentation Service
+
+Loads each Cellpose model once per run and segments lists of images in batches
+instead of calling `model.eval(img)` in a per-image loop. On CPU-only hosts the
+torch intra-op thread count is set to the node's core share (SMFISH_CORES) and
+inter-op threading is turned off, which is where most of the CPU throughput is.
+
+The nucleus pass (CH0, 'nuclei') and the cell pass (CH1, fine-tuned cpsam on
+denoised images) share one driver, `segment_folder`:
+
+    from segmentation_service import SegmentationService, segment_folder
+    service = SegmentationService(batch_size=8)
+    segment_folder(service, input_dir, output_dir, {'model_type': 'nuclei'},
+                   {'channels': [0, 0], 'diameter': None})
+    service.report()
+
+The benchmark measures images/sec for a grid of thread counts and batch sizes,
+to pick the settings for a host:
+
+Usage:
+    python segmentation_service.py run                      # both passes, all conditions
+    python segmentation_service.py run --pass nucleus --batch-size 16 --threads 8
+    python segmentation_service.py benchmark --threads 1 4 8 --batch-sizes 1 4 8 --limit 8
+"""
+
+import os
+import glob
+import time
+import argparse
+
+import numpy as np
+import tifffile
+
+from incremental import load_units, unit_key, unit_is_current, record_unit, save_units
+from instrumentation import measure, tiff_read, tiff_write
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROCESSED_DIR = os.path.join(BASE_DIR, "data", "processed")
+FINAL_MASKS_DIR = os.path.join(BASE_DIR, "data", "final_masks")
+CELL_MODEL_PATH = os.path.join(BASE_DIR, "models", "smfish_cell_model_cpsam")
+
+DEFAULT_BATCH_SIZE = 8
+DENOISING_STRENGTH_FACTOR = 100.0
+
+# Code identity of every per-image mask key (this module and the pipeline modules
+# it imports), whichever driver (notebook, run_pass, stream_folder) made the mask
+SEGMENTATION_CODE = ('segmentation_service',)
+
+# The two passes of 5_complete_segmentation.ipynb
+PASSES = {
+    'nucleus': {
+        'channel': 'CH0',
+        'model': {'model_type': 'nuclei'},
+        'eval': {'channels': [0, 0], 'diameter': None},
+        'denoise': False,
+    },
+    'cell': {
+        'channel': 'CH1',
+        'model': {'pretrained_model': CELL_MODEL_PATH},
+        'eval': {'channels': [0, 0], 'diameter': None},
+        'denoise': True,
+    },
+}
+
+
+def configure_torch_threads(threads=None):
+    """Set torch's intra-op threads to the core share and disable inter-op parallelism."""
+    import torch
+
+    threads = threads or int(os.environ.get("SMFISH_CORES", os.cpu_count()))
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Only allowed before torch runs its first parallel operation
+        pass
+    return threads
+
+
+class SegmentationService:
+    """Holds loaded Cellpose models and runs batched inference with throughput counters."""
+
+    def __init__(self, gpu=True, threads=None, batch_size=DEFAULT_BATCH_SIZE, tile_batch_size=None):
+        self.gpu = gpu
+        self.threads = configure_torch_threads(threads)
+        self.batch_size = max(1, int(batch_size))
+        # Passed to model.eval as batch_size: network tiles per forward pass
+        self.tile_batch_size = tile_batch_size
+        self.models = {}
+        self.stats = {}
+
+    def set_threads(self, threads):
+        """Change the torch thread count, e.g. when denoising workers share the node."""
+        self.threads = configure_torch_threads(threads)
+
+    def model(self, model_type=None, pretrained_model=None):
+        """Load a model on first use and return the same instance afterwards."""
+        from cellpose import models
+        from warm_worker import model_cache_key
+
+        kwargs = {'gpu': self.gpu}
+        if model_type is not None:
+            kwargs['model_type'] = model_type
+        if pretrained_model is not None:
+            kwargs['pretrained_model'] = pretrained_model
+        key = model_cache_key((), kwargs)
+        if key not in self.models:
+            start = time.perf_counter()
+            self.models[key] = models.CellposeModel(**kwargs)
+            print(f"Loaded {pretrained_model or model_type} in {time.perf_counter() - start:.1f}s "
+                  f"({self.threads} torch threads)")
+        return self.models[key]
+
+    def segment(self, images, model_type=None, pretrained_model=None, batch_size=None, **eval_kwargs):
+        """Segment a list of 2D images, `batch_size` images per model.eval call; returns uint16 masks."""
+        model = self.model(model_type, pretrained_model)
+        if self.tile_batch_size:
+            eval_kwargs.setdefault('batch_size', self.tile_batch_size)
+        batch_size = batch_size or self.batch_size
+        name = pretrained_model or model_type
+
+        masks = []
+        for i in range(0, len(images), batch_size):
+            batch = list(images[i:i + batch_size])
+            start = time.perf_counter()
+            with measure('cellpose_eval', items=len(batch), model=os.path.basename(str(name))):
+                batch_masks = model.eval(batch, **eval_kwargs)[0]
+            self._count(name, len(batch), time.perf_counter() - start)
+            masks.extend(np.asarray(m).astype(np.uint16) for m in batch_masks)
+        return masks
+
+    def _count(self, name, images, seconds):
+        stat = self.stats.setdefault(name, {'images': 0, 'seconds': 0.0})
+        stat['images'] += images
+        stat['seconds'] += seconds
+
+    def images_per_second(self, name):
+        stat = self.stats.get(name, {'images': 0, 'seconds': 0.0})
+        return stat['images'] / stat['seconds'] if stat['seconds'] else 0.0
+
+    def report(self):
+        """Print images/sec for every model used."""
+        for name, stat in self.stats.items():
+            print(f"  {os.path.basename(str(name))}: {stat['images']} images in {stat['seconds']:.1f}s "
+                  f"({self.images_per_second(name):.2f} images/sec, batch {self.batch_size}, "
+                  f"{self.threads} threads)")
+
+
+def segment_folder(service, input_dir, output_dir, model, eval_kwargs=None, prepare=None, batch_size=None,
+                   ledger=None, key_paths=(), key_params=None):
+    """
+    Segment every .tif in `input_dir` into `output_dir` (same file names, uint16 masks).
+
+    `model` holds the model_type / pretrained_model arguments and `prepare(image)`
+    runs before inference (e.g. denoising). With a `ledger` name, images whose key
+    (`unit_key(input_path, *key_paths, code=SEGMENTATION_CODE, **key_params)`)
+    is unchanged are skipped.
+    Returns {filename: error_text} for the files that failed.
+    """
+    eval_kwargs = eval_kwargs or {}
+    batch_size = batch_size or service.batch_size
+    os.makedirs(output_dir, exist_ok=True)
+
+    units = load_units(ledger) if ledger else {}
+    pending = []
+    for filename in sorted(f for f in os.listdir(input_dir) if f.endswith('.tif')):
+        input_path = os.path.join(input_dir, filename)
+        output_path = os.path.join(output_dir, filename)
+        key = unit_key(input_path, *key_paths, code=SEGMENTATION_CODE, **(key_params or {})) if ledger else None
+        if ledger and unit_is_current(units, filename, key, output_path):
+            continue
+        pending.append((filename, input_path, output_path, key))
+
+    failures = {}
+    for i in range(0, len(pending), batch_size):
+        batch = []
+        for filename, input_path, output_path, key in pending[i:i + batch_size]:
+            try:
+                image = tiff_read(input_path)
+                with measure('prepare', image=filename):
+                    batch.append((filename, output_path, key, prepare(image) if prepare else image))
+            except Exception as e:
+                print(f"  - FAILED to process {filename}: {e}")
+                failures[filename] = str(e)
+        if not batch:
+            continue
+
+        try:
+            masks = service.segment([item[3] for item in batch], batch_size=len(batch), **model, **eval_kwargs)
+        except Exception:
+            # Retry one at a time so a single bad image does not fail the whole batch
+            masks = []
+            for filename, _, _, image in batch:
+                try:
+                    masks.append(service.segment([image], **model, **eval_kwargs)[0])
+                except Exception as e:
+                    print(f"  - FAILED to process {filename}: {e}")
+                    failures[filename] = str(e)
+                    masks.append(None)
+
+        for (filename, output_path, key, _), mask in zip(batch, masks):
+            if mask is None:
+                continue
+            tiff_write(output_path, mask)
+            if ledger:
+                record_unit(units, filename, key)
+        if ledger:
+            save_units(ledger, units)
+    return failures
+
+
+def run_pass(service, pass_name, conditions=None, processed_dir=PROCESSED_DIR, masks_dir=FINAL_MASKS_DIR,
+             strength=DENOISING_STRENGTH_FACTOR, denoiser='bm3d', incremental=True):
+    """Run the nucleus or cell pass over every condition, as 5_complete_segmentation.ipynb does."""
+    spec = PASSES[pass_name]
+    channel = spec['channel']
+    conditions = conditions or sorted(d for d in os.listdir(processed_dir)
+                                      if os.path.isdir(os.path.join(processed_dir, d)))
+    # Same model and parameters in the key as 5_complete_segmentation.ipynb, so both share its ledgers
+    prepare = None
+    key_paths, key_params = (), {'model': spec['model'].get('model_type')}
+    if spec['denoise']:
+        from denoise_cache import cached_denoise
+        prepare = lambda image: cached_denoise(image, strength, method=denoiser)
+        key_paths = (spec['model']['pretrained_model'],)
+        key_params = {'strength': strength, 'denoiser': denoiser}
+
+    failures = {}
+    for condition in conditions:
+        input_dir = os.path.join(processed_dir, condition, channel)
+        if not os.path.isdir(input_dir):
+            print(f"Warning: Skipping {pass_name} segmentation for {condition}, directory not found.")
+            continue
+        print(f"Processing {pass_name} masks for condition: {condition}")
+        ledger = f"complete_segmentation_{condition}_{channel}" if incremental else None
+        failures.update(segment_folder(service, input_dir, os.path.join(masks_dir, condition, f"{channel}_masks"),
+                                       spec['model'], spec['eval'], prepare=prepare, ledger=ledger,
+                                       key_paths=key_paths, key_params=key_params))
+    return failures
+
+
+def benchmark(image_paths, thread_counts, batch_sizes, pass_name='nucleus'):
+    """Images/sec for each (threads, batch size) combination on the given images."""
+    spec = PASSES[pass_name]
+    images = [tifffile.imread(path) for path in image_paths]
+    if spec['denoise']:
+        from denoise_cache import cached_denoise
+        images = [cached_denoise(image, DENOISING_STRENGTH_FACTOR) for image in images]
+
+    rows = []
+    for threads in thread_counts:
+        for batch_size in batch_sizes:
+            service = SegmentationService(threads=threads, batch_size=batch_size)
+            # Load and run once so model loading and first-call setup are not timed
+            service.segment(images[:1], **spec['model'], **spec['eval'])
+            service.stats.clear()
+            service.segment(images, **spec['model'], **spec['eval'])
+            rate = service.images_per_second(spec['model'].get('pretrained_model') or spec['model']['model_type'])
+            rows.append({'threads': threads, 'batch_size': batch_size, 'images_per_sec': rate})
+            print(f"  threads={threads:<3} batch={batch_size:<3} {rate:6.2f} images/sec")
+
+    best = max(rows, key=lambda r: r['images_per_sec'])
+    print(f"\nBest: {best['threads']} threads, batch size {best['batch_size']} "
+          f"({best['images_per_sec']:.2f} images/sec)")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched Cellpose segmentation service")
+    subparsers = parser.add_subparsers(dest='command')
+
+    run = subparsers.add_parser('run', help='Segment every condition into data/final_masks')
+    run.add_argument('--pass', dest='passes', choices=list(PASSES) + ['both'], default='both')
+    run.add_argument('--conditions', nargs='*', help='Conditions to process (default: all found)')
+    run.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Images per model.eval call')
+    run.add_argument('--threads', type=int, help='Torch intra-op threads (default: SMFISH_CORES or all cores)')
+    run.add_argument('--strength', type=float, default=DENOISING_STRENGTH_FACTOR)
+    run.add_argument('--denoiser', default='bm3d', help='Denoiser backend for the cell pass')
+    run.add_argument('--force', action='store_true', help='Segment images even if unchanged')
+
+    bench = subparsers.add_parser('benchmark', help='Images/sec for thread counts and batch sizes')
+    bench.add_argument('--pass', dest='passes', choices=list(PASSES), default='nucleus')
+    bench.add_argument('--images', nargs='*', help='Images to segment (default: data/processed/*/<channel>)')
+    bench.add_argument('--limit', type=int, default=8, help='Maximum number of images')
+    bench.add_argument('--threads', nargs='*', type=int, default=[1, 2, 4, os.cpu_count()])
+    bench.add_argument('--batch-sizes', nargs='*', type=int, default=[1, 4, DEFAULT_BATCH_SIZE])
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        service = SegmentationService(threads=args.threads, batch_size=args.batch_size)
+        passes = list(PASSES) if args.passes == 'both' else [args.passes]
+        failures = {}
+        for pass_name in passes:
+            print(f"\n--- {pass_name} pass ---")
+            failures.update(run_pass(service, pass_name, args.conditions, strength=args.strength,
+                                     denoiser=args.denoiser, incremental=not args.force))
+        print("\nThroughput:")
+        service.report()
+        print(f"\n✗ {len(failures)} files failed" if failures else "\n✓ Segmentation complete")
+    elif args.command == 'benchmark':
+        channel = PASSES[args.passes]['channel']
+        pattern = os.path.join(PROCESSED_DIR, "*", channel, "*.tif")
+        image_paths = sorted(args.images or glob.glob(pattern))[:args.limit]
+        if not image_paths:
+            print("No images found to benchmark.")
+            return
+        benchmark(image_paths, sorted(set(args.threads)), sorted(set(args.batch_sizes)), args.passes)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
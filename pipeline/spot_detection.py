@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Fast Fixed-Scale Spot Detection
+
+`blob_log(dog_image, min_sigma=0.2, max_sigma=2, threshold=0.08)` builds a
+10-level Laplacian-of-Gaussian scale space, searches it for 3D peaks and then
+prunes overlapping blobs, and it dominates the cost of 8_blob_detection.ipynb.
+`detect_spots` does the same search on a small fixed set of scales with
+float32 filtering, threshold masking and a vectorized 3x3x3 local-maximum test
+(`maximum_filter`, evaluated only at above-threshold voxels when they are
+sparse). It returns the same (y, x, sigma) array as `blob_log`.
+
+    from spot_detection import dog_filter, detect_spots
+    dog_image = dog_filter(fish_image_float, SIGMA_LIGHT_BLUR, SIGMA_HEAVY_BLUR)
+    blobs = detect_spots(dog_image, FAST_SPOT_SIGMAS, BLOB_THRESHOLD)
+
+The comparison runs both detectors on data/processed/*/CH1, matches spots
+within a pixel tolerance and reports speedup, counts, recall and precision.
+It exits with status 1 when the count difference exceeds --max-count-diff, so
+it can gate switching production to the fast detector.
+
+Usage:
+    python spot_detection.py compare --limit 10
+    python spot_detection.py compare --sigmas 0.2 1.0 1.4 1.6 2.0 --max-count-diff 0.02
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+
+import numpy as np
+from scipy import ndimage
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_IMAGES = os.path.join(BASE_DIR, "data", "processed", "*", "CH1", "*.tif")
+
+# Parameters used by 8_blob_detection.ipynb
+SIGMA_LIGHT_BLUR = 1.0
+SIGMA_HEAVY_BLUR = 10.0
+BLOB_MIN_SIGMA = 0.2
+BLOB_MAX_SIGMA = 2
+BLOB_THRESHOLD = 0.08
+NASCENT_SIZE_THRESHOLD = 1.5
+
+# Fixed scales for the fast detector, spanning BLOB_MIN_SIGMA..BLOB_MAX_SIGMA;
+# 1.4 and 1.6 straddle NASCENT_SIZE_THRESHOLD so the size classification matches blob_log
+FAST_SPOT_SIGMAS = (0.2, 0.8, 1.4, 1.6, 2.0)
+
+
+def normalize_image(image):
+    """Min-max scale to [0, 1] as the notebook does."""
+    image = np.asarray(image, dtype=np.float32)
+    low, high = image.min(), image.max()
+    return (image - low) / (high - low) if high > low else np.zeros_like(image)
+
+
+def dog_filter(image_float, sigma_light=SIGMA_LIGHT_BLUR, sigma_heavy=SIGMA_HEAVY_BLUR):
+    """Difference of Gaussians used to flatten the background before spot detection."""
+    image_float = np.asarray(image_float, dtype=np.float32)
+    # mode='nearest' matches skimage.filters.gaussian
+    return (ndimage.gaussian_filter(image_float, sigma_light, mode='nearest')
+            - ndimage.gaussian_filter(image_float, sigma_heavy, mode='nearest'))
+
+
+def log_stack(image, sigmas):
+    """Scale-normalised negative LoG responses, shape (Y, X, len(sigmas)), float32."""
+    image = np.asarray(image, dtype=np.float32)
+    stack = np.empty(image.shape + (len(sigmas),), dtype=np.float32)
+    for i, sigma in enumerate(sigmas):
+        stack[..., i] = ndimage.gaussian_laplace(image, sigma) * (-sigma ** 2)
+    return stack
+
+
+def local_maxima(stack, threshold, dense_fraction=0.1):
+    """
+    Indices of voxels above `threshold` that equal the maximum of their 3x3x3 neighbourhood.
+
+    Usually only a few percent of voxels pass the threshold, so the
+    neighbourhood maximum is gathered for those candidates alone; a full
+    `maximum_filter` pass is used when candidates are dense.
+    """
+    candidates = stack > threshold
+    if candidates.mean() > dense_fraction:
+        local_max = ndimage.maximum_filter(stack, size=3, mode='constant', cval=-np.inf)
+        return np.nonzero(candidates & (stack == local_max))
+
+    padded = np.pad(stack, 1, mode='constant', constant_values=-np.inf)
+    flat = padded.ravel()
+    index = np.ravel_multi_index(tuple(i + 1 for i in np.nonzero(candidates)), padded.shape)
+    strides = np.array(padded.strides) // padded.itemsize
+    offsets = np.array([np.dot(step, strides) for step in np.ndindex(3, 3, 3) if step != (1, 1, 1)]) - strides.sum()
+    neighbours = flat[index[:, None] + offsets[None, :]].max(axis=1)
+    peaks = index[flat[index] >= neighbours]
+    return tuple(i - 1 for i in np.unravel_index(peaks, padded.shape))
+
+
+def disk_overlap(distance, r1, r2):
+    """Fraction of the smaller disk covered by the other one (vectorized over pairs)."""
+    fraction = np.zeros_like(distance)
+    inside = distance <= np.abs(r1 - r2)
+    partial = ~inside & (distance < r1 + r2)
+    fraction[inside] = 1.0
+
+    d, a, b = distance[partial], r1[partial], r2[partial]
+    angle1 = np.arccos(np.clip((d ** 2 + a ** 2 - b ** 2) / (2 * d * a), -1, 1))
+    angle2 = np.arccos(np.clip((d ** 2 + b ** 2 - a ** 2) / (2 * d * b), -1, 1))
+    triangle = 0.5 * np.sqrt(np.clip((-d + a + b) * (d + a - b) * (d - a + b) * (d + a + b), 0, None))
+    area = a ** 2 * angle1 + b ** 2 * angle2 - triangle
+    fraction[partial] = area / (np.pi * np.minimum(a, b) ** 2)
+    return fraction
+
+
+def prune_spots(spots, overlap=0.5):
+    """
+    Drop the smaller spot of every pair overlapping by more than `overlap`, as blob_log does.
+
+    All pairs are resolved at once, so long chains of overlapping spots can
+    differ slightly from blob_log's one-pair-at-a-time pruning.
+    """
+    if len(spots) < 2:
+        return spots
+    from scipy.spatial import cKDTree
+
+    radii = spots[:, 2] * np.sqrt(2)
+    pairs = cKDTree(spots[:, :2]).query_pairs(2 * radii.max(), output_type='ndarray')
+    if len(pairs) == 0:
+        return spots
+    i, j = pairs[:, 0], pairs[:, 1]
+    distance = np.hypot(spots[i, 0] - spots[j, 0], spots[i, 1] - spots[j, 1])
+    overlapping = disk_overlap(distance, radii[i], radii[j]) > overlap
+    # Keep the larger spot; on equal sigma blob_log keeps the second one
+    smaller = np.where(spots[i, 2] > spots[j, 2], j, i)
+    keep = np.ones(len(spots), dtype=bool)
+    keep[smaller[overlapping]] = False
+    return spots[keep]
+
+
+def detect_spots(image, sigmas=FAST_SPOT_SIGMAS, threshold=BLOB_THRESHOLD, overlap=0.5):
+    """
+    Spots as an (N, 3) array of (y, x, sigma), like `skimage.feature.blob_log`.
+
+    A pixel is a spot when its LoG response is above `threshold` and is the
+    maximum of its 3x3 neighbourhood across the neighbouring scales; spots
+    overlapping a larger one by more than `overlap` are then removed.
+    """
+    sigmas = np.asarray(sigmas, dtype=np.float64)
+    y, x, scale = local_maxima(log_stack(image, sigmas), threshold)
+    return prune_spots(np.column_stack([y, x, sigmas[scale]]).astype(np.float64), overlap)
+
+
+def detect_spots_blob_log(image, min_sigma=BLOB_MIN_SIGMA, max_sigma=BLOB_MAX_SIGMA, threshold=BLOB_THRESHOLD):
+    """The reference detector used in production."""
+    from skimage.feature import blob_log
+    return blob_log(image, min_sigma=min_sigma, max_sigma=max_sigma, threshold=threshold)
+
+
+def match_spots(reference, test, tolerance=1.5):
+    """Number of `test` spots within `tolerance` pixels of a distinct `reference` spot."""
+    if len(reference) == 0 or len(test) == 0:
+        return 0
+    from scipy.optimize import linear_sum_assignment
+    from scipy.spatial import cKDTree
+
+    pairs = cKDTree(test[:, :2]).sparse_distance_matrix(cKDTree(reference[:, :2]), tolerance, output_type='coo_matrix')
+    if pairs.nnz == 0:
+        return 0
+    # One-to-one matching among the candidate pairs only
+    rows, row_index = np.unique(pairs.row, return_inverse=True)
+    cols, col_index = np.unique(pairs.col, return_inverse=True)
+    cost = np.full((len(rows), len(cols)), tolerance * 10)
+    cost[row_index, col_index] = pairs.data
+    matched_rows, matched_cols = linear_sum_assignment(cost)
+    return int((cost[matched_rows, matched_cols] <= tolerance).sum())
+
+
+def compare(image_paths, sigmas, threshold, tolerance):
+    """Run both detectors on each image; returns per-image rows."""
+    import tifffile
+
+    rows = []
+    for path in image_paths:
+        dog_image = dog_filter(normalize_image(tifffile.imread(path)))
+
+        start = time.perf_counter()
+        reference = detect_spots_blob_log(dog_image, threshold=threshold)
+        reference_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        fast = detect_spots(dog_image, sigmas, threshold)
+        fast_seconds = time.perf_counter() - start
+
+        matched = match_spots(reference, fast, tolerance)
+        row = {
+            'image': os.path.basename(path),
+            'blob_log_count': len(reference), 'fast_count': len(fast),
+            'count_diff': (len(fast) - len(reference)) / max(len(reference), 1),
+            # Spots large enough to count as nascent sites (before the intensity test)
+            'blob_log_large': int((reference[:, 2] > NASCENT_SIZE_THRESHOLD).sum()) if len(reference) else 0,
+            'fast_large': int((fast[:, 2] > NASCENT_SIZE_THRESHOLD).sum()) if len(fast) else 0,
+            'recall': matched / len(reference) if len(reference) else 1.0,
+            'precision': matched / len(fast) if len(fast) else 1.0,
+            'blob_log_seconds': reference_seconds, 'fast_seconds': fast_seconds,
+            'speedup': reference_seconds / fast_seconds if fast_seconds else float('inf'),
+        }
+        rows.append(row)
+        print(f"  {row['image']}: blob_log={row['blob_log_count']} fast={row['fast_count']} "
+              f"({row['count_diff']:+.1%})  large={row['blob_log_large']}/{row['fast_large']}  recall={row['recall']:.3f} precision={row['precision']:.3f}  "
+              f"{reference_seconds:.2f}s → {fast_seconds:.2f}s ({row['speedup']:.1f}x)")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fast fixed-scale spot detection")
+    subparsers = parser.add_subparsers(dest='command')
+    check = subparsers.add_parser('compare', help='Benchmark and equivalence check against blob_log')
+    check.add_argument('--images', nargs='*', help=f'Images to test (default: {DEFAULT_IMAGES})')
+    check.add_argument('--limit', type=int, default=10, help='Maximum number of images')
+    check.add_argument('--sigmas', nargs='*', type=float, default=list(FAST_SPOT_SIGMAS))
+    check.add_argument('--threshold', type=float, default=BLOB_THRESHOLD)
+    check.add_argument('--tolerance', type=float, default=1.5, help='Matching distance in pixels')
+    check.add_argument('--max-count-diff', type=float, default=0.02,
+                       help='Largest accepted relative difference in total spot count')
+    args = parser.parse_args()
+
+    if args.command != 'compare':
+        parser.print_help()
+        return
+
+    image_paths = sorted(args.images or glob.glob(DEFAULT_IMAGES))[:args.limit]
+    if not image_paths:
+        print("No images found to compare.")
+        return
+    print(f"--- fast detector (sigmas {args.sigmas}) vs blob_log on {len(image_paths)} images ---")
+    rows = compare(image_paths, args.sigmas, args.threshold, args.tolerance)
+
+    reference_total = sum(r['blob_log_count'] for r in rows)
+    fast_total = sum(r['fast_count'] for r in rows)
+    count_diff = (fast_total - reference_total) / max(reference_total, 1)
+    speedup = sum(r['blob_log_seconds'] for r in rows) / max(sum(r['fast_seconds'] for r in rows), 1e-9)
+    print("\n" + "=" * 70)
+    print(f"Total spots: blob_log={reference_total} fast={fast_total} ({count_diff:+.2%})")
+    print(f"Spots with sigma > {NASCENT_SIZE_THRESHOLD}: blob_log={sum(r['blob_log_large'] for r in rows)} "
+          f"fast={sum(r['fast_large'] for r in rows)}")
+    print(f"Mean recall={np.mean([r['recall'] for r in rows]):.3f} "
+          f"precision={np.mean([r['precision'] for r in rows]):.3f}")
+    print(f"Speedup: {speedup:.1f}x")
+
+    if abs(count_diff) > args.max_count_diff:
+        print(f"✗ Count difference above {args.max_count_diff:.1%}")
+        sys.exit(1)
+    print(f"✓ Count difference within {args.max_count_diff:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Native 3D Spot Detection on Raw Z-Stacks
+
+8_blob_detection.ipynb detects spots on the smoothed maximum projection of
+CH1, which merges spots stacked along Z and gives no depth. Running
+`blob_log` on the whole raw stack instead would hold a float64 copy of the
+volume for every scale. `detect_spots_3d` streams the FISH channel plane by
+plane (`projection.iter_planes`) and works on overlapping Z-slabs:
+
+- every plane is normalised with the stack's min/max and background
+  flattened by the notebook's 2D difference of Gaussians (float32)
+- each slab of `slab` planes is read with `halo` extra planes on both sides,
+  enough for the Z support of the Gaussian kernels, and filtered with an
+  anisotropic, scale-normalised LoG: the lateral sigma runs over the spot
+  scales, the axial one stays at the PSF's (the axial PSF is several times
+  wider than the lateral one, so even nascent sites are PSF-limited in Z)
+- spots are the (scale, z, y, x) local maxima above `threshold` whose z lies
+  in the slab's own planes; the halo is only read, so a spot is never found
+  by two slabs
+- spots overlapping a larger one are pruned over the whole stack at the end,
+  which removes duplicates straddling slab boundaries
+
+The result is the same as filtering the whole volume at once. Peak memory is
+about (slab + 2 * halo) * 2 + (slab + 2) * len(sigmas) float32 planes,
+independent of the Z depth, and the LoG of the two planes on either side of
+a slab boundary is computed once and handed to the next slab. Spots come back as (z, y, x, sigma, intensity)
+rows; (y, x, sigma) go through `quantify_cells` against the 2D masks like
+projection spots, and z is kept in the per-spot table.
+
+    from spot_detection_3d import detect_spots_3d, raw_stack_path
+    spots = detect_spots_3d(raw_stack_path(RAW_DIR, condition, filename))
+
+Usage:
+    python spot_detection_3d.py detect --limit 4
+    python spot_detection_3d.py compare --raw-dir /path/to/raw --truth /path/to/synthetic_truth/spots.csv
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+from collections import deque
+
+import numpy as np
+from scipy import ndimage
+
+from projection import iter_planes
+from spot_detection import SIGMA_LIGHT_BLUR, SIGMA_HEAVY_BLUR, NASCENT_SIZE_THRESHOLD, match_spots
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RAW_DATA_DIR = os.path.join(BASE_DIR, "data", "raw")
+
+FISH_CHANNEL = 1
+# Lateral scales in pixels; 1.4 and 1.6 straddle NASCENT_SIZE_THRESHOLD as in the fast 2D detector
+SPOT_SIGMAS_3D = (0.8, 1.4, 1.6, 2.0)
+SPOT_THRESHOLD_3D = 0.02
+# Axial PSF sigma in planes (depends on the Z step and the objective)
+AXIAL_SIGMA = 1.5
+# Gaussian kernels are cut at TRUNCATE sigmas; sets the slab halo
+TRUNCATE = 3.0
+SLAB_PLANES = 4
+
+
+def raw_stack_path(raw_dir, condition, filename, channel=FISH_CHANNEL):
+    """Raw stack a projection was made from, e.g. X_ch1_projection.tif -> <raw_dir>/<condition>/X.tif."""
+    return os.path.join(raw_dir, condition, filename.replace(f'_ch{channel}_projection', ''))
+
+
+def channel_planes(tif, channel=FISH_CHANNEL):
+    """YX planes of one channel in Z order, read one at a time."""
+    for plane_channel, plane in iter_planes(tif):
+        if plane_channel == channel:
+            yield plane
+
+
+def stack_range(path, channel=FISH_CHANNEL):
+    """(min, max, n_planes, plane shape) of one channel, from a streaming pass."""
+    import tifffile
+
+    low, high, n_planes, shape = np.inf, -np.inf, 0, None
+    with tifffile.TiffFile(path) as tif:
+        for plane in channel_planes(tif, channel):
+            low = min(low, float(plane.min()))
+            high = max(high, float(plane.max()))
+            n_planes += 1
+            shape = plane.shape
+    if not n_planes:
+        raise ValueError(f"No planes for channel {channel} in {os.path.basename(path)}")
+    return low, high, n_planes, shape
+
+
+def prepare_plane(plane, low, high, sigma_light=SIGMA_LIGHT_BLUR, sigma_heavy=SIGMA_HEAVY_BLUR):
+    """(light-blurred, DoG) float32 planes of a raw plane normalised with the stack's `low`..`high`."""
+    plane = np.asarray(plane, dtype=np.float32)
+    if high > low:
+        plane = (plane - np.float32(low)) / np.float32(high - low)
+    else:
+        plane = np.zeros_like(plane)
+    # mode='nearest' matches skimage.filters.gaussian, as spot_detection.dog_filter
+    light = ndimage.gaussian_filter(plane, sigma_light, mode='nearest')
+    return light, light - ndimage.gaussian_filter(plane, sigma_heavy, mode='nearest')
+
+
+def slab_halo(axial_sigma=AXIAL_SIGMA, truncate=TRUNCATE):
+    """Planes read beyond each side of a slab: the Z kernel half-width plus one for the peak test."""
+    return int(truncate * axial_sigma + 0.5) + 1
+
+
+def log_planes(volume, sigma, axial_sigma=AXIAL_SIGMA, truncate=TRUNCATE, start=0, stop=None):
+    """
+    Scale-normalised negative anisotropic LoG of planes `start`..`stop` of a (Z, Y, X) float32 volume.
+
+    The Z derivative is weighted by axial_sigma**2 and the lateral ones by
+    sigma**2. Z filtering reads the requested planes plus the kernel
+    half-width around them; the lateral filters run on the requested planes only.
+    """
+    stop = len(volume) if stop is None else stop
+    radius = slab_halo(axial_sigma, truncate) - 1
+    first, last = max(start - radius, 0), min(stop + radius, len(volume))
+    smooth_z, curve_z = (ndimage.gaussian_filter1d(volume[first:last], axial_sigma, axis=0, order=order, mode='nearest',
+                                                   truncate=truncate)[start - first:stop - first] for order in (0, 2))
+    response = np.empty(smooth_z.shape, dtype=np.float32)
+    for i in range(len(response)):
+        lateral = sum(ndimage.gaussian_filter(smooth_z[i], sigma, order=order, mode='nearest', truncate=truncate)
+                      for order in ((2, 0), (0, 2)))
+        axial = ndimage.gaussian_filter(curve_z[i], sigma, mode='nearest', truncate=truncate)
+        response[i] = -(sigma ** 2 * lateral + axial_sigma ** 2 * axial)
+    return response
+
+
+def local_maxima_4d(stack, threshold, start, stop):
+    """
+    (scale, z, y, x) indices of voxels in planes `start`..`stop` of a (S, Z, Y, X)
+    stack that are above `threshold` and the maximum of their 3x3x3x3 neighbourhood.
+
+    Neighbours outside the stack count as -inf, as in spot_detection.local_maxima.
+    """
+    index = np.nonzero(stack[:, start:stop] > threshold)
+    index = (index[0], index[1] + start, index[2], index[3])
+    values = stack[index]
+    neighbours = np.full(len(values), -np.inf, dtype=np.float32)
+    shape = np.array(stack.shape)
+    coords = np.stack(index)
+    for step in np.ndindex(3, 3, 3, 3):
+        if step == (1, 1, 1, 1):
+            continue
+        shifted = coords + (np.array(step) - 1)[:, None]
+        valid = np.all((shifted >= 0) & (shifted < shape[:, None]), axis=0)
+        clipped = tuple(np.clip(shifted, 0, shape[:, None] - 1))
+        np.maximum(neighbours, np.where(valid, stack[clipped], -np.inf), out=neighbours)
+    peaks = values >= neighbours
+    return tuple(i[peaks] for i in index)
+
+
+def sphere_overlap(distance, r1, r2):
+    """Fraction of the smaller sphere's volume covered by the other one (vectorized over pairs)."""
+    fraction = np.zeros_like(distance)
+    inside = distance <= np.abs(r1 - r2)
+    partial = ~inside & (distance < r1 + r2)
+    fraction[inside] = 1.0
+
+    d, a, b = distance[partial], r1[partial], r2[partial]
+    lens = np.pi * (a + b - d) ** 2 * (d ** 2 + 2 * d * (a + b) - 3 * (a - b) ** 2) / (12 * d)
+    fraction[partial] = lens / (4 / 3 * np.pi * np.minimum(a, b) ** 3)
+    return fraction
+
+
+def prune_spots_3d(spots, overlap=0.5):
+    """
+    Drop the smaller spot of every pair overlapping by more than `overlap`.
+
+    `spots` are (z, y, x, sigma, intensity, response) rows, each a sphere of
+    radius sigma * sqrt(3) in voxels, as blob_log uses in 3D. Equal sigmas
+    keep the stronger spot, or else the later one.
+    """
+    if len(spots) < 2:
+        return spots
+    from scipy.spatial import cKDTree
+
+    points = spots[:, :3]
+    radii = spots[:, 3] * np.sqrt(3)
+    pairs = cKDTree(points).query_pairs(2 * radii.max(), output_type='ndarray')
+    if len(pairs) == 0:
+        return spots
+    i, j = pairs[:, 0], pairs[:, 1]
+    distance = np.linalg.norm(points[i] - points[j], axis=1)
+    overlapping = sphere_overlap(distance, radii[i], radii[j]) > overlap
+    i_smaller = (spots[i, 3] < spots[j, 3]) | ((spots[i, 3] == spots[j, 3]) & (spots[i, 5] <= spots[j, 5]))
+    smaller = np.where(i_smaller, i, j)
+    keep = np.ones(len(spots), dtype=bool)
+    keep[smaller[overlapping]] = False
+    return spots[keep]
+
+
+def detect_slab(volume, light, sigmas, threshold, start, stop, z_offset, axial_sigma=AXIAL_SIGMA, truncate=TRUNCATE,
+                carry=None):
+    """
+    Spots whose z is in planes `start`..`stop` of a slab, as (z, y, x, sigma, intensity, response) rows.
+
+    `volume` holds the slab's DoG planes with their halo and `light` the
+    matching light-blurred planes; `z_offset` is the stack index of plane 0.
+    `carry` is the LoG of planes start - 1 and start, computed by the previous
+    slab. Returns (spots, carry for the next slab).
+    """
+    low, high = max(start - 1, 0), min(stop + 1, len(volume))
+    computed_from = low if carry is None else low + 2
+    stack = np.stack([log_planes(volume, sigma, axial_sigma, truncate, computed_from, high) for sigma in sigmas])
+    if carry is not None:
+        stack = np.concatenate([carry, stack], axis=1)
+    scale, z, y, x = local_maxima_4d(stack, threshold, start - low, stop - low)
+    response = stack[scale, z, y, x]
+    z = z + low
+    intensity = np.array([light[plane][row, column] for plane, row, column in zip(z, y, x)], dtype=np.float64)
+    spots = np.column_stack([z + z_offset, y, x, np.asarray(sigmas, dtype=np.float64)[scale],
+                             intensity, response]).astype(np.float64).reshape(-1, 6)
+    return spots, stack[:, -2:].copy()
+
+
+def detect_spots_3d(path, channel=FISH_CHANNEL, sigmas=SPOT_SIGMAS_3D, threshold=SPOT_THRESHOLD_3D,
+                    axial_sigma=AXIAL_SIGMA, slab=SLAB_PLANES, truncate=TRUNCATE, overlap=0.5):
+    """
+    3D spots of one channel of a raw stack as an (N, 5) array of (z, y, x, sigma, intensity).
+
+    sigma is the lateral scale in pixels, comparable with the 2D detectors;
+    intensity is the light-blurred, min/max-normalised value at the spot.
+    The stack is read twice: once for its intensity range and once slab by
+    slab. `slab=None` filters the whole stack at once (the reference).
+    """
+    import tifffile
+
+    low, high, n_planes, _ = stack_range(path, channel)
+    slab = slab or n_planes
+    halo = slab_halo(axial_sigma, truncate)
+    found = []
+    with tifffile.TiffFile(path) as tif:
+        planes = channel_planes(tif, channel)
+        # (z, light, dog) of the planes the current slab can still need
+        window = deque()
+        next_z, carry = 0, None
+        for core_start in range(0, n_planes, slab):
+            core_stop = min(core_start + slab, n_planes)
+            first, last = max(core_start - halo, 0), min(core_stop + halo, n_planes)
+            while window and window[0][0] < first:
+                window.popleft()
+            while next_z < last:
+                window.append((next_z, *prepare_plane(next(planes), low, high)))
+                next_z += 1
+            volume = np.stack([dog for _, _, dog in window])
+            light = [plane for _, plane, _ in window]
+            spots, carry = detect_slab(volume, light, sigmas, threshold, core_start - first, core_stop - first,
+                                       first, axial_sigma, truncate, carry)
+            found.append(spots)
+    spots = np.concatenate(found) if found else np.empty((0, 6))
+    return prune_spots_3d(spots, overlap)[:, :5]
+
+
+def spot_columns(spots):
+    """(blobs, z, intensities): (y, x, sigma) for `quantify_cells`, plus the z and intensity of each spot."""
+    spots = np.asarray(spots, dtype=np.float64).reshape(-1, 5)
+    return spots[:, 1:4], spots[:, 0], spots[:, 4]
+
+
+def find_stacks(raw_dir, conditions=None):
+    """(condition, path) of every raw stack under <raw_dir>/<condition>/."""
+    stacks = []
+    for condition in sorted(conditions or os.listdir(raw_dir)):
+        folder = os.path.join(raw_dir, condition)
+        if os.path.isdir(folder):
+            stacks.extend((condition, path) for path in sorted(glob.glob(os.path.join(folder, '*.tif*'))))
+    return stacks
+
+
+def truth_accuracy(truth, spots, tolerance):
+    """Lateral recall/precision against true (y, x, z) spots, and the z error of matched spots."""
+    from scipy.optimize import linear_sum_assignment
+    from scipy.spatial import cKDTree
+
+    true_yx = truth[['y', 'x']].to_numpy()
+    matched = match_spots(true_yx, spots[:, 1:3], tolerance)
+    z_error = np.nan
+    if len(true_yx) and len(spots):
+        # Match in (z, y, x) to read off the depth error
+        true_points = truth[['z', 'y', 'x']].to_numpy()
+        points = spots[:, :3]
+        pairs = cKDTree(points).sparse_distance_matrix(cKDTree(true_points), tolerance * 2, output_type='coo_matrix')
+        if pairs.nnz:
+            rows, row_index = np.unique(pairs.row, return_inverse=True)
+            cols, col_index = np.unique(pairs.col, return_inverse=True)
+            cost = np.full((len(rows), len(cols)), tolerance * 20)
+            cost[row_index, col_index] = pairs.data
+            r, c = linear_sum_assignment(cost)
+            r, c = r[cost[r, c] <= tolerance * 2], c[cost[r, c] <= tolerance * 2]
+            z_error = float(np.median(np.abs(spots[rows[r], 0] - truth['z'].to_numpy()[cols[c]])))
+    return {
+        'recall': matched / len(true_yx) if len(true_yx) else 1.0,
+        'precision': matched / len(spots) if len(spots) else 1.0,
+        'median_z_error': z_error,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="3D spot detection on raw Z-stacks, streamed in slabs")
+    parser.add_argument('command', choices=['detect', 'compare'])
+    parser.add_argument('--raw-dir', default=RAW_DATA_DIR, help='Raw stacks, one folder per condition')
+    parser.add_argument('--conditions', nargs='*', help='Conditions to process (default: all)')
+    parser.add_argument('--limit', type=int, help='Maximum number of stacks')
+    parser.add_argument('--channel', type=int, default=FISH_CHANNEL)
+    parser.add_argument('--sigmas', nargs='*', type=float, default=list(SPOT_SIGMAS_3D))
+    parser.add_argument('--threshold', type=float, default=SPOT_THRESHOLD_3D)
+    parser.add_argument('--axial-sigma', type=float, default=AXIAL_SIGMA, help='Axial PSF sigma in planes')
+    parser.add_argument('--slab', type=int, default=SLAB_PLANES, help='Planes per slab, halo excluded')
+    parser.add_argument('--truth', help='synthetic_truth/spots.csv to score against (compare)')
+    parser.add_argument('--tolerance', type=float, default=2.0, help='Matching distance in pixels (compare)')
+    args = parser.parse_args()
+
+    stacks = find_stacks(args.raw_dir, args.conditions)[:args.limit]
+    if not stacks:
+        print("No raw stacks found.")
+        return
+    halo = slab_halo(args.axial_sigma)
+    print(f"--- 3D spot detection on {len(stacks)} stacks (slab {args.slab} planes, halo {halo}) ---")
+    truth = None
+    if args.truth:
+        import pandas as pd
+        truth = pd.read_csv(args.truth)
+
+    identical = True
+    for condition, path in stacks:
+        filename = os.path.basename(path)
+        try:
+            start = time.perf_counter()
+            spots = detect_spots_3d(path, args.channel, args.sigmas, args.threshold, args.axial_sigma, args.slab)
+            seconds = time.perf_counter() - start
+            large = int((spots[:, 3] > NASCENT_SIZE_THRESHOLD).sum())
+            line = f"  {condition}/{filename}: {len(spots)} spots ({large} large) in {seconds:.2f}s"
+            if args.command == 'compare':
+                reference = detect_spots_3d(path, args.channel, args.sigmas, args.threshold, args.axial_sigma, None)
+                same = reference.shape == spots.shape and np.allclose(
+                    reference[np.lexsort(reference.T[::-1])], spots[np.lexsort(spots.T[::-1])])
+                identical &= same
+                line += f"  whole-stack reference: {len(reference)} {'identical' if same else 'DIFFERENT'}"
+                if truth is not None:
+                    scores = truth_accuracy(truth[(truth['condition'] == condition) & (truth['image'] == filename)],
+                                            spots, args.tolerance)
+                    line += (f"  recall={scores['recall']:.3f} precision={scores['precision']:.3f} "
+                             f"|dz|={scores['median_z_error']:.2f}")
+            print(line)
+        except Exception as e:
+            print(f"  - FAILED to process {filename}: {e}")
+            identical = False
+
+    if args.command == 'compare':
+        if not identical:
+            print("✗ Slab-wise spots differ from the whole-stack reference")
+            sys.exit(1)
+        print("✓ Slab-wise spots identical to the whole-stack reference")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Statistics Engine for Condition Comparisons
+
+Compares any number of conditions on any number of metrics and returns one
+tidy table, one row per test:
+
+    kruskal              Kruskal-Wallis H-test across all conditions
+    permutation_kruskal  the same H statistic against label permutations
+    dunn                 Dunn's post-hoc z-test for each pair (Holm-adjusted)
+    permutation          difference in means for each pair against label permutations (Holm-adjusted)
+    bootstrap            mean of each condition with a percentile confidence interval
+    bootstrap_diff       difference in means for each pair with a percentile confidence interval
+
+Resamples are drawn as batched NumPy arrays, one row per resample (shuffled
+labels or values for permutations, index arrays for the bootstrap), never in a
+Python loop over resamples. Each metric gets its own random stream, spawned
+from `seed`, so the results are the same whether metrics run serially or
+across `workers` processes.
+
+    from stats_engine import compare_conditions
+    table = compare_conditions(df, ['total_count', 'nascent_count'], seed=0, workers=4)
+
+Pairs default to every pair of conditions. With `control='DMSO'` only each
+condition against the control is tested, which keeps screens with dozens of
+compounds manageable.
+
+Usage:
+    python stats_engine.py --metrics total_count nascent_count single_molecule_count avg_intensity
+    python stats_engine.py --table cell_counts --metrics total_count nucleus_count --control DMSO --workers 4
+    python stats_engine.py --csv results/tables/final_detailed_counts.csv --metrics total_count --seed 1
+"""
+
+import os
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STORE_DIR = os.path.join(BASE_DIR, "results", "store")
+TABLES_DIR = os.path.join(BASE_DIR, "results", "tables")
+
+DEFAULT_METRICS = ['total_count', 'nascent_count', 'single_molecule_count', 'avg_intensity']
+N_PERMUTATIONS = 10000
+N_BOOTSTRAP = 10000
+CONFIDENCE = 0.95
+ALPHA = 0.05
+
+# Resample arrays are generated in chunks of at most this many elements
+CHUNK_ELEMENTS = 2_000_000
+
+TABLE_COLUMNS = ['metric', 'test', 'group1', 'group2', 'n1', 'n2', 'statistic', 'estimate',
+                 'ci_low', 'ci_high', 'p_value', 'p_adjusted', 'significant']
+
+
+def holm(p_values):
+    """Holm step-down adjusted p-values."""
+    p_values = np.asarray(p_values, dtype=np.float64)
+    m = len(p_values)
+    if m == 0:
+        return p_values
+    order = np.argsort(p_values)
+    adjusted = np.maximum.accumulate((m - np.arange(m)) * p_values[order])
+    result = np.empty(m)
+    result[order] = np.minimum(adjusted, 1.0)
+    return result
+
+
+def _chunks(total, row_length):
+    """Split `total` resamples into chunk sizes that keep resample arrays small."""
+    size = max(1, CHUNK_ELEMENTS // max(row_length, 1))
+    while total > 0:
+        yield min(size, total)
+        total -= size
+
+
+def _permuted_rows(rng, array, batch):
+    """(batch, n) array whose rows are independent shuffles of `array`."""
+    return rng.permuted(np.broadcast_to(array, (batch, len(array))), axis=1)
+
+
+def kruskal_statistic(ranks, labels, n_groups, counts, tie_correction):
+    """
+    Kruskal-Wallis H for one or more label vectors at once.
+
+    `labels` is (n,) or (batch, n) of group indices; `ranks` the pooled ranks.
+    """
+    labels = np.atleast_2d(labels)
+    batch, n = labels.shape
+    offsets = (np.arange(batch) * n_groups)[:, None]
+    rank_sums = np.bincount((labels + offsets).ravel(), weights=np.broadcast_to(ranks, labels.shape).ravel(),
+                            minlength=batch * n_groups).reshape(batch, n_groups)
+    h = 12.0 / (n * (n + 1)) * (rank_sums ** 2 / counts).sum(axis=1) - 3 * (n + 1)
+    return h / tie_correction
+
+
+def dunn(values, labels, n_groups, pairs):
+    """Dunn's z and two-sided p for each (i, j) group pair, with the tie correction."""
+    n = len(values)
+    ranks = stats.rankdata(values)
+    counts = np.bincount(labels, minlength=n_groups)
+    mean_ranks = np.bincount(labels, weights=ranks, minlength=n_groups) / counts
+    _, ties = np.unique(values, return_counts=True)
+    tie_term = (ties ** 3 - ties).sum() / (12.0 * (n - 1))
+    i, j = np.array(pairs).T
+    z = (mean_ranks[i] - mean_ranks[j]) / np.sqrt((n * (n + 1) / 12.0 - tie_term) * (1.0 / counts[i] + 1.0 / counts[j]))
+    return z, 2 * stats.norm.sf(np.abs(z))
+
+
+def permutation_kruskal(values, labels, n_groups, n_permutations, rng):
+    """Observed H and its permutation p-value."""
+    n = len(values)
+    ranks = stats.rankdata(values)
+    counts = np.bincount(labels, minlength=n_groups)
+    _, ties = np.unique(values, return_counts=True)
+    tie_correction = 1.0 - (ties ** 3 - ties).sum() / (n ** 3 - n) if n > 1 else 1.0
+    if tie_correction == 0:
+        return np.nan, np.nan
+    observed = kruskal_statistic(ranks, labels, n_groups, counts, tie_correction)[0]
+
+    exceed = 0
+    for batch in _chunks(n_permutations, n):
+        permuted = _permuted_rows(rng, labels, batch)
+        exceed += int((kruskal_statistic(ranks, permuted, n_groups, counts, tie_correction)
+                       >= observed - 1e-12).sum())
+    return observed, (exceed + 1) / (n_permutations + 1)
+
+
+def permutation_diff(a, b, n_permutations, rng):
+    """Observed mean(a) - mean(b) and its two-sided permutation p-value."""
+    pooled = np.concatenate([a, b])
+    n, n_a = len(pooled), len(a)
+    observed = a.mean() - b.mean()
+    total = pooled.sum()
+    exceed = 0
+    for batch in _chunks(n_permutations, n):
+        sum_a = _permuted_rows(rng, pooled, batch)[:, :n_a].sum(axis=1)
+        diffs = sum_a / n_a - (total - sum_a) / (n - n_a)
+        exceed += int((np.abs(diffs) >= abs(observed) - 1e-12).sum())
+    return observed, (exceed + 1) / (n_permutations + 1)
+
+
+def bootstrap_means(values, n_bootstrap, rng):
+    """Means of `n_bootstrap` resamples (with replacement) of `values`."""
+    n = len(values)
+    means = []
+    for batch in _chunks(n_bootstrap, n):
+        means.append(values[rng.integers(0, n, size=(batch, n))].mean(axis=1))
+    return np.concatenate(means)
+
+
+def _interval(samples, confidence):
+    tail = (1 - confidence) / 2 * 100
+    return np.percentile(samples, [tail, 100 - tail])
+
+
+def analyze_metric(values, labels, names, metric, pairs, n_permutations=N_PERMUTATIONS, n_bootstrap=N_BOOTSTRAP,
+                   confidence=CONFIDENCE, alpha=ALPHA, seed_sequence=None):
+    """All tests for one metric; returns a list of row dicts (see TABLE_COLUMNS)."""
+    rng = np.random.default_rng(seed_sequence)
+    n_groups = len(names)
+    groups = [values[labels == g] for g in range(n_groups)]
+    counts = [len(g) for g in groups]
+    rows = []
+
+    def row(test, group1='', group2='', n1=np.nan, n2=np.nan, statistic=np.nan, estimate=np.nan,
+            ci=(np.nan, np.nan), p_value=np.nan):
+        return {'metric': metric, 'test': test, 'group1': group1, 'group2': group2, 'n1': n1, 'n2': n2,
+                'statistic': statistic, 'estimate': estimate, 'ci_low': ci[0], 'ci_high': ci[1],
+                'p_value': p_value}
+
+    testable = n_groups > 1 and min(counts) > 0 and len(np.unique(values)) > 1
+    if testable:
+        h_statistic, p_value = stats.kruskal(*groups)
+        rows.append(dict(row('kruskal', n1=len(values), statistic=h_statistic, p_value=p_value), p_adjusted=p_value))
+        h_statistic, p_value = permutation_kruskal(values, labels, n_groups, n_permutations, rng)
+        rows.append(dict(row('permutation_kruskal', n1=len(values), statistic=h_statistic, p_value=p_value),
+                         p_adjusted=p_value))
+
+        z, p_dunn = dunn(values, labels, n_groups, pairs)
+        dunn_rows = [row('dunn', names[i], names[j], counts[i], counts[j], statistic=z[k],
+                         estimate=groups[i].mean() - groups[j].mean(), p_value=p_dunn[k])
+                     for k, (i, j) in enumerate(pairs)]
+        for dunn_row, adjusted in zip(dunn_rows, holm(p_dunn)):
+            dunn_row['p_adjusted'] = adjusted
+        rows.extend(dunn_rows)
+
+        permutation_rows = []
+        for i, j in pairs:
+            difference, p_value = permutation_diff(groups[i], groups[j], n_permutations, rng)
+            permutation_rows.append(row('permutation', names[i], names[j], counts[i], counts[j],
+                                        statistic=difference, estimate=difference, p_value=p_value))
+        for permutation_row, adjusted in zip(permutation_rows, holm([r['p_value'] for r in permutation_rows])):
+            permutation_row['p_adjusted'] = adjusted
+        rows.extend(permutation_rows)
+
+    boot = {}
+    for g, name in enumerate(names):
+        if counts[g] == 0:
+            continue
+        boot[g] = bootstrap_means(groups[g], n_bootstrap, rng)
+        rows.append(row('bootstrap', name, n1=counts[g], estimate=groups[g].mean(),
+                        ci=_interval(boot[g], confidence)))
+    for i, j in pairs:
+        if i in boot and j in boot:
+            # Independent resamples of each condition, so their differences resample the difference
+            rows.append(row('bootstrap_diff', names[i], names[j], counts[i], counts[j],
+                            estimate=groups[i].mean() - groups[j].mean(), ci=_interval(boot[i] - boot[j], confidence)))
+
+    for r in rows:
+        r.setdefault('p_adjusted', np.nan)
+        r['significant'] = bool(r['p_adjusted'] < alpha) if not np.isnan(r['p_adjusted']) else (
+            bool(r['ci_low'] > 0 or r['ci_high'] < 0) if r['test'] == 'bootstrap_diff' else False)
+    return rows
+
+
+def _analyze_metric_job(args):
+    return analyze_metric(*args[:5], **args[5])
+
+
+def compare_conditions(df, metrics, group_col='condition', conditions=None, control=None,
+                       n_permutations=N_PERMUTATIONS, n_bootstrap=N_BOOTSTRAP, confidence=CONFIDENCE,
+                       alpha=ALPHA, seed=0, workers=1):
+    """
+    Tidy table (TABLE_COLUMNS) of every test for every metric.
+
+    `conditions` fixes the set and order of conditions (default: sorted unique
+    values of `group_col`); `control` restricts pairwise tests to condition vs
+    control. `workers` > 1 evaluates metrics in parallel processes.
+    """
+    names = list(conditions) if conditions else sorted(df[group_col].astype(str).unique())
+    if control is not None and control not in names:
+        raise ValueError(f"Control '{control}' is not one of the conditions: {', '.join(names)}")
+    missing = [m for m in metrics if m not in df.columns]
+    if missing:
+        raise ValueError(f"Unknown metrics: {', '.join(missing)}")
+
+    df = df[df[group_col].astype(str).isin(names)]
+    labels_all = pd.Categorical(df[group_col].astype(str), categories=names).codes
+    if control is None:
+        pairs = list(itertools.combinations(range(len(names)), 2))
+    else:
+        c = names.index(control)
+        pairs = [(g, c) for g in range(len(names)) if g != c]
+
+    options = {'n_permutations': n_permutations, 'n_bootstrap': n_bootstrap, 'confidence': confidence,
+               'alpha': alpha}
+    jobs = []
+    for metric, seed_sequence in zip(metrics, np.random.SeedSequence(seed).spawn(len(metrics))):
+        values = pd.to_numeric(df[metric], errors='coerce').to_numpy(dtype=np.float64)
+        keep = ~np.isnan(values)
+        jobs.append((values[keep], labels_all[keep].astype(np.intp), names, metric, pairs,
+                     dict(options, seed_sequence=seed_sequence)))
+
+    if workers and workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)),
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            results = list(executor.map(_analyze_metric_job, jobs))
+    else:
+        results = [_analyze_metric_job(job) for job in jobs]
+    return pd.DataFrame([r for rows in results for r in rows], columns=TABLE_COLUMNS)
+
+
+def load_table(table='detailed_counts', store_root=STORE_DIR, csv_path=None, conditions=None, columns=None):
+    """Rows from a CSV file, or from the results store (latest run) with only the needed columns."""
+    if csv_path:
+        df = pd.read_csv(csv_path, usecols=columns)
+        return df[df['condition'].astype(str).isin(conditions)] if conditions else df
+    from results_store import read_table
+    return read_table(store_root, table, columns=columns, conditions=conditions)
+
+
+def print_summary(table, alpha=ALPHA):
+    """Kruskal-Wallis and significant pairwise results per metric."""
+    for metric, rows in table.groupby('metric', sort=False):
+        kruskal = rows[rows['test'] == 'kruskal']
+        if kruskal.empty:
+            print(f"\n--- {metric}: not enough data to test ---")
+            continue
+        kruskal = kruskal.iloc[0]
+        permuted = rows[rows['test'] == 'permutation_kruskal'].iloc[0]
+        print(f"\n--- {metric} ---")
+        print(f"Kruskal-Wallis H = {kruskal['statistic']:.4f}, p = {kruskal['p_value']:.4g} "
+              f"(permutation p = {permuted['p_value']:.4g})")
+        pairwise = rows[rows['test'].isin(['dunn', 'permutation']) & rows['significant']]
+        if kruskal['p_value'] >= alpha or pairwise.empty:
+            print("No significant pairwise differences.")
+            continue
+        for _, r in pairwise.iterrows():
+            print(f"  {r['test']:<12} {r['group1']} vs {r['group2']}: p_adj = {r['p_adjusted']:.4g}, "
+                  f"mean difference = {r['estimate']:.4g}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kruskal/Dunn, permutation and bootstrap tests across conditions")
+    parser.add_argument('--table', default='detailed_counts', help='Results store table (see results_store.py)')
+    parser.add_argument('--store', default=STORE_DIR, help='Results store directory')
+    parser.add_argument('--csv', help='Read this CSV file instead of the results store')
+    parser.add_argument('--metrics', nargs='*', default=DEFAULT_METRICS)
+    parser.add_argument('--conditions', nargs='*', help='Conditions to compare (default: all found)')
+    parser.add_argument('--control', help='Only test each condition against this one')
+    parser.add_argument('--permutations', type=int, default=N_PERMUTATIONS)
+    parser.add_argument('--bootstrap', type=int, default=N_BOOTSTRAP)
+    parser.add_argument('--confidence', type=float, default=CONFIDENCE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1, help='Processes evaluating metrics in parallel')
+    parser.add_argument('--output', default=os.path.join(TABLES_DIR, "condition_stats.csv"))
+    args = parser.parse_args()
+
+    df = load_table(args.table, args.store, args.csv, args.conditions, columns=['condition'] + args.metrics)
+    table = compare_conditions(df, args.metrics, conditions=args.conditions, control=args.control,
+                               n_permutations=args.permutations, n_bootstrap=args.bootstrap,
+                               confidence=args.confidence, seed=args.seed, workers=args.workers)
+    print_summary(table)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    table.to_csv(args.output, index=False)
+    print(f"\n✓ {len(table)} test results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+Streaming Denoise + Segmentation
+
+Runs the CH1 pass of 5_complete_segmentation.ipynb as four concurrent stages
+connected by bounded queues instead of read → BM3D → Cellpose → write one image
+at a time:
+
+    reader ──▶ denoiser pool (processes) ──▶ segmenter (Cellpose batches) ──▶ writer
+
+While Cellpose segments one batch, the denoiser pool is already working on the
+next images. Every queue holds at most `queue_size` items, so a slow stage
+blocks the stages before it (backpressure) instead of letting images pile up in
+memory. At the end each stage reports its utilization: the share of the
+run it spent working, waiting for input, or blocked on a full output queue.
+The busiest stage is the bottleneck.
+
+    from stream_segmentation import stream_folder
+    stream_folder(service, input_dir, output_dir, {'pretrained_model': CELL_MODEL_PATH},
+                  {'channels': [0, 0], 'diameter': None}, strength=100.0, denoise_workers=6)
+
+Usage:
+    python stream_segmentation.py                                  # CH1 of every condition
+    python stream_segmentation.py --conditions DMSO --denoise-workers 12 --threads 4 --queue-size 8
+"""
+
+import os
+import time
+import queue
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from incremental import load_units, unit_key, unit_is_current, record_unit, save_units
+from instrumentation import measure, tiff_read, tiff_write
+from segmentation_service import (SegmentationService, PASSES, PROCESSED_DIR, FINAL_MASKS_DIR,
+                                  DEFAULT_BATCH_SIZE, DENOISING_STRENGTH_FACTOR, SEGMENTATION_CODE)
+
+DEFAULT_QUEUE_SIZE = 4
+
+# End-of-stream marker passed down the queues
+_DONE = object()
+
+
+class StageStats:
+    """Busy / starved / blocked time of one stage."""
+
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.waiting_input = 0.0
+        self.blocked_output = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, field, seconds):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + seconds)
+
+
+def _get(q, stats):
+    start = time.perf_counter()
+    item = q.get()
+    stats.add('waiting_input', time.perf_counter() - start)
+    return item
+
+
+def _put(q, item, stats):
+    start = time.perf_counter()
+    q.put(item)
+    stats.add('blocked_output', time.perf_counter() - start)
+
+
+def _denoise_in_worker(image, strength, method, filename=None):
+    """Denoiser pool entry point; returns the denoised image and the seconds spent."""
+    from denoise_cache import cached_denoise
+    start = time.perf_counter()
+    # Tiling, if configured, stays inside this worker: the pool already uses every core
+    with measure('prepare', image=filename):
+        denoised_image = cached_denoise(image, strength, method=method, workers=1)
+    return denoised_image, time.perf_counter() - start
+
+
+def _limit_worker_threads():
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = '1'
+
+
+def print_utilization(stages, wall):
+    """Per-stage utilization table; the stage closest to 100% busy is the bottleneck."""
+    print(f"\n{'stage':<12}{'items':>7}{'busy':>8}{'starved':>9}{'blocked':>9}")
+    for stats in stages:
+        capacity = wall * stats.workers
+        print(f"{stats.name:<12}{stats.items:>7}{stats.busy / capacity:>8.0%}"
+              f"{stats.waiting_input / capacity:>9.0%}{stats.blocked_output / capacity:>9.0%}")
+    bottleneck = max(stages, key=lambda s: s.busy / (wall * s.workers))
+    print(f"Bottleneck: {bottleneck.name} ({len(stages)} stages, {wall:.1f}s wall)")
+
+
+def stream_folder(service, input_dir, output_dir, model, eval_kwargs=None, strength=DENOISING_STRENGTH_FACTOR,
+                  denoiser='bm3d', denoise_workers=None, batch_size=None, queue_size=DEFAULT_QUEUE_SIZE,
+                  ledger=None, key_paths=(), key_params=None):
+    """
+    Denoise and segment every .tif in `input_dir` with all stages running concurrently.
+
+    Arguments match `segmentation_service.segment_folder`, with denoising done
+    by `denoise_workers` processes. Returns {filename: error_text} for the
+    files that failed.
+    """
+    eval_kwargs = eval_kwargs or {}
+    batch_size = batch_size or service.batch_size
+    denoise_workers = denoise_workers or max(1, int(os.environ.get("SMFISH_CORES", os.cpu_count())) // 2)
+    os.makedirs(output_dir, exist_ok=True)
+
+    units = load_units(ledger) if ledger else {}
+    pending = []
+    for filename in sorted(f for f in os.listdir(input_dir) if f.endswith('.tif')):
+        input_path = os.path.join(input_dir, filename)
+        output_path = os.path.join(output_dir, filename)
+        key = unit_key(input_path, *key_paths, code=SEGMENTATION_CODE, **(key_params or {})) if ledger else None
+        if ledger and unit_is_current(units, filename, key, output_path):
+            continue
+        pending.append((filename, input_path, output_path, key))
+    if not pending:
+        return {}
+
+    read_queue = queue.Queue(maxsize=queue_size)
+    denoised_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    reader = StageStats('reader')
+    denoise = StageStats('denoise', denoise_workers)
+    segment = StageStats('segment')
+    writer = StageStats('writer')
+    failures = {}
+
+    # Items travel as (filename, output_path, key, payload, error)
+    def stage_failed(stats, e):
+        """Report a stage that stopped on an unexpected error; returns the error text for its files."""
+        error = f"{stats.name} stage stopped: {type(e).__name__}: {e}"
+        print(f"✗ {error}")
+        return error
+
+    def drain(in_queue, out_queue, stats, error):
+        """Pass every remaining input item on as failed, so upstream stages never block on a full queue."""
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                return
+            _put(out_queue, item[:3] + (None, item[4] or error), stats)
+
+    def read_stage():
+        position = 0
+        try:
+            for position, (filename, input_path, output_path, key) in enumerate(pending):
+                start = time.perf_counter()
+                try:
+                    item = (filename, output_path, key, tiff_read(input_path), None)
+                except Exception as e:
+                    item = (filename, output_path, key, None, str(e))
+                reader.add('busy', time.perf_counter() - start)
+                reader.items += 1
+                _put(read_queue, item, reader)
+                position += 1
+        except Exception as e:
+            error = stage_failed(reader, e)
+            for filename, _, output_path, key in pending[position:]:
+                _put(read_queue, (filename, output_path, key, None, error), reader)
+        finally:
+            _put(read_queue, _DONE, reader)
+
+    def denoise_stage(executor):
+        in_flight = {}
+        current = None
+
+        def collect(done):
+            for future in done:
+                filename, output_path, key = in_flight.pop(future)
+                try:
+                    denoised_image, seconds = future.result()
+                    denoise.add('busy', seconds)
+                    item = (filename, output_path, key, denoised_image, None)
+                except Exception as e:
+                    item = (filename, output_path, key, None, str(e))
+                denoise.items += 1
+                _put(denoised_queue, item, denoise)
+
+        try:
+            while True:
+                # Keep every worker busy but never more than one queued image per worker
+                if len(in_flight) >= 2 * denoise_workers:
+                    done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                    collect(done)
+                try:
+                    current = read_queue.get(timeout=0.05) if in_flight else _get(read_queue, denoise)
+                except queue.Empty:
+                    done, _ = wait(list(in_flight), timeout=0, return_when=FIRST_COMPLETED)
+                    collect(done)
+                    continue
+                if current is _DONE:
+                    break
+                filename, output_path, key, image, error = current
+                if error is not None:
+                    _put(denoised_queue, current, denoise)
+                else:
+                    # Raises BrokenProcessPool once a worker has died (e.g. OOM-killed)
+                    in_flight[executor.submit(_denoise_in_worker, image, strength, denoiser, filename)] = (filename, output_path, key)
+                current = None
+            collect(wait(list(in_flight))[0])
+        except Exception as e:
+            error = stage_failed(denoise, e)
+            # The item being submitted, the images still in the pool, then everything not read yet
+            if current is not None and current is not _DONE:
+                _put(denoised_queue, current[:3] + (None, current[4] or error), denoise)
+            for future, (filename, output_path, key) in list(in_flight.items()):
+                future.cancel()
+                _put(denoised_queue, (filename, output_path, key, None, error), denoise)
+            if current is not _DONE:
+                drain(read_queue, denoised_queue, denoise, error)
+        finally:
+            _put(denoised_queue, _DONE, denoise)
+
+    def segment_stage():
+        finished = False
+        unsent = []
+        try:
+            while not finished:
+                batch = [_get(denoised_queue, segment)]
+                # Take whatever else is ready, up to a full batch, without waiting for more
+                while len(batch) < batch_size and batch[-1] is not _DONE:
+                    try:
+                        batch.append(denoised_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch[-1] is _DONE:
+                    batch.pop()
+                    finished = True
+
+                ready = [item for item in batch if item[4] is None]
+                for item in batch:
+                    if item[4] is not None:
+                        _put(write_queue, item, segment)
+                unsent = ready
+                if not ready:
+                    continue
+
+                start = time.perf_counter()
+                try:
+                    masks = service.segment([item[3] for item in ready], batch_size=len(ready), **model, **eval_kwargs)
+                    results = [(f, o, k, m, None) for (f, o, k, _, _), m in zip(ready, masks)]
+                except Exception:
+                    # Retry one at a time so a single bad image does not fail the whole batch
+                    results = []
+                    for filename, output_path, key, image, _ in ready:
+                        try:
+                            mask = service.segment([image], **model, **eval_kwargs)[0]
+                            results.append((filename, output_path, key, mask, None))
+                        except Exception as e:
+                            results.append((filename, output_path, key, None, str(e)))
+                segment.add('busy', time.perf_counter() - start)
+                segment.items += len(ready)
+                for item in results:
+                    _put(write_queue, item, segment)
+                unsent = []
+        except Exception as e:
+            error = stage_failed(segment, e)
+            for item in unsent:
+                _put(write_queue, item[:3] + (None, item[4] or error), segment)
+            if not finished:
+                drain(denoised_queue, write_queue, segment, error)
+        finally:
+            _put(write_queue, _DONE, segment)
+
+    def write_stage():
+        item = None
+        try:
+            while True:
+                item = _get(write_queue, writer)
+                if item is _DONE:
+                    break
+                filename, output_path, key, mask, error = item
+                start = time.perf_counter()
+                if error is None:
+                    try:
+                        tiff_write(output_path, mask)
+                        if ledger:
+                            record_unit(units, filename, key)
+                            save_units(ledger, units)
+                    except Exception as e:
+                        error = str(e)
+                if error is not None:
+                    print(f"  - FAILED to process {filename}: {error}")
+                    failures[filename] = error
+                writer.add('busy', time.perf_counter() - start)
+                writer.items += 1
+        except Exception as e:
+            error = stage_failed(writer, e)
+            if item is not None:
+                print(f"  - FAILED to process {item[0]}: {item[4] or error}")
+                failures[item[0]] = item[4] or error
+            while True:
+                item = write_queue.get()
+                if item is _DONE:
+                    break
+                print(f"  - FAILED to process {item[0]}: {item[4] or error}")
+                failures[item[0]] = item[4] or error
+
+    start = time.perf_counter()
+    # Spawned, not forked: the pool starts workers while the stage threads are already running
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=denoise_workers, mp_context=context,
+                             initializer=_limit_worker_threads) as executor:
+        threads = [threading.Thread(target=read_stage, daemon=True),
+                   threading.Thread(target=denoise_stage, args=(executor,), daemon=True),
+                   threading.Thread(target=segment_stage, daemon=True),
+                   threading.Thread(target=write_stage, daemon=True)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    print_utilization([reader, denoise, segment, writer], time.perf_counter() - start)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming denoise + Cellpose segmentation of CH1 images")
+    parser.add_argument('--conditions', nargs='*', help='Conditions to process (default: all found)')
+    parser.add_argument('--processed-dir', default=PROCESSED_DIR)
+    parser.add_argument('--masks-dir', default=FINAL_MASKS_DIR)
+    parser.add_argument('--denoise-workers', type=int, help='Denoiser processes (default: half the cores)')
+    parser.add_argument('--threads', type=int, help='Torch threads for the segmenter (default: the other half)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Images per model.eval call')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help='Capacity of each queue')
+    parser.add_argument('--strength', type=float, default=DENOISING_STRENGTH_FACTOR)
+    parser.add_argument('--denoiser', default='bm3d', help='Denoiser backend (see denoisers.py)')
+    parser.add_argument('--force', action='store_true', help='Segment images even if unchanged')
+    args = parser.parse_args()
+
+    cores = int(os.environ.get("SMFISH_CORES", os.cpu_count()))
+    denoise_workers = args.denoise_workers or max(1, cores // 2)
+    service = SegmentationService(threads=args.threads or max(1, cores - denoise_workers),
+                                  batch_size=args.batch_size)
+    spec = PASSES['cell']
+    conditions = args.conditions or sorted(d for d in os.listdir(args.processed_dir)
+                                           if os.path.isdir(os.path.join(args.processed_dir, d)))
+    failures = {}
+    for condition in conditions:
+        input_dir = os.path.join(args.processed_dir, condition, spec['channel'])
+        if not os.path.isdir(input_dir):
+            print(f"Warning: Skipping cell segmentation for {condition}, directory not found.")
+            continue
+        print(f"\nProcessing cell masks for condition: {condition}")
+        failures.update(stream_folder(
+            service, input_dir, os.path.join(args.masks_dir, condition, f"{spec['channel']}_masks"),
+            spec['model'], spec['eval'], strength=args.strength, denoiser=args.denoiser,
+            denoise_workers=denoise_workers, queue_size=args.queue_size,
+            ledger=None if args.force else f"complete_segmentation_{condition}_{spec['channel']}",
+            key_paths=(spec['model']['pretrained_model'],),
+            key_params={'strength': args.strength, 'denoiser': args.denoiser}))
+
+    print("\nThroughput:")
+    service.report()
+    print(f"\n✗ {len(failures)} files failed" if failures else "\n✓ Streaming segmentation complete")
+
+
+if __name__ == "__main__":
+    main()
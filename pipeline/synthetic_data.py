@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Synthetic smFISH Dataset Generator
+
+Writes raw (Z, C, Y, X) uint16 stacks laid out like data/raw, with the
+ground truth needed to score the pipeline against them. The default shape
+is Z=15 and C=2: CH0 is a nuclear stain, CH1 the smFISH channel.
+
+- Cells are Voronoi regions around random seeds, each clipped to a
+  randomly oriented ellipse. Every cell has one elliptical nucleus inside it.
+- smFISH spots sit at known sub-pixel (z, y, x) positions inside the cells.
+  Each is a Gaussian with its own intensity. The number per cell is
+  Poisson-distributed with a mean that depends on the condition, so the
+  stats stage has real differences to find.
+- Nascent transcription sites are larger and brighter spots inside the
+  nuclei, above the notebooks' 1.5 sigma / 0.1 intensity thresholds.
+- Noise is Poisson shot noise on the photon counts plus Gaussian read noise.
+
+Output under <data_dir>:
+
+    raw/<condition>/SYNTH_<condition>_<nnn>.tif                 ZCYX uint16 stacks
+    synthetic_truth/<condition>/SYNTH_..._cells.tif, _nuclei.tif   label images
+    synthetic_truth/spots.csv                                    one row per spot
+    final_masks/<condition>/CH1_masks, CH0_masks                 (--masks) truth as segmentation masks
+
+Usage:
+    python synthetic_data.py --data-dir /tmp/synthetic --images 8
+    python synthetic_data.py --data-dir /tmp/synthetic --conditions DMSO JQ1 --size 1024 --z 15 --noise 30 --masks
+"""
+
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+import tifffile
+from scipy import ndimage
+
+from projection import projection_filename
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CONDITIONS = ['DMSO', 'JQ1', 'TSA']
+TRUTH_DIRNAME = "synthetic_truth"
+
+# Mean spots per cell for each condition; anything else gets DEFAULT_SPOTS_PER_CELL
+SPOTS_PER_CELL = {'DMSO': 20, 'JQ1': 10, 'TSA': 35}
+DEFAULT_SPOTS_PER_CELL = 20
+
+# Everything below can be overridden with generate_dataset(..., **params) or the command line
+DEFAULTS = {
+    'size': 512,               # Y = X in pixels
+    'z': 15,
+    'cell_radius': 45.0,       # mean ellipse semi-axis of a cell, pixels
+    'cell_aspect': (1.0, 1.6), # range of major/minor axis ratios
+    'nucleus_fraction': 0.45,  # nucleus axes relative to the cell's
+    'nascent_per_nucleus': 0.8,
+    'spot_intensity': 900.0,   # peak photons of a single-molecule spot
+    'spot_sigma': 1.0,         # lateral PSF sigma, pixels
+    'spot_sigma_z': 1.5,       # axial PSF sigma, planes
+    'nascent_intensity': 4.0,  # times spot_intensity
+    'nascent_sigma': 2.2,
+    'background': 100.0,       # photons everywhere
+    'cell_background': 60.0,   # extra cytoplasmic autofluorescence in CH1
+    'nucleus_intensity': 1500.0,
+    'noise': 20.0,             # Gaussian read noise sd, counts
+}
+
+SPOT_COLUMNS = ['condition', 'image', 'spot_id', 'z', 'y', 'x', 'sigma', 'sigma_z', 'intensity', 'nascent',
+                'cell_id', 'in_nucleus']
+
+
+def _ellipse_cells(rng, size, cell_radius, cell_aspect, nucleus_fraction):
+    """Cell and nucleus label images plus per-cell (centre, axes, angle)."""
+    # Seeds at least ~1.4 radii apart, as many as fit
+    n_target = max(1, int(size * size / (np.pi * cell_radius ** 2) * 1.2))
+    candidates = rng.uniform(cell_radius * 0.3, size - cell_radius * 0.3, size=(n_target * 4, 2))
+    centres = []
+    for point in candidates:
+        if all(np.hypot(*(point - c)) > 1.4 * cell_radius for c in centres):
+            centres.append(point)
+        if len(centres) == n_target:
+            break
+    centres = np.array(centres)
+    n = len(centres)
+
+    aspect = rng.uniform(*cell_aspect, size=n)
+    radius = cell_radius * rng.uniform(0.85, 1.15, size=n)
+    major, minor = radius * np.sqrt(aspect), radius / np.sqrt(aspect)
+    angle = rng.uniform(0, np.pi, size=n)
+
+    seeds = np.zeros((size, size), dtype=np.int32)
+    seeds[centres[:, 0].astype(int), centres[:, 1].astype(int)] = np.arange(1, n + 1)
+    _, (iy, ix) = ndimage.distance_transform_edt(seeds == 0, return_indices=True)
+    nearest = seeds[iy, ix] - 1
+
+    yy, xx = np.indices((size, size), dtype=np.float32)
+
+    def inside(scale, shift):
+        dy = yy - (centres[nearest, 0] + shift[nearest, 0])
+        dx = xx - (centres[nearest, 1] + shift[nearest, 1])
+        cos, sin = np.cos(angle[nearest]), np.sin(angle[nearest])
+        u, v = dx * cos + dy * sin, -dx * sin + dy * cos
+        return (u / (major[nearest] * scale)) ** 2 + (v / (minor[nearest] * scale)) ** 2 <= 1
+
+    cell_mask = np.where(inside(1.0, np.zeros((n, 2))), nearest + 1, 0).astype(np.uint16)
+    shift = rng.normal(0, cell_radius * 0.05, size=(n, 2))
+    nuc_mask = np.where(inside(nucleus_fraction, shift) & (cell_mask > 0), cell_mask, 0).astype(np.uint16)
+    return cell_mask, nuc_mask
+
+
+def _sample_pixels(rng, mask, counts):
+    """`counts[label]` random sub-pixel (y, x) positions inside each label of `mask`, with their labels."""
+    flat = mask.ravel()
+    order = np.argsort(flat, kind='stable')
+    bounds = np.searchsorted(flat[order], np.arange(len(counts) + 1))
+    labels, positions = [], []
+    for label in np.flatnonzero(counts):
+        start, stop = bounds[label], bounds[label + 1] if label + 1 < len(bounds) else len(flat)
+        if stop <= start:
+            continue
+        picked = order[rng.integers(start, stop, size=counts[label])]
+        positions.append(np.column_stack(np.unravel_index(picked, mask.shape)) + rng.uniform(-0.5, 0.5, (len(picked), 2)))
+        labels.append(np.full(len(picked), label))
+    if not positions:
+        return np.zeros((0, 2)), np.zeros(0, dtype=int)
+    return np.vstack(positions), np.concatenate(labels)
+
+
+def _add_gaussian(volume, z, y, x, sigma, sigma_z, amplitude):
+    """Add one anisotropic Gaussian spot to a (Z, Y, X) volume in place, within +-3 sigma."""
+    nz, ny, nx = volume.shape
+    rz, ry = int(np.ceil(3 * sigma_z)), int(np.ceil(3 * sigma))
+    z0, z1 = max(int(z) - rz, 0), min(int(z) + rz + 2, nz)
+    y0, y1 = max(int(y) - ry, 0), min(int(y) + ry + 2, ny)
+    x0, x1 = max(int(x) - ry, 0), min(int(x) + ry + 2, nx)
+    if z0 >= z1 or y0 >= y1 or x0 >= x1:
+        return
+    gz = np.exp(-0.5 * ((np.arange(z0, z1) - z) / sigma_z) ** 2)
+    gy = np.exp(-0.5 * ((np.arange(y0, y1) - y) / sigma) ** 2)
+    gx = np.exp(-0.5 * ((np.arange(x0, x1) - x) / sigma) ** 2)
+    volume[z0:z1, y0:y1, x0:x1] += amplitude * gz[:, None, None] * gy[None, :, None] * gx[None, None, :]
+
+
+def generate_image(rng, condition, spots_per_cell=None, **params):
+    """
+    One synthetic field of view.
+
+    Returns (stack, cell_mask, nuc_mask, spots) where stack is (Z, 2, Y, X)
+    uint16 and spots is a DataFrame of SPOT_COLUMNS without condition/image.
+    """
+    p = dict(DEFAULTS, **params)
+    size, nz = p['size'], p['z']
+    cell_mask, nuc_mask = _ellipse_cells(rng, size, p['cell_radius'], p['cell_aspect'], p['nucleus_fraction'])
+    n_cells = int(cell_mask.max())
+
+    mean_spots = SPOTS_PER_CELL.get(condition, DEFAULT_SPOTS_PER_CELL) if spots_per_cell is None else spots_per_cell
+    counts = np.zeros(n_cells + 1, dtype=int)
+    counts[1:] = rng.poisson(mean_spots, size=n_cells)
+    yx, cell_ids = _sample_pixels(rng, cell_mask, counts)
+    n_spots = len(yx)
+    spot_z = rng.uniform(nz * 0.25, nz * 0.75, size=n_spots)
+    intensity = p['spot_intensity'] * rng.lognormal(0, 0.2, size=n_spots)
+    sigma = p['spot_sigma'] * rng.uniform(0.9, 1.1, size=n_spots)
+
+    nascent_counts = np.zeros(n_cells + 1, dtype=int)
+    nascent_counts[1:] = np.minimum(rng.poisson(p['nascent_per_nucleus'], size=n_cells), 2)
+    nascent_yx, nascent_ids = _sample_pixels(rng, nuc_mask, nascent_counts)
+    n_nascent = len(nascent_yx)
+
+    spots = pd.DataFrame({
+        'spot_id': np.arange(n_spots + n_nascent),
+        'z': np.concatenate([spot_z, rng.uniform(nz * 0.35, nz * 0.65, size=n_nascent)]),
+        'y': np.concatenate([yx[:, 0], nascent_yx[:, 0]]),
+        'x': np.concatenate([yx[:, 1], nascent_yx[:, 1]]),
+        'sigma': np.concatenate([sigma, np.full(n_nascent, p['nascent_sigma'])]),
+        'sigma_z': p['spot_sigma_z'],
+        'intensity': np.concatenate([intensity, p['spot_intensity'] * p['nascent_intensity']
+                                     * rng.lognormal(0, 0.15, size=n_nascent)]),
+        'nascent': np.concatenate([np.zeros(n_spots, dtype=bool), np.ones(n_nascent, dtype=bool)]),
+        'cell_id': np.concatenate([cell_ids, nascent_ids]).astype(int),
+    })
+    iy = np.clip(np.round(spots['y']).astype(int), 0, size - 1)
+    ix = np.clip(np.round(spots['x']).astype(int), 0, size - 1)
+    spots['in_nucleus'] = nuc_mask[iy, ix] > 0
+
+    # CH1: background, cytoplasmic autofluorescence and the spots
+    fish = np.full((nz, size, size), p['background'], dtype=np.float32)
+    fish += (cell_mask > 0) * np.float32(p['cell_background'])
+    for row in spots.itertuples(index=False):
+        _add_gaussian(fish, row.z, row.y, row.x, row.sigma, row.sigma_z, row.intensity)
+
+    # CH0: textured nuclear stain, brightest in the middle planes
+    texture = ndimage.gaussian_filter(rng.normal(1.0, 0.25, size=(size, size)).astype(np.float32), 2)
+    nuclei = ndimage.gaussian_filter((nuc_mask > 0) * texture * np.float32(p['nucleus_intensity']), 1.5)
+    z_profile = np.exp(-0.5 * ((np.arange(nz) - (nz - 1) / 2) / (nz / 4)) ** 2).astype(np.float32)
+    dapi = p['background'] + nuclei[None] * z_profile[:, None, None]
+
+    stack = np.empty((nz, 2, size, size), dtype=np.uint16)
+    for channel, volume in enumerate((dapi, fish)):
+        noisy = rng.poisson(np.maximum(volume, 0)).astype(np.float32)
+        noisy += rng.normal(0, p['noise'], size=volume.shape).astype(np.float32)
+        stack[:, channel] = np.clip(np.round(noisy), 0, 65535).astype(np.uint16)
+    return stack, cell_mask, nuc_mask, spots
+
+
+def generate_dataset(data_dir, conditions=CONDITIONS, images=4, seed=0, masks=False, **params):
+    """
+    Write `images` stacks per condition with their ground truth under `data_dir`.
+
+    Every image gets its own random stream from (seed, condition, index), so
+    a larger dataset contains the smaller one. Returns the spots DataFrame.
+    """
+    truth_dir = os.path.join(data_dir, TRUTH_DIRNAME)
+    all_spots = []
+    for condition_index, condition in enumerate(conditions):
+        raw_dir = os.path.join(data_dir, "raw", condition)
+        os.makedirs(raw_dir, exist_ok=True)
+        os.makedirs(os.path.join(truth_dir, condition), exist_ok=True)
+        for i in range(images):
+            rng = np.random.default_rng([seed, condition_index, i])
+            filename = f"SYNTH_{condition}_{i:03d}.tif"
+            stack, cell_mask, nuc_mask, spots = generate_image(rng, condition, **params)
+
+            tifffile.imwrite(os.path.join(raw_dir, filename), stack, imagej=True, metadata={'axes': 'ZCYX'})
+            stem = filename[:-len('.tif')]
+            tifffile.imwrite(os.path.join(truth_dir, condition, f"{stem}_cells.tif"), cell_mask)
+            tifffile.imwrite(os.path.join(truth_dir, condition, f"{stem}_nuclei.tif"), nuc_mask)
+            if masks:
+                write_truth_masks(data_dir, condition, filename, cell_mask, nuc_mask)
+
+            spots.insert(0, 'image', filename)
+            spots.insert(0, 'condition', condition)
+            all_spots.append(spots)
+            print(f"  ✓ {condition}/{filename}: {int(cell_mask.max())} cells, {len(spots)} spots "
+                  f"({int(spots['nascent'].sum())} nascent)")
+
+    spots = pd.concat(all_spots, ignore_index=True)[SPOT_COLUMNS] if all_spots else pd.DataFrame(columns=SPOT_COLUMNS)
+    spots.to_csv(os.path.join(truth_dir, "spots.csv"), index=False)
+    return spots
+
+
+def write_truth_masks(data_dir, condition, filename, cell_mask, nuc_mask):
+    """Ground truth as final_masks/<condition>/CH1_masks (cells) and CH0_masks (nuclei)."""
+    for channel, kind, mask in ((1, 'CH1_masks', cell_mask), (0, 'CH0_masks', nuc_mask)):
+        folder = os.path.join(data_dir, "final_masks", condition, kind)
+        os.makedirs(folder, exist_ok=True)
+        tifffile.imwrite(os.path.join(folder, projection_filename(filename, channel)), mask)
+
+
+def load_truth(data_dir):
+    """The ground-truth spots table written by generate_dataset."""
+    return pd.read_csv(os.path.join(data_dir, TRUTH_DIRNAME, "spots.csv"))
+
+
+def truth_masks(data_dir, condition, filename):
+    """(cell_mask, nuc_mask) ground truth of one raw image."""
+    stem = os.path.join(data_dir, TRUTH_DIRNAME, condition, filename[:-len('.tif')])
+    return tifffile.imread(f"{stem}_cells.tif"), tifffile.imread(f"{stem}_nuclei.tif")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic (Z, C, Y, X) smFISH stacks with ground truth")
+    parser.add_argument('--data-dir', required=True, help='Output data directory (raw/, synthetic_truth/, ...)')
+    parser.add_argument('--conditions', nargs='*', default=CONDITIONS)
+    parser.add_argument('--images', type=int, default=4, help='Images per condition')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--masks', action='store_true', help='Also write the truth as final_masks')
+    parser.add_argument('--spots-per-cell', type=float, help='Same mean for every condition')
+    for name, value in DEFAULTS.items():
+        if isinstance(value, tuple):
+            continue
+        parser.add_argument('--' + name.replace('_', '-'), type=type(value), default=value)
+    args = parser.parse_args()
+
+    params = {name: getattr(args, name) for name, value in DEFAULTS.items() if not isinstance(value, tuple)}
+    print(f"Generating {args.images} images per condition ({params['z']}x2x{params['size']}x{params['size']})...")
+    spots = generate_dataset(args.data_dir, args.conditions, args.images, args.seed, args.masks,
+                             spots_per_cell=args.spots_per_cell, **params)
+    print(f"\n{len(spots)} ground-truth spots saved to {os.path.join(args.data_dir, TRUTH_DIRNAME)}")
+
+
+if __name__ == "__main__":
+    main()
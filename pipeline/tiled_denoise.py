@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Tiled, Multi-Core BM3D Denoising
+
+`bm3d.bm3d` runs single-threaded on the whole projection. This module splits the
+image into overlapping tiles, denoises the tiles in parallel worker processes
+and blends the seams with smooth windowed weights. The noise level is estimated
+once on the whole image with `estimate_sigma`, so every tile is filtered with
+the same sigma_psd as the whole-image run.
+
+    from tiled_denoise import tiled_bm3d
+    denoised_image = tiled_bm3d(image, strength=100.0, tile_size=512, overlap=64, workers=8)
+
+The validation harness compares tiled output against whole-image BM3D (PSNR)
+and reports the speedup for each worker count, to pick a tile size and overlap
+that keep the output effectively identical:
+
+Usage:
+    python tiled_denoise.py validate                                 # data/processed/*/CH1
+    python tiled_denoise.py validate --tile-sizes 256 512 --overlaps 32 64 --workers 1 4 16
+    python tiled_denoise.py validate --images path/to/a.tif path/to/b.tif --limit 2
+"""
+
+import os
+import glob
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tifffile
+
+from instrumentation import measure
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_IMAGES = os.path.join(BASE_DIR, "data", "processed", "*", "CH1", "*.tif")
+
+DEFAULT_TILE_SIZE = 512
+DEFAULT_OVERLAP = 64
+
+
+def tile_starts(length, tile_size, overlap):
+    """Start offsets along one axis; the last tile is aligned to the image edge."""
+    if tile_size >= length:
+        return [0]
+    stride = tile_size - overlap
+    if stride <= 0:
+        raise ValueError(f"overlap ({overlap}) must be smaller than tile_size ({tile_size})")
+    starts = list(range(0, length - tile_size, stride))
+    starts.append(length - tile_size)
+    return starts
+
+
+def tile_grid(shape, tile_size, overlap):
+    """(y0, y1, x0, x1) for every tile covering an image of `shape`."""
+    height, width = shape
+    return [(y, min(y + tile_size, height), x, min(x + tile_size, width))
+            for y in tile_starts(height, tile_size, overlap)
+            for x in tile_starts(width, tile_size, overlap)]
+
+
+def ramp(length, overlap, at_start, at_end):
+    """1D blending weights: a raised-cosine ramp over `overlap` pixels at inner edges."""
+    weights = np.ones(length)
+    overlap = min(overlap, length // 2)
+    if overlap > 0:
+        # Half-pixel offsets keep every weight strictly positive
+        rising = 0.5 - 0.5 * np.cos(np.pi * (np.arange(overlap) + 0.5) / overlap)
+        if at_start:
+            weights[:overlap] = rising
+        if at_end:
+            weights[-overlap:] = rising[::-1]
+    return weights
+
+
+def blend_window(tile, shape, overlap):
+    """2D window for one tile; edges that touch the image border keep full weight."""
+    y0, y1, x0, x1 = tile
+    wy = ramp(y1 - y0, overlap, y0 > 0, y1 < shape[0])
+    wx = ramp(x1 - x0, overlap, x0 > 0, x1 < shape[1])
+    return np.outer(wy, wx)
+
+
+def _denoise_tile(tile_image, sigma_psd):
+    """Worker entry point: BM3D on one tile with the global sigma_psd."""
+    import bm3d
+    return bm3d.bm3d(tile_image, sigma_psd=sigma_psd)
+
+
+def _limit_worker_threads():
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = '1'
+
+
+def global_sigma_psd(image_float, strength):
+    """sigma_psd for the whole image, as the notebooks compute it."""
+    from skimage.restoration import estimate_sigma
+    with measure('estimate_sigma'):
+        noise_sigma_est = np.mean(estimate_sigma(image_float, channel_axis=None))
+    return noise_sigma_est * strength
+
+
+def tiled_bm3d(image, strength, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP, workers=None):
+    """
+    BM3D-denoise `image` tile by tile and blend the tiles back together.
+
+    Returns a float64 array in the same range as `bm3d.bm3d(img_as_float(image), ...)`.
+    """
+    from skimage.util import img_as_float
+
+    image_float = img_as_float(image)
+    sigma_psd = global_sigma_psd(image_float, strength)
+    tiles = tile_grid(image_float.shape, tile_size, overlap)
+    tile_images = [np.ascontiguousarray(image_float[y0:y1, x0:x1]) for y0, y1, x0, x1 in tiles]
+
+    workers = workers or os.cpu_count()
+    with measure('bm3d', tiles=len(tiles)):
+        if workers == 1 or len(tiles) == 1:
+            results = [_denoise_tile(t, sigma_psd) for t in tile_images]
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(tiles)),
+                                     mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_limit_worker_threads) as executor:
+                results = list(executor.map(_denoise_tile, tile_images, [sigma_psd] * len(tiles)))
+
+    accumulated = np.zeros(image_float.shape)
+    weight_sum = np.zeros(image_float.shape)
+    for tile, denoised_tile in zip(tiles, results):
+        y0, y1, x0, x1 = tile
+        window = blend_window(tile, image_float.shape, overlap)
+        accumulated[y0:y1, x0:x1] += denoised_tile * window
+        weight_sum[y0:y1, x0:x1] += window
+    return accumulated / weight_sum
+
+
+def psnr(reference, test, data_range=1.0):
+    """Peak signal-to-noise ratio of `test` against `reference` in dB."""
+    mse = np.mean((np.asarray(reference, dtype=np.float64) - test) ** 2)
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(data_range ** 2 / mse)
+
+
+def validate(image_paths, tile_sizes, overlaps, worker_counts, strength):
+    """Compare tiled BM3D with whole-image BM3D: PSNR per setting and speedup per worker count."""
+    from denoise_cache import bm3d_denoise
+
+    rows = []
+    for path in image_paths:
+        image = tifffile.imread(path)
+        name = os.path.basename(path)
+        print(f"\n{name} {image.shape}")
+
+        start = time.perf_counter()
+        reference = bm3d_denoise(image, strength)
+        reference_time = time.perf_counter() - start
+        print(f"  whole-image BM3D: {reference_time:7.2f}s")
+
+        for tile_size in tile_sizes:
+            for overlap in overlaps:
+                if overlap >= tile_size:
+                    continue
+                for workers in worker_counts:
+                    start = time.perf_counter()
+                    tiled = tiled_bm3d(image, strength, tile_size, overlap, workers)
+                    elapsed = time.perf_counter() - start
+                    row = {
+                        'image': name, 'tile_size': tile_size, 'overlap': overlap, 'workers': workers,
+                        'psnr_db': psnr(reference, tiled), 'max_abs_diff': float(np.abs(reference - tiled).max()),
+                        'seconds': elapsed, 'speedup': reference_time / elapsed,
+                    }
+                    rows.append(row)
+                    print(f"  tile={tile_size:<5} overlap={overlap:<4} workers={workers:<3} "
+                          f"PSNR={row['psnr_db']:6.1f} dB  max|Δ|={row['max_abs_diff']:.2e}  "
+                          f"{elapsed:7.2f}s  speedup={row['speedup']:5.2f}x")
+
+    print("\n" + "=" * 70)
+    print("Mean over images (PSNR and speedup against whole-image BM3D)")
+    settings = sorted({(r['tile_size'], r['overlap'], r['workers']) for r in rows})
+    for tile_size, overlap, workers in settings:
+        subset = [r for r in rows if (r['tile_size'], r['overlap'], r['workers']) == (tile_size, overlap, workers)]
+        mean_psnr = np.mean([min(r['psnr_db'], 200.0) for r in subset])
+        mean_speedup = np.mean([r['speedup'] for r in subset])
+        print(f"  tile={tile_size:<5} overlap={overlap:<4} workers={workers:<3} "
+              f"PSNR={mean_psnr:6.1f} dB  speedup={mean_speedup:5.2f}x")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tiled multi-core BM3D denoising")
+    subparsers = parser.add_subparsers(dest='command')
+    check = subparsers.add_parser('validate', help='PSNR and speedup against whole-image BM3D')
+    check.add_argument('--images', nargs='*', help=f'Images to test (default: {DEFAULT_IMAGES})')
+    check.add_argument('--limit', type=int, default=3, help='Maximum number of images')
+    check.add_argument('--tile-sizes', nargs='*', type=int, default=[256, DEFAULT_TILE_SIZE])
+    check.add_argument('--overlaps', nargs='*', type=int, default=[32, DEFAULT_OVERLAP])
+    check.add_argument('--workers', nargs='*', type=int, default=[1, 2, 4, os.cpu_count()])
+    check.add_argument('--strength', type=float, default=100.0, help='DENOISING_STRENGTH_FACTOR')
+    args = parser.parse_args()
+
+    if args.command == 'validate':
+        image_paths = sorted(args.images or glob.glob(DEFAULT_IMAGES))[:args.limit]
+        if not image_paths:
+            print("No images found to validate.")
+            return
+        validate(image_paths, args.tile_sizes, args.overlaps, sorted(set(args.workers)), args.strength)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
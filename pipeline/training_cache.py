@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Precomputed Training-Flow Cache for Cellpose Fine-Tuning
+
+`train.train_seg(train_files=..., train_labels_files=...)` reads every TIFF
+again and recomputes the flows of every label image on each fine-tuning run,
+although a sweep over learning_rate / n_epochs / weight_decay never changes
+them. This module prepares each image-label pair once:
+
+- flows: `cellpose.dynamics.labels_to_flows` of the label image, the
+  (4, Y, X) float32 array (labels, cell probability, dY, dX) Cellpose trains
+  on, keyed by the label file's content hash and the cellpose version
+- images: the image normalized to its 1st-99th percentiles as float32
+  (Cellpose's normalize99), keyed by the image file's content hash
+
+Entries are .npy files under SMFISH_TRAINING_CACHE (default
+pipeline/.pipeline_cache/training), written atomically, so concurrent
+preparation is safe. Later runs open them memory-mapped and pass them as
+`train_data`/`train_labels` with `normalize=False`. Cellpose sees precomputed
+flows and skips recomputing them.
+
+    from training_cache import prepare_training_set, load_training_set
+    entries = prepare_training_set(train_files, train_labels_files)
+    train_data, train_labels = load_training_set(entries)
+    train.train_seg(model.net, train_data=train_data, train_labels=train_labels, normalize=False, ...)
+
+Usage:
+    python training_cache.py prepare --images ../data/training/images/nucleus_binary --labels ../data/training/labels/nucleus
+    python training_cache.py stats
+    python training_cache.py clear
+"""
+
+import os
+import time
+import hashlib
+import argparse
+import multiprocessing
+from importlib import metadata
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from denoise_cache import store, list_entries as list_shards, evict as evict_shards
+from incremental import hash_file, flush_file_hashes
+from instrumentation import measure, tiff_read
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.environ.get('SMFISH_TRAINING_CACHE', os.path.join(BASE_DIR, '.pipeline_cache', 'training'))
+
+# Cellpose's normalize99 percentiles
+NORMALIZE_LOWER = 1.0
+NORMALIZE_UPPER = 99.0
+
+
+def cellpose_version():
+    """Installed cellpose version, part of every flow key."""
+    try:
+        return metadata.version('cellpose')
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def flow_key(label_path):
+    """Cache key for the flows of a label file."""
+    digest = hashlib.sha256()
+    digest.update(hash_file(label_path).encode())
+    digest.update(f"flows,cellpose={cellpose_version()}".encode())
+    return digest.hexdigest()
+
+
+def image_key(image_path, lower=NORMALIZE_LOWER, upper=NORMALIZE_UPPER):
+    """Cache key for the normalized float32 version of an image file."""
+    digest = hashlib.sha256()
+    digest.update(hash_file(image_path).encode())
+    digest.update(f"normalize={float(lower)},{float(upper)}".encode())
+    return digest.hexdigest()
+
+
+def entry_path(kind, key, cache_dir=None):
+    """Location of a cache entry: <cache>/<kind>/<key[:2]>/<key>.npy."""
+    return os.path.join(cache_dir or CACHE_DIR, kind, key[:2], f"{key}.npy")
+
+
+def normalize_image(image, lower=NORMALIZE_LOWER, upper=NORMALIZE_UPPER):
+    """Scale so the `lower` and `upper` percentiles map to 0 and 1, as Cellpose's normalize99 does."""
+    image = np.asarray(image, dtype=np.float32)
+    low, high = np.percentile(image, [lower, upper])
+    if high - low <= 1e-3:
+        return np.zeros_like(image)
+    return (image - np.float32(low)) / np.float32(high - low)
+
+
+def compute_flows(labels):
+    """(4, Y, X) float32 training target of a label image."""
+    from cellpose import dynamics
+    return np.asarray(dynamics.labels_to_flows([labels])[0], dtype=np.float32)
+
+
+def prepare_pair(image_path, label_path, image_entry, flow_entry):
+    """
+    Worker entry point: write whichever of the two entries is missing.
+
+    Returns (images computed, flows computed) or the error text.
+    """
+    try:
+        made = [0, 0]
+        if not os.path.exists(image_entry):
+            with measure('training_normalize', image=os.path.basename(image_path)):
+                store(image_entry, normalize_image(tiff_read(image_path)))
+            made[0] = 1
+        if not os.path.exists(flow_entry):
+            labels = tiff_read(label_path)
+            with measure('training_flows', image=os.path.basename(label_path)):
+                store(flow_entry, compute_flows(labels))
+            made[1] = 1
+        return tuple(made)
+    except Exception as e:
+        return str(e)
+
+
+def prepare_training_set(image_files, label_files, cache_dir=None, workers=None):
+    """
+    Normalized images and flows for every pair, computed only where not cached yet.
+
+    Returns [(image_path, label_path, image_entry, flow_entry)] for the pairs
+    that are ready; pairs that fail are reported and left out.
+    """
+    if len(image_files) != len(label_files):
+        raise ValueError(f"{len(image_files)} images but {len(label_files)} label files")
+    workers = workers or int(os.environ.get("SMFISH_CORES", os.cpu_count()))
+    entries = [(image_path, label_path, entry_path('images', image_key(image_path), cache_dir),
+                entry_path('flows', flow_key(label_path), cache_dir))
+               for image_path, label_path in zip(image_files, label_files)]
+    flush_file_hashes()
+
+    pending = [entry for entry in entries if not (os.path.exists(entry[2]) and os.path.exists(entry[3]))]
+    ready, images_made, flows_made = [], 0, 0
+    if pending:
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending)),
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            results = dict(zip(pending, executor.map(prepare_pair, *zip(*pending))))
+    else:
+        results = {}
+    for entry in entries:
+        result = results.get(entry, (0, 0))
+        if isinstance(result, str):
+            print(f"  - FAILED to process {os.path.basename(entry[0])}: {result}")
+            continue
+        images_made += result[0]
+        flows_made += result[1]
+        ready.append(entry)
+    print(f"Training cache: {len(ready)} pairs ready ({images_made} images normalized, {flows_made} flows "
+          f"computed, {len(ready) * 2 - images_made - flows_made} entries reused)")
+    return ready
+
+
+def load_training_set(entries):
+    """Memory-mapped (train_data, train_labels) lists for `train.train_seg`."""
+    train_data = [np.load(image_entry, mmap_mode='r') for _, _, image_entry, _ in entries]
+    train_labels = [np.load(flow_entry, mmap_mode='r') for _, _, _, flow_entry in entries]
+    for path in (p for _, _, image_entry, flow_entry in entries for p in (image_entry, flow_entry)):
+        # Reading counts as a use for LRU pruning
+        os.utime(path)
+    return train_data, train_labels
+
+
+def match_pairs(image_dir, label_dir, suffix='_projection.tif'):
+    """(image_files, label_files) with the same filename in both folders, as 3_model_training pairs them."""
+    image_files, label_files = [], []
+    for filename in sorted(f for f in os.listdir(image_dir) if f.endswith(suffix)):
+        label_path = os.path.join(label_dir, filename)
+        if os.path.exists(label_path):
+            image_files.append(os.path.join(image_dir, filename))
+            label_files.append(label_path)
+        else:
+            print(f"Warning: Found image '{filename}' but no corresponding label. Skipping.")
+    return image_files, label_files
+
+
+def shard_roots(cache_dir=None):
+    """The sharded folders of the cache, laid out like the denoise cache."""
+    root = cache_dir or CACHE_DIR
+    return [os.path.join(root, 'images'), os.path.join(root, 'flows')]
+
+
+def list_entries(cache_dir=None):
+    """(mtime, size, path) for every cache entry, oldest first."""
+    return list_shards(shard_roots(cache_dir))
+
+
+def evict(cache_dir=None, max_bytes=0):
+    """Delete least recently used entries until the cache fits in `max_bytes`."""
+    return evict_shards(shard_roots(cache_dir), max_bytes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precomputed flows and normalized images for Cellpose training")
+    parser.add_argument('command', choices=['prepare', 'stats', 'prune', 'clear'])
+    parser.add_argument('--images', help='Training image folder (prepare)')
+    parser.add_argument('--labels', help='Training label folder (prepare)')
+    parser.add_argument('--suffix', default='_projection.tif', help='Image filename suffix (prepare)')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='Cache folder')
+    parser.add_argument('--workers', type=int, help='Worker processes (default: SMFISH_CORES or all cores)')
+    parser.add_argument('--max-gb', type=float, default=10.0, help='Size limit for prune')
+    args = parser.parse_args()
+
+    if args.command == 'prepare':
+        if not args.images or not args.labels:
+            parser.error("prepare needs --images and --labels")
+        image_files, label_files = match_pairs(args.images, args.labels, args.suffix)
+        start = time.perf_counter()
+        prepare_training_set(image_files, label_files, args.cache_dir, args.workers)
+        print(f"Prepared in {time.perf_counter() - start:.1f}s, cache: {args.cache_dir}")
+    elif args.command == 'stats':
+        entries = list_entries(args.cache_dir)
+        images = sum(1 for _, _, path in entries if f"{os.sep}images{os.sep}" in path)
+        print(f"Cache folder: {args.cache_dir}")
+        print(f"Entries: {images} images, {len(entries) - images} flows")
+        print(f"Size: {sum(size for _, size, _ in entries) / 1e9:.2f} GB")
+        if entries:
+            print(f"Oldest use: {time.ctime(entries[0][0])}")
+            print(f"Newest use: {time.ctime(entries[-1][0])}")
+    elif args.command == 'prune':
+        print(f"Removed {evict(args.cache_dir, int(args.max_gb * 1e9))} entries")
+    elif args.command == 'clear':
+        print(f"Removed {evict(args.cache_dir, 0)} entries")
+
+
+if __name__ == "__main__":
+    main()
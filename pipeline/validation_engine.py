@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Segmentation Validation Engine
+
+4_1_validation_smfish.ipynb and 4_2_validation_nucleus.ipynb plot the first
+three predictions next to their manual labels. This module scores every
+labelled training image instead. Images are prepared over a process pool (BM3D
+through the shared cache for the cell model) and segmented in batches by
+SegmentationService. Every prediction is then matched to its ground truth.
+
+Matching works on a sparse label-overlap matrix: the (true, predicted) label
+pairs that share at least one pixel, with their intersection counted once over
+the image. IoU is computed only for those pairs. At each IoU threshold, true and
+predicted objects are paired one-to-one (Hungarian assignment over the
+candidate pairs; above 0.5 IoU every object has at most one candidate).
+Matched pairs are true positives, unmatched predictions false positives and
+unmatched labels false negatives, giving:
+
+    precision = TP / (TP + FP)     recall = TP / (TP + FN)
+    F1 = 2 TP / (2 TP + FP + FN)   AP = TP / (TP + FP + FN)
+
+AP is the Cellpose/StarDist "average precision" of one image at one
+threshold. Tables in results/tables/validation/:
+
+    <model>_per_image.csv   one row per image and threshold
+    <model>_summary.csv     per threshold: pooled counts and scores, mean per-image AP
+
+`--min-ap` exits with an error when the pooled AP at `--gate-threshold` is
+lower, to gate model promotion.
+
+Usage:
+    python validation_engine.py run --model cell                   # fine-tuned model on data/training/*/fish
+    python validation_engine.py run --model nucleus --workers 8 --min-ap 0.7
+    python validation_engine.py score --labels ../labels --predictions ../masks --name candidate
+"""
+
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+
+from instrumentation import measure, tiff_read
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TRAINING_DIR = os.path.join(BASE_DIR, "data", "training")
+VALIDATION_DIR = os.path.join(BASE_DIR, "results", "tables", "validation")
+
+IOU_THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.9)
+GATE_THRESHOLD = 0.5
+DENOISING_STRENGTH_FACTOR = 100.0
+
+# Image and label folders under data/training, and the segmentation pass each model uses
+VALIDATION_SETS = {
+    'cell': {'images': 'fish', 'labels': 'fish', 'pass': 'cell'},
+    'nucleus': {'images': 'nucleus_binary', 'labels': 'nucleus', 'pass': 'nucleus'},
+}
+
+METRIC_COLUMNS = ['threshold', 'n_true', 'n_pred', 'tp', 'fp', 'fn', 'precision', 'recall', 'f1', 'ap',
+                  'mean_matched_iou']
+
+
+def label_overlap(true_mask, pred_mask):
+    """
+    Sparse overlap of two label images.
+
+    Returns (true_labels, pred_labels, intersection) for every pair of
+    non-zero labels sharing pixels, plus the pixel area of every label in
+    each image (indexed by label).
+    """
+    if true_mask.shape != pred_mask.shape:
+        raise ValueError(f"Prediction shape {pred_mask.shape} does not match labels {true_mask.shape}")
+    true_flat = true_mask.ravel().astype(np.int64)
+    pred_flat = pred_mask.ravel().astype(np.int64)
+    true_area = np.bincount(true_flat)
+    pred_area = np.bincount(pred_flat)
+
+    both = (true_flat > 0) & (pred_flat > 0)
+    pair = true_flat[both] * len(pred_area) + pred_flat[both]
+    pairs, intersection = np.unique(pair, return_counts=True)
+    return pairs // len(pred_area), pairs % len(pred_area), intersection, true_area, pred_area
+
+
+def pair_iou(true_labels, pred_labels, intersection, true_area, pred_area):
+    """IoU of every overlapping pair."""
+    return intersection / (true_area[true_labels] + pred_area[pred_labels] - intersection)
+
+
+def matched_pairs(true_labels, pred_labels, iou, threshold):
+    """IoU values of a one-to-one matching that maximizes true positives at `threshold`."""
+    keep = iou >= threshold
+    true_labels, pred_labels, iou = true_labels[keep], pred_labels[keep], iou[keep]
+    if not len(iou):
+        return iou
+    if threshold > 0.5:
+        # Each object overlaps at most one other by more than half of their union
+        return iou
+    rows, row_index = np.unique(true_labels, return_inverse=True)
+    cols, col_index = np.unique(pred_labels, return_inverse=True)
+    cost = np.zeros((len(rows), len(cols)))
+    # Candidates score above any non-candidate; IoU breaks ties between matchings of equal size
+    cost[row_index, col_index] = -(1.0 + iou)
+    matched_rows, matched_cols = linear_sum_assignment(cost)
+    scores = -cost[matched_rows, matched_cols] - 1.0
+    return scores[scores >= threshold]
+
+
+def _rates(n_true, n_pred, tp):
+    fp, fn = n_pred - tp, n_true - tp
+    return {'tp': tp, 'fp': fp, 'fn': fn,
+            'precision': tp / n_pred if n_pred else np.nan,
+            'recall': tp / n_true if n_true else np.nan,
+            'f1': 2 * tp / (2 * tp + fp + fn) if tp + fp + fn else np.nan,
+            'ap': tp / (tp + fp + fn) if tp + fp + fn else np.nan}
+
+
+def instance_metrics(true_mask, pred_mask, thresholds=IOU_THRESHOLDS):
+    """One dict of METRIC_COLUMNS per IoU threshold for a prediction against its labels."""
+    true_labels, pred_labels, intersection, true_area, pred_area = label_overlap(true_mask, pred_mask)
+    iou = pair_iou(true_labels, pred_labels, intersection, true_area, pred_area)
+    n_true = int(np.count_nonzero(true_area[1:]))
+    n_pred = int(np.count_nonzero(pred_area[1:]))
+
+    rows = []
+    for threshold in thresholds:
+        matched = matched_pairs(true_labels, pred_labels, iou, threshold)
+        row = {'threshold': threshold, 'n_true': n_true, 'n_pred': n_pred}
+        row.update(_rates(n_true, n_pred, len(matched)))
+        row['mean_matched_iou'] = float(matched.mean()) if len(matched) else np.nan
+        rows.append(row)
+    return rows
+
+
+def score_image(filename, true_mask, pred_mask, thresholds=IOU_THRESHOLDS):
+    """Worker entry point: per-threshold rows for one image, or the error text."""
+    try:
+        true_mask = tiff_read(true_mask) if isinstance(true_mask, str) else true_mask
+        pred_mask = tiff_read(pred_mask) if isinstance(pred_mask, str) else pred_mask
+        with measure('validation_metrics', image=filename):
+            rows = instance_metrics(true_mask, pred_mask, thresholds)
+        return [dict({'image': filename}, **row) for row in rows]
+    except Exception as e:
+        return str(e)
+
+
+def summarize(per_image):
+    """Per threshold: counts pooled over images, the scores they give, and the mean per-image AP."""
+    rows = []
+    for threshold, group in per_image.groupby('threshold', sort=True):
+        n_true, n_pred, tp = (int(group[c].sum()) for c in ('n_true', 'n_pred', 'tp'))
+        row = {'threshold': threshold, 'images': len(group), 'n_true': n_true, 'n_pred': n_pred}
+        row.update(_rates(n_true, n_pred, tp))
+        row['mean_image_ap'] = group['ap'].mean()
+        row['mean_image_f1'] = group['f1'].mean()
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def score_predictions(items, thresholds=IOU_THRESHOLDS, workers=None):
+    """
+    Score (filename, true_mask, pred_mask) items over a process pool.
+
+    Masks may be arrays or TIFF paths. Returns (per_image, summary) tables;
+    images that fail are reported and left out.
+    """
+    workers = workers or int(os.environ.get("SMFISH_CORES", os.cpu_count()))
+    rows = []
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(items) or 1)),
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(score_image, *item, thresholds) for item in items]
+        for item, future in zip(items, futures):
+            result = future.result()
+            if isinstance(result, str):
+                print(f"  - FAILED to process {item[0]}: {result}")
+            else:
+                rows.extend(result)
+    per_image = pd.DataFrame(rows, columns=['image'] + METRIC_COLUMNS)
+    return per_image, summarize(per_image)
+
+
+def labelled_pairs(image_dir, label_dir, suffix='_projection.tif'):
+    """(filename, image_path, label_path) for every image with a label of the same name."""
+    pairs = []
+    for filename in sorted(f for f in os.listdir(image_dir) if f.endswith(suffix)):
+        label_path = os.path.join(label_dir, filename)
+        if os.path.exists(label_path):
+            pairs.append((filename, os.path.join(image_dir, filename), label_path))
+        else:
+            print(f"Could not find a matching label for image '{filename}'. Skipping.")
+    return pairs
+
+
+def prepare_image(image_path, denoise=False, strength=DENOISING_STRENGTH_FACTOR, denoiser='bm3d'):
+    """Worker entry point: the model input for one image (denoised through the shared cache if asked)."""
+    image = tiff_read(image_path)
+    if denoise:
+        from denoise_cache import cached_denoise
+        return cached_denoise(image, strength, method=denoiser, workers=1)
+    return image
+
+
+def validate(model='cell', service=None, training_dir=TRAINING_DIR, thresholds=IOU_THRESHOLDS, workers=None,
+             strength=DENOISING_STRENGTH_FACTOR, denoiser='bm3d', limit=None):
+    """
+    Segment every labelled image of a validation set and score it.
+
+    Returns (per_image, summary, samples), where samples is a list of
+    (filename, image, ground_truth_mask, predicted_mask) for plotting.
+    """
+    from segmentation_service import SegmentationService, PASSES
+
+    spec = VALIDATION_SETS[model]
+    pass_spec = PASSES[spec['pass']]
+    pairs = labelled_pairs(os.path.join(training_dir, "images", spec['images']),
+                           os.path.join(training_dir, "labels", spec['labels']))[:limit]
+    workers = workers or int(os.environ.get("SMFISH_CORES", os.cpu_count()))
+    service = service or SegmentationService(gpu=True)
+
+    ready, inputs = [], []
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(pairs) or 1)),
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(prepare_image, image_path, pass_spec['denoise'], strength, denoiser)
+                   for _, image_path, _ in pairs]
+        for pair, future in zip(pairs, futures):
+            try:
+                inputs.append(future.result())
+                ready.append(pair)
+            except Exception as e:
+                print(f"  - FAILED to process {pair[0]}: {e}")
+
+    print(f"Segmenting {len(inputs)} labelled images...")
+    predicted_masks = service.segment(inputs, **pass_spec['model'], **pass_spec['eval'])
+
+    items = [(filename, label_path, predicted) for (filename, _, label_path), predicted in zip(ready, predicted_masks)]
+    per_image, summary = score_predictions(items, thresholds, workers)
+    samples = [(filename, tiff_read(image_path), tiff_read(label_path), predicted)
+               for (filename, image_path, label_path), predicted in zip(ready[:3], predicted_masks)]
+    return per_image, summary, samples
+
+
+def save_tables(name, per_image, summary, output_dir=VALIDATION_DIR):
+    """Write <name>_per_image.csv and <name>_summary.csv; returns their paths."""
+    os.makedirs(output_dir, exist_ok=True)
+    paths = (os.path.join(output_dir, f"{name}_per_image.csv"), os.path.join(output_dir, f"{name}_summary.csv"))
+    per_image.to_csv(paths[0], index=False)
+    summary.to_csv(paths[1], index=False)
+    return paths
+
+
+def print_summary(summary):
+    print(summary.to_string(index=False, float_format=lambda v: f"{v:.3f}"))
+
+
+def gate(summary, min_ap, threshold=GATE_THRESHOLD):
+    """True when the pooled AP at `threshold` reaches `min_ap`."""
+    row = summary[np.isclose(summary['threshold'], threshold)]
+    if row.empty:
+        print(f"✗ No results at IoU {threshold}")
+        return False
+    ap = float(row['ap'].iloc[0])
+    passed = ap >= min_ap
+    print(f"{'✓' if passed else '✗'} AP@{threshold:g} = {ap:.3f} (required {min_ap:.3f})")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IoU-matched precision/recall/F1/AP over every labelled image")
+    parser.add_argument('command', choices=['run', 'score'])
+    parser.add_argument('--model', default='cell', choices=list(VALIDATION_SETS), help='Validation set (run)')
+    parser.add_argument('--training-dir', default=TRAINING_DIR)
+    parser.add_argument('--labels', help='Ground-truth label folder (score)')
+    parser.add_argument('--predictions', help='Predicted mask folder with the same filenames (score)')
+    parser.add_argument('--name', help='Table name (default: the model, or "predictions" for score)')
+    parser.add_argument('--thresholds', nargs='*', type=float, default=list(IOU_THRESHOLDS))
+    parser.add_argument('--workers', type=int, help='Worker processes (default: SMFISH_CORES or all cores)')
+    parser.add_argument('--denoiser', default='bm3d', help='Backend from denoisers.py for the cell model')
+    parser.add_argument('--limit', type=int, help='Only the first N labelled images')
+    parser.add_argument('--output-dir', default=VALIDATION_DIR)
+    parser.add_argument('--min-ap', type=float, help='Exit with an error below this pooled AP')
+    parser.add_argument('--gate-threshold', type=float, default=GATE_THRESHOLD)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'score':
+        if not args.labels or not args.predictions:
+            parser.error("score needs --labels and --predictions")
+        items = []
+        for filename in sorted(f for f in os.listdir(args.labels) if f.endswith(('.tif', '.tiff'))):
+            prediction = os.path.join(args.predictions, filename)
+            if os.path.exists(prediction):
+                items.append((filename, os.path.join(args.labels, filename), prediction))
+            else:
+                print(f"  - {filename}: no prediction")
+        per_image, summary = score_predictions(items[:args.limit], args.thresholds, args.workers)
+        name = args.name or 'predictions'
+    else:
+        per_image, summary, _ = validate(args.model, training_dir=args.training_dir, thresholds=args.thresholds,
+                                         workers=args.workers, denoiser=args.denoiser, limit=args.limit)
+        name = args.name or args.model
+
+    print(f"\n{per_image['image'].nunique()} images scored in {time.perf_counter() - start:.1f}s")
+    print_summary(summary)
+    paths = save_tables(name, per_image, summary, args.output_dir)
+    print(f"Tables saved to: {', '.join(paths)}")
+    if args.min_ap is not None and not gate(summary, args.min_ap, args.gate_threshold):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Warm In-Process Stage Engine
+
+Runs pipeline notebooks inside one long-lived worker process instead of a new
+`jupyter nbconvert --execute` kernel per notebook. The worker imports the heavy
+modules (torch, cellpose, skimage, bm3d, ...) once and keeps every
+`CellposeModel` it builds, so later stages asking for the same model reuse the
+loaded instance instead of reading the weights from disk again.
+
+Notebook code cells are executed top to bottom in a fresh namespace with the
+notebook's directory as working directory, exactly as nbconvert would, but the
+notebook file itself is not rewritten.
+
+Usage:
+    python run_pipeline.py --all --engine warm      # Use the warm worker from the runner
+    python warm_worker.py benchmark                 # Startup time: warm worker vs nbconvert
+    python warm_worker.py benchmark --repeats 5
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import traceback
+import subprocess
+import importlib
+import importlib.util
+import multiprocessing as mp
+
+from instrumentation import measure
+
+# Imported once when the worker starts; missing optional packages are skipped
+PRELOAD_MODULES = [
+    'numpy',
+    'scipy.ndimage',
+    'pandas',
+    'tifffile',
+    'matplotlib.pyplot',
+    'skimage.filters',
+    'skimage.feature',
+    'skimage.restoration',
+    'bm3d',
+    'torch',
+    'cellpose.models',
+]
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def preload_modules(names=PRELOAD_MODULES):
+    """Import the heavy modules up front and return {module: seconds}."""
+    timings = {}
+    for name in names:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            continue
+        timings[name] = time.perf_counter() - start
+    return timings
+
+
+def model_cache_key(args, kwargs):
+    """Hashable key for a CellposeModel call; custom weights are keyed on their mtime too."""
+    key = [repr(args), repr(sorted(kwargs.items()))]
+    pretrained = kwargs.get('pretrained_model')
+    if isinstance(pretrained, (str, os.PathLike)) and os.path.exists(pretrained):
+        key.append(os.path.getmtime(pretrained))
+    return tuple(key)
+
+
+def install_model_cache(cache):
+    """
+    Make `cellpose.models.CellposeModel(...)` return cached instances.
+
+    Returns a function that restores the original class.
+    """
+    try:
+        from cellpose import models
+    except ImportError:
+        return lambda: None
+
+    original = models.CellposeModel
+
+    def cached_model(*args, **kwargs):
+        key = model_cache_key(args, kwargs)
+        if key not in cache:
+            cache[key] = original(*args, **kwargs)
+        else:
+            print(f"(warm worker) reusing loaded CellposeModel {kwargs}")
+        return cache[key]
+
+    models.CellposeModel = cached_model
+    return lambda: setattr(models, 'CellposeModel', original)
+
+
+def execute_notebook(notebook_path, env, model_cache, reuse_models=True):
+    """Execute the code cells of a notebook in-process from the notebook's directory."""
+    notebook_path = os.path.abspath(notebook_path)
+    with open(notebook_path) as f:
+        notebook = json.load(f)
+
+    saved_cwd = os.getcwd()
+    saved_env = {name: os.environ.get(name) for name in env}
+    saved_path = list(sys.path)
+    os.environ.update(env)
+    os.chdir(os.path.dirname(notebook_path))
+    sys.path.insert(0, os.getcwd())
+    restore_models = install_model_cache(model_cache) if reuse_models else (lambda: None)
+
+    namespace = {'__name__': '__main__'}
+    try:
+        for i, cell in enumerate(notebook['cells']):
+            if cell['cell_type'] != 'code':
+                continue
+            source = ''.join(cell['source'])
+            code = compile(source, f"<{os.path.basename(notebook_path)} cell {i}>", 'exec')
+            exec(code, namespace)
+    finally:
+        restore_models()
+        sys.path[:] = saved_path
+        os.chdir(saved_cwd)
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        try:
+            import matplotlib.pyplot as plt
+            plt.close('all')
+        except ImportError:
+            pass
+
+
+def worker_main(connection, cores):
+    """Worker loop: preload modules, then execute notebooks until told to stop."""
+    if cores:
+        for var in THREAD_ENV_VARS:
+            os.environ[var] = str(cores)
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+    timings = preload_modules()
+    if cores and 'torch' in timings:
+        import torch
+        torch.set_num_threads(cores)
+    connection.send(('ready', timings))
+
+    model_cache = {}
+    while True:
+        message = connection.recv()
+        if message[0] == 'stop':
+            break
+        _, notebook_path, env, reuse_models = message
+        start = time.perf_counter()
+        try:
+            with measure('notebook', notebook=env.get('SMFISH_PROFILE_NOTEBOOK', notebook_path),
+                         channels=env.get('SMFISH_CHANNELS')):
+                execute_notebook(notebook_path, env, model_cache, reuse_models)
+            connection.send(('ok', None, time.perf_counter() - start))
+        except BaseException:
+            connection.send(('error', traceback.format_exc(), time.perf_counter() - start))
+
+
+class WarmWorker:
+    """Handle to a persistent worker process that executes notebooks."""
+
+    def __init__(self, cores=None):
+        context = mp.get_context('spawn')
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_connection, cores), daemon=True)
+        self.process.start()
+        # Only the child keeps its end open, so a crashed worker shows up as EOFError
+        child_connection.close()
+        _, self.preload_timings = self.connection.recv()
+
+    def is_alive(self):
+        """True while the worker process is running."""
+        return self.process.is_alive()
+
+    def run(self, notebook_path, env=None, reuse_models=True):
+        """Execute a notebook in the worker; returns (ok, error_text, seconds)."""
+        try:
+            self.connection.send(('run', notebook_path, dict(env or {}), reuse_models))
+            status, error, seconds = self.connection.recv()
+        except (EOFError, OSError):
+            # The worker died before or while running the notebook (BrokenPipeError on send, EOFError on recv)
+            self.process.join(timeout=1)
+            return False, f"warm worker exited with code {self.process.exitcode}", 0.0
+        return status == 'ok', error, seconds
+
+    def close(self):
+        """Stop the worker process."""
+        if self.process.is_alive():
+            try:
+                self.connection.send(('stop',))
+            except OSError:
+                pass
+            self.process.join(timeout=30)
+        self.connection.close()
+
+
+# --- Startup benchmark ---
+
+def write_probe_notebook(folder, modules):
+    """A one-cell notebook that only imports `modules`, used to time startup cost."""
+    source = '\n'.join(f"import {name}" for name in modules)
+    notebook = {
+        'cells': [{'cell_type': 'code', 'execution_count': None, 'id': 'probe',
+                   'metadata': {}, 'outputs': [], 'source': [source]}],
+        'metadata': {'kernelspec': {'display_name': 'Python 3', 'language': 'python', 'name': 'python3'}},
+        'nbformat': 4,
+        'nbformat_minor': 5,
+    }
+    path = os.path.join(folder, 'startup_probe.ipynb')
+    with open(path, 'w') as f:
+        json.dump(notebook, f)
+    return path
+
+
+def benchmark_startup(repeats=3):
+    """Time the per-notebook startup cost of nbconvert against the warm worker."""
+    modules = [name for name in PRELOAD_MODULES if importlib.util.find_spec(name.split('.')[0])]
+    print(f"Probe notebook imports: {', '.join(modules)}")
+
+    with tempfile.TemporaryDirectory() as folder:
+        probe = write_probe_notebook(folder, modules)
+
+        print(f"\n--- nbconvert ({repeats} runs) ---")
+        nbconvert_times = []
+        for i in range(repeats):
+            start = time.perf_counter()
+            result = subprocess.run(['jupyter', 'nbconvert', '--to', 'notebook', '--execute',
+                                     '--stdout', probe], capture_output=True, text=True)
+            elapsed = time.perf_counter() - start
+            if result.returncode != 0:
+                print(f"✗ nbconvert failed: {result.stderr.strip()[-300:]}")
+                break
+            nbconvert_times.append(elapsed)
+            print(f"  run {i + 1}: {elapsed:6.2f}s")
+
+        print(f"\n--- warm worker ({repeats} runs) ---")
+        start = time.perf_counter()
+        worker = WarmWorker()
+        spawn_time = time.perf_counter() - start
+        print(f"  worker start + preload: {spawn_time:6.2f}s (paid once per pipeline run)")
+        warm_times = []
+        try:
+            for i in range(repeats):
+                ok, error, elapsed = worker.run(probe)
+                if not ok:
+                    print(f"✗ warm worker failed: {error}")
+                    break
+                warm_times.append(elapsed)
+                print(f"  run {i + 1}: {elapsed:6.2f}s")
+        finally:
+            worker.close()
+
+    print("\n" + "=" * 50)
+    if nbconvert_times and warm_times:
+        per_nbconvert = sum(nbconvert_times) / len(nbconvert_times)
+        per_warm = sum(warm_times) / len(warm_times)
+        print(f"nbconvert mean per notebook:   {per_nbconvert:6.2f}s")
+        print(f"warm worker mean per notebook: {per_warm:6.2f}s")
+        for count in (1, 13):
+            print(f"{count:>2} notebooks: nbconvert {per_nbconvert * count:7.1f}s "
+                  f"vs warm {spawn_time + per_warm * count:7.1f}s")
+    return nbconvert_times, warm_times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Warm in-process stage engine")
+    subparsers = parser.add_subparsers(dest='command')
+    bench = subparsers.add_parser('benchmark', help='Compare startup time against nbconvert')
+    bench.add_argument('--repeats', type=int, default=3, help='Runs per engine')
+    args = parser.parse_args()
+
+    if args.command == 'benchmark':
+        benchmark_startup(args.repeats)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Chunked Zarr Store for Projections, Denoised Images and Masks
+
+An optional alternative to the folders of small TIFFs under data/processed
+and data/final_masks. Each condition is one Zarr group; each kind of image is
+one compressed 3D array of shape (images, Y, X), chunked per image and tile:
+
+    data/zarr/<condition>.zarr/
+        CH0, CH1                 projections           (data/processed/<cond>/CH0|CH1)
+        CH1_denoised             denoised CH1 images
+        CH0_masks, CH1_masks     final label masks     (data/final_masks/<cond>/CH*_masks)
+
+The per-image index (filename → position and original shape) lives in the
+array attributes, so listing a condition reads one small JSON document instead
+of a directory, and reading an image decodes only that image's chunks.
+
+Readers go through `ImageSource`, which serves the same filenames from either
+layout; SMFISH_STORAGE=zarr selects the Zarr store (default: tiff):
+
+    from zarr_store import ImageSource
+    source = ImageSource()
+    for filename in source.list(condition, 'CH1_masks'):
+        cell_mask = source.read(condition, 'CH1_masks', filename)
+
+Scope: the store is a read-side copy. No pipeline stage writes it; the
+preprocessing and segmentation stages (batch_preprocess, denoise_cache,
+segmentation_service, stream_segmentation, validation_engine) read and write
+the TIFF folders only. `to-zarr` fills the store from those folders, and must
+be rerun after they change. The readers served from it are the analysis and
+visualisation ones: 8_blob_detection.ipynb, cell_nucleus_matching,
+outline_frames, outline_overlay, animation_encoder and blob_sweep.
+
+Zarr (zarr>=3) is only needed when the Zarr layout is used.
+
+Usage:
+    python zarr_store.py to-zarr                          # every condition and kind found as TIFFs
+    python zarr_store.py to-zarr --conditions DMSO --kinds CH1 CH1_masks
+    python zarr_store.py to-tiff --output-dir /tmp/tiff_export
+    python zarr_store.py benchmark --reads 200
+"""
+
+import os
+import time
+import argparse
+
+import numpy as np
+import tifffile
+
+from instrumentation import tiff_read
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "data")
+ZARR_DIR = os.path.join(DATA_DIR, "zarr")
+
+STORAGE = os.environ.get("SMFISH_STORAGE", "tiff")
+TILE = 512
+
+# Kind of image -> TIFF folder relative to data/, with {condition} filled in
+KINDS = {
+    'CH0': os.path.join("processed", "{condition}", "CH0"),
+    'CH1': os.path.join("processed", "{condition}", "CH1"),
+    'CH1_denoised': os.path.join("processed", "{condition}", "CH1_denoised"),
+    'CH0_masks': os.path.join("final_masks", "{condition}", "CH0_masks"),
+    'CH1_masks': os.path.join("final_masks", "{condition}", "CH1_masks"),
+}
+
+
+def _require_zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError("The Zarr store needs zarr>=3: pip install zarr") from None
+    return zarr
+
+
+def tiff_dir(condition, kind, data_dir=DATA_DIR):
+    if kind not in KINDS:
+        raise ValueError(f"Unknown image kind '{kind}'. Available: {', '.join(KINDS)}")
+    return os.path.join(data_dir, KINDS[kind].format(condition=condition))
+
+
+class ZarrImageStore:
+    """One Zarr group per condition, one (images, Y, X) array per kind."""
+
+    def __init__(self, root=ZARR_DIR, tile=TILE):
+        self.zarr = _require_zarr()
+        self.root = root
+        self.tile = tile
+        self._groups = {}
+        self._arrays = {}
+        self._indexes = {}
+
+    def group_path(self, condition):
+        return os.path.join(self.root, f"{condition}.zarr")
+
+    def conditions(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(d[:-len('.zarr')] for d in os.listdir(self.root) if d.endswith('.zarr'))
+
+    def _group(self, condition, mode='r'):
+        key = (condition, mode)
+        if key not in self._groups:
+            if mode == 'r' and not os.path.isdir(self.group_path(condition)):
+                raise FileNotFoundError(f"No Zarr group for condition '{condition}' in {self.root}")
+            self._groups[key] = self.zarr.open_group(self.group_path(condition), mode=mode)
+        return self._groups[key]
+
+    def array(self, condition, kind):
+        """The lazy (images, Y, X) Zarr array; slicing it decodes only the chunks touched."""
+        if (condition, kind) not in self._arrays:
+            group = self._group(condition)
+            if kind not in group:
+                raise FileNotFoundError(f"No '{kind}' images for condition '{condition}'")
+            self._arrays[condition, kind] = group[kind]
+        return self._arrays[condition, kind]
+
+    def index(self, condition, kind):
+        """{filename: [position, height, width]}, read once per store object."""
+        if (condition, kind) not in self._indexes:
+            try:
+                self._indexes[condition, kind] = dict(self.array(condition, kind).attrs['images'])
+            except FileNotFoundError:
+                return {}
+        return self._indexes[condition, kind]
+
+    def list(self, condition, kind):
+        return sorted(self.index(condition, kind))
+
+    def read(self, condition, kind, filename):
+        entry = self.index(condition, kind).get(filename)
+        if entry is None:
+            raise FileNotFoundError(f"{filename} is not in {condition}/{kind}")
+        position, height, width = entry
+        return self.array(condition, kind)[position, :height, :width]
+
+    def write_many(self, condition, kind, items):
+        """
+        Store (filename, image) pairs, replacing images already stored under the same name.
+
+        The array grows to fit the largest image; smaller images are padded
+        with zeros and cropped back on read. Not safe for concurrent writers.
+        """
+        from zarr.codecs import BloscCodec
+
+        group = self._group(condition, mode='a')
+        array = None
+        index = {}
+        for filename, image in items:
+            image = np.asarray(image)
+            if image.ndim != 2:
+                raise ValueError(f"{filename}: expected a 2D image, got shape {image.shape}")
+            if array is None:
+                if kind in group:
+                    array = group[kind]
+                    index = dict(array.attrs['images'])
+                else:
+                    array = group.create_array(
+                        kind, shape=(0,) + image.shape, dtype=image.dtype,
+                        chunks=(1, min(self.tile, image.shape[0]), min(self.tile, image.shape[1])),
+                        compressors=BloscCodec(cname='zstd', clevel=3, shuffle='bitshuffle'),
+                        fill_value=0, dimension_names=('image', 'y', 'x'), attributes={'images': {}})
+            if not np.can_cast(image.dtype, array.dtype, casting='safe'):
+                raise ValueError(f"{filename}: {image.dtype} does not fit the {array.dtype} '{kind}' array")
+
+            position = index[filename][0] if filename in index else len(index)
+            shape = (max(array.shape[0], position + 1), max(array.shape[1], image.shape[0]),
+                     max(array.shape[2], image.shape[1]))
+            if shape != array.shape:
+                array.resize(shape)
+            height, width = image.shape
+            if (height, width) != shape[1:]:
+                array[position] = 0
+            array[position, :height, :width] = image
+            index[filename] = [position, height, width]
+        if array is not None:
+            array.attrs['images'] = index
+        # Readers of this object see the new images; the read-only handles are reopened
+        self._groups.pop((condition, 'r'), None)
+        self._arrays.pop((condition, kind), None)
+        self._indexes.pop((condition, kind), None)
+        return len(index)
+
+    def write(self, condition, kind, filename, image):
+        return self.write_many(condition, kind, [(filename, image)])
+
+
+class ImageSource:
+    """Lists and reads images from the TIFF folders or the Zarr store, by condition and kind."""
+
+    def __init__(self, storage=None, data_dir=DATA_DIR, zarr_dir=ZARR_DIR):
+        self.storage = storage or STORAGE
+        self.data_dir = data_dir
+        if self.storage not in ('tiff', 'zarr'):
+            raise ValueError(f"Unknown storage '{self.storage}'. Use 'tiff' or 'zarr'.")
+        self.store = ZarrImageStore(zarr_dir) if self.storage == 'zarr' else None
+
+    def conditions(self, kind='CH1'):
+        if self.store is not None:
+            return self.store.conditions()
+        parent = os.path.join(self.data_dir, KINDS[kind].split(os.sep)[0])
+        if not os.path.isdir(parent):
+            return []
+        return sorted(d for d in os.listdir(parent) if os.path.isdir(os.path.join(parent, d)))
+
+    def list(self, condition, kind):
+        if self.store is not None:
+            return self.store.list(condition, kind)
+        folder = tiff_dir(condition, kind, self.data_dir)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(f for f in os.listdir(folder) if f.endswith(('.tif', '.tiff')))
+
+    def exists(self, condition, kind):
+        if self.store is not None:
+            return bool(self.store.index(condition, kind))
+        return os.path.isdir(tiff_dir(condition, kind, self.data_dir))
+
+    def read(self, condition, kind, filename):
+        if self.store is not None:
+            return self.store.read(condition, kind, filename)
+        return tiff_read(os.path.join(tiff_dir(condition, kind, self.data_dir), filename))
+
+
+# --- Conversion ---
+
+def tiff_to_zarr(conditions=None, kinds=None, data_dir=DATA_DIR, zarr_dir=ZARR_DIR, batch=32):
+    """Copy TIFF folders into the Zarr store; returns {(condition, kind): images stored}."""
+    source = ImageSource('tiff', data_dir)
+    store = ZarrImageStore(zarr_dir)
+    conditions = conditions or source.conditions('CH0')
+    counts = {}
+    for condition in conditions:
+        for kind in kinds or KINDS:
+            filenames = source.list(condition, kind)
+            if not filenames:
+                continue
+            for start in range(0, len(filenames), batch):
+                chunk = filenames[start:start + batch]
+                counts[condition, kind] = store.write_many(
+                    condition, kind, [(f, source.read(condition, kind, f)) for f in chunk])
+            print(f"  - {condition}/{kind}: {counts[condition, kind]} images")
+    return counts
+
+
+def zarr_to_tiff(output_dir, conditions=None, kinds=None, zarr_dir=ZARR_DIR):
+    """Write every stored image back to TIFF folders laid out like data/."""
+    store = ZarrImageStore(zarr_dir)
+    counts = {}
+    for condition in conditions or store.conditions():
+        for kind in kinds or KINDS:
+            filenames = store.list(condition, kind)
+            if not filenames:
+                continue
+            folder = tiff_dir(condition, kind, output_dir)
+            os.makedirs(folder, exist_ok=True)
+            for filename in filenames:
+                tifffile.imwrite(os.path.join(folder, filename), store.read(condition, kind, filename))
+            counts[condition, kind] = len(filenames)
+            print(f"  - {condition}/{kind}: {len(filenames)} images")
+    return counts
+
+
+# --- Benchmark ---
+
+def _folder_bytes(path):
+    total, files = 0, 0
+    for folder, _, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(folder, filename))
+            files += 1
+    return total, files
+
+
+def benchmark(conditions=None, kinds=None, reads=200, seed=0, data_dir=DATA_DIR, zarr_dir=ZARR_DIR):
+    """Listing, full-scan and random-access read throughput of both layouts over the same images."""
+    tiff = ImageSource('tiff', data_dir)
+    zarr_source = ImageSource('zarr', data_dir, zarr_dir)
+    conditions = conditions or zarr_source.conditions()
+    images = [(c, k, f) for c in conditions for k in (kinds or KINDS) for f in zarr_source.list(c, k)
+              if os.path.exists(os.path.join(tiff_dir(c, k, data_dir), f))]
+    if not images:
+        print("No images present in both layouts: run `python zarr_store.py to-zarr` first.")
+        return []
+    rng = np.random.default_rng(seed)
+    sample = [images[i] for i in rng.integers(0, len(images), size=reads)]
+
+    rows = []
+    for name, source in (('tiff', tiff), ('zarr', zarr_source)):
+        start = time.perf_counter()
+        for condition in conditions:
+            for kind in kinds or KINDS:
+                source.list(condition, kind)
+        listing = time.perf_counter() - start
+
+        for mode, selection in (('scan', images), ('random', sample)):
+            start = time.perf_counter()
+            nbytes = sum(source.read(c, k, f).nbytes for c, k, f in selection)
+            seconds = time.perf_counter() - start
+            rows.append({'layout': name, 'mode': mode, 'images': len(selection), 'seconds': seconds,
+                         'images_per_second': len(selection) / seconds, 'mb_per_second': nbytes / 1e6 / seconds,
+                         'listing_seconds': listing})
+
+    tiff_bytes = sum(os.path.getsize(os.path.join(tiff_dir(c, k, data_dir), f)) for c, k, f in images)
+    zarr_bytes, zarr_files = _folder_bytes(zarr_dir)
+    print(f"\n{len(images)} images: TIFF {tiff_bytes / 1e6:.1f} MB in {len(images)} files, "
+          f"Zarr {zarr_bytes / 1e6:.1f} MB in {zarr_files} files")
+    print(f"{'layout':<8}{'mode':<8}{'images':>8}{'img/s':>10}{'MB/s':>10}{'list s':>9}")
+    for row in rows:
+        print(f"{row['layout']:<8}{row['mode']:<8}{row['images']:>8}{row['images_per_second']:>10.1f}"
+              f"{row['mb_per_second']:>10.1f}{row['listing_seconds']:>9.3f}")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chunked Zarr store for projections and masks")
+    parser.add_argument('--data-dir', default=DATA_DIR, help='Folder holding processed/ and final_masks/')
+    parser.add_argument('--zarr-dir', default=ZARR_DIR)
+    subparsers = parser.add_subparsers(dest='command')
+    for name, help_text in (('to-zarr', 'Convert TIFF folders to the Zarr store'),
+                            ('to-tiff', 'Export the Zarr store to TIFF folders'),
+                            ('benchmark', 'Read throughput of the TIFF and Zarr layouts')):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument('--conditions', nargs='*', help='Conditions (default: all found)')
+        sub.add_argument('--kinds', nargs='*', choices=list(KINDS), help='Image kinds (default: all)')
+    subparsers.choices['to-tiff'].add_argument('--output-dir', required=True)
+    subparsers.choices['benchmark'].add_argument('--reads', type=int, default=200,
+                                                 help='Random single-image reads per layout')
+    args = parser.parse_args()
+
+    if args.command == 'to-zarr':
+        counts = tiff_to_zarr(args.conditions, args.kinds, args.data_dir, args.zarr_dir)
+        print(f"✓ {sum(counts.values())} images stored in {args.zarr_dir}")
+    elif args.command == 'to-tiff':
+        counts = zarr_to_tiff(args.output_dir, args.conditions, args.kinds, args.zarr_dir)
+        print(f"✓ {sum(counts.values())} images written to {args.output_dir}")
+    elif args.command == 'benchmark':
+        benchmark(args.conditions, args.kinds, args.reads, data_dir=args.data_dir, zarr_dir=args.zarr_dir)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()